@@ -0,0 +1,123 @@
+import logging
+from power_values import REGISTERS, FACTORS, SHORT_INDEX, P_INDEX, N_INDEX
+
+logger = logging.getLogger(__name__)
+
+# Counter registers for which the consumption within a window is reported
+ENERGY_INDEXES = (SHORT_INDEX['WirkenergieP'], SHORT_INDEX['WirkenergieN'])
+
+class AggregateSnapshot:
+    """
+    min/max/mean/last of every register over one window. display holds the
+    means, so sinks written for PowerValuesSnapshot work unchanged.
+    """
+
+    __slots__ = ('window', 'start', 'end', 'count', 'display', 'minimum', 'maximum', 'last',
+                 'energy', 'timestamp', 'frame_counter', 'meter', 'wirkleistung_gesamt')
+
+    def __init__(self, window, start, end, count, display, minimum, maximum, last, energy, frame_counter, meter=''):
+        set_attr = object.__setattr__
+        set_attr(self, 'window', window)
+        set_attr(self, 'start', start)
+        set_attr(self, 'end', end)
+        set_attr(self, 'count', count)
+        set_attr(self, 'display', display)
+        set_attr(self, 'minimum', minimum)
+        set_attr(self, 'maximum', maximum)
+        set_attr(self, 'last', last)
+        set_attr(self, 'energy', energy)
+        set_attr(self, 'timestamp', start)
+        set_attr(self, 'frame_counter', frame_counter)
+        set_attr(self, 'meter', meter)
+        set_attr(self, 'wirkleistung_gesamt', display[P_INDEX] - display[N_INDEX])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("AggregateSnapshot is immutable")
+
+    def items(self):
+        """
+        Yields (register, mean value) in the order of REGISTERS.
+        """
+        return zip(REGISTERS, self.display)
+
+class WindowAggregator:
+    """
+    Tumbling window over the snapshots of the serial reader, aligned to
+    multiples of the window length (15 min windows match the billing
+    periods of the grid operator). Every frame updates running sums and
+    extremes of the raw values, a finished window is returned as
+    AggregateSnapshot by the first frame behind it.
+
+    Every meter needs its own aggregator.
+    """
+
+    def __init__(self, name, length, meter=''):
+        self.name = name
+        self.meter = meter
+        self.length = int(length)
+        if self.length <= 0:
+            raise ValueError(f"Window {name} needs a positive length")
+        self.start = None
+        # Counter readings at the end of the previous window, the energy delta
+        # of a window reaches back to them so nothing between windows is lost
+        self.previous_last = None
+        self._reset()
+
+    def _reset(self):
+        self.count = 0
+        self.sums = [0] * len(REGISTERS)
+        self.minimum = None
+        self.maximum = None
+        self.first = None
+        self.last = None
+        self.frame_counter = None
+
+    def add(self, snapshot):
+        start = snapshot.timestamp - snapshot.timestamp % self.length
+        finished = None
+        if self.start is not None and start != self.start:
+            finished = self.flush()
+        self.start = start
+
+        raw = snapshot.raw
+        if self.count == 0:
+            self.minimum = list(raw)
+            self.maximum = list(raw)
+            self.first = raw
+        else:
+            minimum = self.minimum
+            maximum = self.maximum
+            for i, value in enumerate(raw):
+                if value < minimum[i]:
+                    minimum[i] = value
+                elif value > maximum[i]:
+                    maximum[i] = value
+        self.sums = [total + value for total, value in zip(self.sums, raw)]
+        self.last = raw
+        self.frame_counter = snapshot.frame_counter
+        self.count += 1
+        return finished
+
+    def flush(self):
+        """
+        Returns the aggregate of the current window (None if it is empty) and
+        starts a new one.
+        """
+        if self.count == 0:
+            return None
+
+        count = self.count
+        baseline = self.previous_last if self.previous_last is not None else self.first
+        energy = {REGISTERS[i].short: (self.last[i] - baseline[i]) * FACTORS[i] for i in ENERGY_INDEXES}
+        aggregate = AggregateSnapshot(
+            self.name, self.start, self.start + self.length, count,
+            tuple([total / count * factor for total, factor in zip(self.sums, FACTORS)]),
+            tuple([value * factor for value, factor in zip(self.minimum, FACTORS)]),
+            tuple([value * factor for value, factor in zip(self.maximum, FACTORS)]),
+            tuple([value * factor for value, factor in zip(self.last, FACTORS)]),
+            energy, self.frame_counter, self.meter)
+
+        self.previous_last = self.last
+        self._reset()
+        logger.debug(f"Window {self.name} starting {self.start} closed with {count} frames")
+        return aggregate
@@ -0,0 +1,248 @@
+"""
+Archive of every frame in columnar files for offline analysis, one
+directory per meter ('' with a single meter) and per hour or day (UTC)
+one or more part files of at most batch_size frames:
+
+    archive/haus/2026-10-18.0.parquet    (pyarrow installed)
+    archive/haus/2026-10-18.1.parquet
+    archive/haus/2026-10-18T14.0.csv.gz  (hourly, without pyarrow)
+
+Columns: timestamp (UTC), meter, frame_counter, the raw register values
+as integers under their short names (display value = raw * factor, see
+power_values.REGISTERS, in Parquet also as field metadata) and with
+raw_frames the encrypted telegram payload (hex in CSV).
+"""
+import os
+import csv
+import gzip
+import time
+import queue
+import logging
+import threading
+import importlib.util
+from array import array
+from datetime import datetime, timezone
+from power_values import REGISTERS
+
+logger = logging.getLogger(__name__)
+
+ROTATIONS = {'hourly': '%Y-%m-%dT%H', 'daily': '%Y-%m-%d'}
+FORMATS = ('auto', 'parquet', 'csv')
+SUFFIXES = {'parquet': '.parquet', 'csv': '.csv.gz'}
+# Full batches waiting for the writer thread, add() blocks beyond that
+PENDING_BATCHES = 2
+# Seconds between retention checks
+RETENTION_INTERVAL = 600
+
+class ArchiveBatch:
+    """
+    The buffered frames of one meter and period as columns: receive times,
+    frame counters and raw register values in typed arrays, 100 bytes per
+    frame plus the payload if kept.
+    """
+
+    def __init__(self, meter, period, raw_frames):
+        self.meter = meter
+        self.period = period
+        self.started = time.monotonic()
+        self.timestamps = array('d')
+        self.frame_counters = array('I')
+        # Signed, a few registers are DLMS integers
+        self.registers = [array('q') for _ in REGISTERS]
+        self.payloads = [] if raw_frames else None
+
+    def append(self, snapshot):
+        self.timestamps.append(snapshot.timestamp)
+        self.frame_counters.append(snapshot.frame_counter or 0)
+        for column, value in zip(self.registers, snapshot.raw):
+            column.append(value)
+        if self.payloads is not None:
+            self.payloads.append(snapshot.payload)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+class ArchiveWriter:
+    """
+    Sink of the raw stream. add() only appends to the batch of the meter on
+    the sink worker thread, full batches, batches of an ended period and
+    batches older than flush_interval seconds are written by a thread of
+    its own. At most PENDING_BATCHES full batches wait for it, beyond that
+    add() blocks and the sink queue takes over.
+
+    Retention deletes files older than retention_days and, with max_size_mb,
+    the oldest files beyond that size (0 for no limit each).
+    """
+
+    def __init__(self, directory, metrics, rotation='daily', file_format='auto', batch_size=3600, flush_interval=3600, retention_days=0, max_size_mb=0, raw_frames=False):
+        if rotation not in ROTATIONS:
+            raise ValueError(f"Unknown archive rotation: {rotation}")
+        if file_format not in FORMATS:
+            raise ValueError(f"Unknown archive format: {file_format}")
+
+        has_pyarrow = importlib.util.find_spec('pyarrow') is not None
+        if file_format == 'parquet' and not has_pyarrow:
+            logger.warning("pyarrow ist nicht installiert, archiviere als CSV")
+        self.format = 'parquet' if file_format != 'csv' and has_pyarrow else 'csv'
+        self.directory = directory
+        self.metrics = metrics
+        self.pattern = ROTATIONS[rotation]
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+        self.max_size_mb = max_size_mb
+        self.raw_frames = raw_frames
+        self.batches = {}
+        self.lock = threading.Lock()
+        self.pending = queue.Queue(PENDING_BATCHES)
+        self.retention_checked = None
+        self.schema = None
+        self.thread = threading.Thread(target=self._run, name="archive", daemon=True)
+        self.thread.start()
+        logger.info(f"Archiv in {directory} ({self.format}, {rotation})")
+
+    def add(self, snapshot):
+        period = time.strftime(self.pattern, time.gmtime(snapshot.timestamp))
+        done = []
+        with self.lock:
+            batch = self.batches.get(snapshot.meter)
+            if batch is not None and batch.period != period:
+                done.append(batch)
+                batch = None
+            if batch is None:
+                batch = self.batches[snapshot.meter] = ArchiveBatch(snapshot.meter, period, self.raw_frames)
+            batch.append(snapshot)
+            if len(batch) >= self.batch_size:
+                done.append(self.batches.pop(snapshot.meter))
+        for batch in done:
+            self.pending.put(batch)
+
+    def close(self):
+        """
+        Writes out the buffered frames, waits for the writer thread.
+        """
+        self.pending.put(None)
+        self.thread.join(timeout=30)
+
+    def _take(self, all_batches=False):
+        # Batches due for writing although not full
+        now = time.monotonic()
+        with self.lock:
+            due = [meter for meter, batch in self.batches.items() if all_batches or now - batch.started >= self.flush_interval]
+            return [self.batches.pop(meter) for meter in due]
+
+    def _run(self):
+        while True:
+            closing = False
+            try:
+                batch = self.pending.get(timeout=self.flush_interval)
+                closing = batch is None
+                if not closing:
+                    self._write(batch)
+            except queue.Empty:
+                pass
+            for expired in self._take(all_batches=closing):
+                self._write(expired)
+            if closing:
+                return
+            if self.retention_checked is None or time.monotonic() - self.retention_checked >= RETENTION_INTERVAL:
+                self.retention_checked = time.monotonic()
+                self._enforce_retention()
+
+    def _path(self, batch):
+        directory = os.path.join(self.directory, batch.meter)
+        os.makedirs(directory, exist_ok=True)
+        suffix = SUFFIXES[self.format]
+        part = 0
+        while os.path.exists(os.path.join(directory, f"{batch.period}.{part}{suffix}")):
+            part += 1
+        return os.path.join(directory, f"{batch.period}.{part}{suffix}")
+
+    def _write(self, batch):
+        """
+        Writes batch atomically to the next part file of its period, a
+        crash leaves at most a .tmp file behind.
+        """
+        path = temp = None
+        try:
+            path = self._path(batch)
+            temp = f"{path}.tmp"
+            if self.format == 'parquet':
+                self._write_parquet(temp, batch)
+            else:
+                self._write_csv(temp, batch)
+            os.replace(temp, path)
+        except Exception as e:
+            if temp and os.path.exists(temp):
+                os.remove(temp)
+            self.metrics.archive_failures += 1
+            logger.error(f"Archiv: {len(batch)} Frames von {batch.period} konnten nicht geschrieben werden: {e}")
+            return
+        self.metrics.archive_rows += len(batch)
+        self.metrics.archive_files += 1
+        logger.debug(f"Archiv: {len(batch)} Frames nach {path} geschrieben")
+
+    def _columns(self):
+        return ['timestamp', 'meter', 'frame_counter'] + [register.short for register in REGISTERS] + (['payload'] if self.raw_frames else [])
+
+    def _write_csv(self, path, batch):
+        columns = [batch.timestamps, batch.frame_counters, *batch.registers]
+        if batch.payloads is not None:
+            columns.append([payload.hex() if payload else '' for payload in batch.payloads])
+        with gzip.open(path, 'wt', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(self._columns())
+            for timestamp, *values in zip(*columns):
+                writer.writerow([datetime.fromtimestamp(timestamp, timezone.utc).isoformat(timespec='milliseconds'), batch.meter, *values])
+
+    def _write_parquet(self, path, batch):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self.schema is None:
+            fields = [pa.field('timestamp', pa.timestamp('ms', tz='UTC')), pa.field('meter', pa.string()), pa.field('frame_counter', pa.uint32())]
+            fields += [pa.field(register.short, pa.int64(), metadata={'obis': register.obis, 'unit': register.unit, 'factor': str(register.factor)}) for register in REGISTERS]
+            if self.raw_frames:
+                fields.append(pa.field('payload', pa.binary()))
+            self.schema = pa.schema(fields)
+
+        arrays = [pa.array([round(timestamp * 1000) for timestamp in batch.timestamps], pa.timestamp('ms', tz='UTC')),
+                  pa.array([batch.meter] * len(batch), pa.string()),
+                  pa.array(batch.frame_counters, pa.uint32())]
+        arrays += [pa.array(column, pa.int64()) for column in batch.registers]
+        if self.raw_frames:
+            arrays.append(pa.array(batch.payloads, pa.binary()))
+        pq.write_table(pa.Table.from_arrays(arrays, schema=self.schema), path, compression='zstd')
+
+    def _enforce_retention(self):
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(tuple(SUFFIXES.values())):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+
+        expired = []
+        if self.retention_days:
+            cutoff = time.time() - self.retention_days * 86400
+            expired = [entry for entry in files if entry[0] < cutoff]
+            files = files[len(expired):]
+        if self.max_size_mb:
+            size = sum(entry[1] for entry in files)
+            while files and size > self.max_size_mb * 1024 * 1024:
+                entry = files.pop(0)
+                size -= entry[1]
+                expired.append(entry)
+
+        for _, _, path in expired:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.error(f"Archiv: {path} kann nicht gelöscht werden: {e}")
+        if expired:
+            logger.info(f"Archiv: {len(expired)} alte Dateien gelöscht")
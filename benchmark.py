@@ -0,0 +1,245 @@
+"""
+Micro-benchmarks for the per frame hot path.
+
+reader: feeds the sample telegram from the EVN customer interface
+documentation (docs/218_12_SmartMeter_Kundenschnittstelle_lektoriert_2803.pdf)
+through SerialReader.read with an in-memory serial port, or with --source
+generated distinct telegrams with drifting values from frame_generator.
+influx: serializes one frame of values to InfluxDB line protocol.
+gateway: streams the sample telegram over loopback TCP from a stand-in
+process to GatewayIngest, once per meter count, and reports the decoded
+frames/sec of all meters together. Stand-in, event loop and decode
+processes share the machine: the total only grows with the meters while
+there are idle cores, on a single core it stays at the decode rate of one
+process (about 17,000 frames/sec, 1 us of it pickling).
+
+    python3 benchmark.py [--frames 2000] [--repeat 3] reader [--decoder native|gurux] [--source sample|generated]
+    python3 benchmark.py [--frames 2000] [--repeat 3] influx [--serializer line|point]
+    python3 benchmark.py [--frames 2000] [--repeat 3] gateway [--meters 1,2,4,8] [--workers N]
+"""
+import argparse
+import logging
+import os
+import time
+
+import serial_reader
+from power_values import PowerValues
+from stage_timings import StageTimings
+
+# Encrypted telegram (two M-Bus frames) and key as printed in the EVN documentation
+SAMPLE_KEY = "36C66639E48A8CA4D6BC8B282A793BBB"
+SAMPLE_TELEGRAM = bytes.fromhex(
+    "68FAFA6853FF000167DB084B464D675000000981F8200000002388D5AB4F97515AAFC6B88D2F85DAA7A0E3C0C40D004535C397C9D"
+    "037AB7DBDA329107615444894A1A0DD7E85F02D496CECD3FF46AF5FB3C9229CFE8F3EE4606AB2E1F409F36AAD2E50900A4396FC6C2E"
+    "083F373233A69616950758BFC7D63A9E9B6E99E21B2CBC2B934772CA51FD4D69830711CAB1F8CFF25F0A329337CBA51904F0CA"
+    "ED88D61968743C8454BA922EB00038182C22FE316D16F2A9F544D6F75D51A4E92A1C4EF8AB19A2B7FEAA32D0726C0ED80229AE6C"
+    "0F7621A4209251ACE2B2BC66FF0327A653BB686C756BE033C7A281F1D2A7E1FA31C3983E15F8FD16CC5787E6F517166814146853F"
+    "F110167419A3CFDA44BE438C96F0E38BF83D98316"
+)
+
+
+class MemorySerial:
+    """Serial port stand-in that returns a prepared byte stream."""
+
+    # Bytes available per read, roughly what a UART driver buffers
+    CHUNK = 1024
+
+    def __init__(self, data, **kwargs):
+        self.data = memoryview(data)
+        self.pos = 0
+        self.is_open = True
+
+    @property
+    def in_waiting(self):
+        return min(self.CHUNK, len(self.data) - self.pos)
+
+    def read(self, size=1):
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += len(chunk)
+        return bytes(chunk)
+
+    def close(self):
+        self.is_open = False
+
+
+class NullMetrics:
+    serial_restarts = 0
+
+    def __init__(self):
+        self.timings = StageTimings(enabled=False)
+
+    def inc_serial_restarts(self):
+        self.serial_restarts += 1
+
+    def serial_stall_started(self):
+        pass
+
+    def serial_stall_recovered(self, duration):
+        pass
+
+    def count_frame_reject(self, reason):
+        pass
+
+
+def generated_stream(frames):
+    from frame_generator import FrameGenerator, TEST_KEY
+    generator = FrameGenerator(TEST_KEY, seed=1)
+    return TEST_KEY, b''.join(b''.join(telegram) for _, _, telegram in generator.generate(frames))
+
+
+def timed(frames, call, latencies=None):
+    """
+    Calls call() frames times and returns the frames/sec. The seconds of
+    every call are appended to latencies if given (benchmark_suite).
+    """
+    clock = time.perf_counter
+    start = clock()
+    if latencies is None:
+        for _ in range(frames):
+            call()
+    else:
+        for _ in range(frames):
+            begin = clock()
+            call()
+            latencies.append(clock() - begin)
+    return frames / (clock() - start)
+
+
+def memory_reader(key, stream, decoder="native", track_frame_counter=True):
+    """SerialReader on an in-memory serial port holding stream."""
+    return serial_reader.SerialReader("memory", 2400, key, NullMetrics(), decoder, source=MemorySerial(stream), track_frame_counter=track_frame_counter)
+
+
+def bench_reader(frames, decoder, source="sample", latencies=None):
+    if source == "generated":
+        key, stream = generated_stream(frames)
+    else:
+        key, stream = SAMPLE_KEY, SAMPLE_TELEGRAM * frames
+
+    # The sample telegram repeats its frame counter, only generated telegrams pass the tracking
+    reader = memory_reader(key, stream, decoder, track_frame_counter=source == "generated")
+    pv = PowerValues()
+    return timed(frames, lambda: reader.read(pv), latencies)
+
+
+def build_points(pv, mytime):
+    """The Point based serialization InfluxHandler used before LineProtocolSerializer."""
+    from influxdb_client import Point
+    points = [
+        Point("Wirkenergie").field("Bezug", pv.get_display_value('WirkenergieP')).field("Lieferung", pv.get_display_value('WirkenergieN')).time(mytime),
+        Point("Momentanleistung").field("Bezug", pv.get_display_value('MomentanleistungP')).field("Lieferung", pv.get_display_value('MomentanleistungN')).field("Gesamt", pv.get_display_value('MomentanleistungP') - pv.get_display_value('MomentanleistungN')).time(mytime),
+        Point("Spannung").field("L1", pv.get_display_value('SpannungL1')).field("L2", pv.get_display_value('SpannungL2')).field("L3", pv.get_display_value('SpannungL3')).time(mytime),
+        Point("Strom").field("L1", pv.get_display_value('StromL1')).field("L2", pv.get_display_value('StromL2')).field("L3", pv.get_display_value('StromL3')).time(mytime),
+        Point("Leistungsfaktor").field("value", pv.get_display_value('Leistungsfaktor')).time(mytime),
+    ]
+    return [point.to_line_protocol() for point in points]
+
+
+def bench_influx(frames, serializer, latencies=None):
+    from line_protocol import LineProtocolSerializer
+
+    pv = PowerValues()
+    for index, raw in enumerate([12937, 3, 1234, 0, 2337, 2301, 2298, 512, 87, 133, 998]):
+        pv.set_raw(index, raw)
+    snapshot = pv.snapshot()
+
+    if serializer == "point":
+        serialize = build_points
+    else:
+        serialize = LineProtocolSerializer().serialize_values
+
+    return timed(frames, lambda: serialize(snapshot, time.time_ns()), latencies)
+
+
+def run_standin(port, frames):
+    import asyncio
+    from gateway import serve_standin
+    logging.disable(logging.CRITICAL)
+    asyncio.run(serve_standin([SAMPLE_TELEGRAM], "127.0.0.1", port, interval=0, count=frames))
+
+
+def bench_gateway(frames, meters, workers):
+    import asyncio
+    import multiprocessing
+    import socket
+    from gateway import GatewayIngest, GatewayMeter
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    standin = multiprocessing.Process(target=run_standin, args=(port, frames), daemon=True)
+    standin.start()
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+
+    async def run():
+        done = asyncio.Event()
+        # Timed from the first decoded telegram, the pool processes are started by then
+        received = 0
+        first = last = 0.0
+
+        def on_values(label, raw, timestamp, frame_counter, payload):
+            nonlocal received, first, last
+            last = time.perf_counter()
+            if not received:
+                first = last
+            received += 1
+            if received == frames * meters:
+                done.set()
+
+        # The sample telegram repeats its frame counter
+        ingest = GatewayIngest([GatewayMeter(f"meter{i}", SAMPLE_KEY, "tcp-client", "127.0.0.1", port, track_frame_counter=False) for i in range(meters)], on_values, workers)
+        task = asyncio.create_task(ingest.serve())
+        await asyncio.wait_for(done.wait(), timeout=120)
+        task.cancel()
+        return (received - 1) / (last - first)
+
+    try:
+        return asyncio.run(run())
+    finally:
+        standin.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SmartMeter hot path benchmarks")
+    parser.add_argument("--frames", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=3, help="best of N runs is reported")
+    stages = parser.add_subparsers(dest="stage", required=True)
+
+    reader = stages.add_parser("reader", help="SerialReader.read: framing, decryption and decoding")
+    reader.add_argument("--decoder", choices=["native", "gurux"], default="native")
+    reader.add_argument("--source", choices=["sample", "generated"], default="sample")
+
+    influx = stages.add_parser("influx", help="InfluxDB value serialization")
+    influx.add_argument("--serializer", choices=["line", "point"], default="line")
+
+    gateway = stages.add_parser("gateway", help="GatewayIngest: loopback TCP, framing and pooled decoding")
+    gateway.add_argument("--meters", default="1,2,4,8", help="comma separated meter counts")
+    gateway.add_argument("--workers", type=int, default=None, help="decode processes (default: CPU count - 1)")
+
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    if args.stage == "gateway":
+        workers = max(0, (os.cpu_count() or 1) - 1) if args.workers is None else args.workers
+        print(f"gateway: {workers} decode processes on {os.cpu_count()} CPUs, stand-in included")
+        for meters in [int(count) for count in args.meters.split(",")]:
+            rate = max(bench_gateway(args.frames, meters, args.workers) for _ in range(args.repeat))
+            print(f"gateway {meters} meters: {rate:,.0f} frames/sec ({rate / meters:,.0f} per meter)")
+        return
+
+    if args.stage == "reader":
+        label = f"{args.decoder} {args.source}"
+        rate = max(bench_reader(args.frames, args.decoder, args.source) for _ in range(args.repeat))
+    else:
+        label = args.serializer
+        rate = max(bench_influx(args.frames, args.serializer) for _ in range(args.repeat))
+    print(f"{args.stage} {label}: {rate:,.0f} frames/sec ({1e6 / rate:.1f} us/frame)")
+
+
+if __name__ == "__main__":
+    main()
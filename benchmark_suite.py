@@ -0,0 +1,471 @@
+"""
+Per stage and end to end throughput of the frame pipeline, for comparing
+hosts (e.g. a Raspberry Pi) and catching regressions over time.
+
+Every stage runs in a fresh interpreter, so its peak RSS is its own, on
+distinct telegrams from frame_generator. reader, influx_serialize and
+gateway are the functions of benchmark.py:
+
+    framing           MBusFramer and SegmentAssembler on the byte stream
+    decrypt           SerialReader._decrypt
+    decode            DLMSDecoder.decode (native decoder)
+    pduToXml          GXDLMSTranslator.pduToXml (gurux decoder)
+    parse_xml         SerialReader._parse_xml (gurux decoder)
+    set_value         PowerValues.set_value for all registers of a frame
+    reader            SerialReader.read: framing, decryption and decoding
+                      (bench_reader)
+    influx_serialize  LineProtocolSerializer.serialize_values (bench_influx)
+    influx_write      InfluxHandler.write_values against a local HTTP stub
+    mqtt_publish      MQTTHandler.publish_batch against a local stand-in
+                      broker, until every PUBACK of the frame arrived
+    gateway           GatewayIngest with one meter over loopback TCP
+                      (bench_gateway), throughput only
+    end_to_end        SerialReader.read, MQTT publish and InfluxDB write of
+                      each frame one after the other
+
+Per stage frames/sec, per frame latency percentiles and peak RSS are
+printed and optionally written to a JSON file. With --baseline a previous
+file is compared and the exit code is 1 if a stage got slower than
+--tolerance allows.
+
+    python3 benchmark_suite.py [--frames 2000] [--repeat 3] [--stages decrypt,decode] [--output results.json] [--baseline old.json] [--tolerance 0.15]
+"""
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import platform
+import resource
+import threading
+import subprocess
+import multiprocessing
+import socketserver
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import benchmark
+
+STAGES = ("framing", "decrypt", "decode", "pduToXml", "parse_xml", "set_value", "reader",
+          "influx_serialize", "influx_write", "mqtt_publish", "gateway", "end_to_end")
+
+# Stages measured by the functions of benchmark.py
+BENCHMARK_STAGES = ("reader", "influx_serialize", "gateway")
+
+# Stages that need the stand-in services
+MQTT_STAGES = ("mqtt_publish", "end_to_end")
+INFLUX_STAGES = ("influx_write", "end_to_end")
+
+PERCENTILES = (0.5, 0.95, 0.99)
+
+MQTT_PREFIX = "smartmeter/"
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+class BrokerHandler(socketserver.BaseRequestHandler):
+    """
+    MQTT 3.1.1 stand-in: accepts every connection, acknowledges QoS 1
+    publishes and answers pings, the messages themselves are dropped.
+    """
+
+    def read_packet(self, f):
+        header = f.read(1)
+        if not header:
+            return None, None
+        multiplier, length = 1, 0
+        while True:
+            byte = f.read(1)[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header[0], f.read(length)
+
+    def handle(self):
+        # PUBACKs go out at once like on a real broker, not after the delayed ACK
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        f = self.request.makefile('rb')
+        while True:
+            header, data = self.read_packet(f)
+            if header is None:
+                return
+            packet_type = header >> 4
+            if packet_type == 1:
+                self.request.sendall(b'\x20\x02\x00\x00')
+            elif packet_type == 3 and (header >> 1) & 0x03:
+                topic_length = int.from_bytes(data[:2], 'big')
+                self.request.sendall(b'\x40\x02' + data[2 + topic_length:4 + topic_length])
+            elif packet_type == 12:
+                self.request.sendall(b'\xd0\x00')
+            elif packet_type == 14:
+                return
+
+class InfluxStubHandler(BaseHTTPRequestHandler):
+    """
+    Accepts InfluxDB v1 and v2 writes with 204 No Content.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_broker(port):
+    socketserver.ThreadingTCPServer.daemon_threads = True
+    with socketserver.ThreadingTCPServer(("127.0.0.1", port), BrokerHandler) as server:
+        server.serve_forever()
+
+def serve_influx_stub(port):
+    with ThreadingHTTPServer(("127.0.0.1", port), InfluxStubHandler) as server:
+        server.serve_forever()
+
+def start_service(target):
+    """
+    Runs a stand-in service in a process of its own, so it does not compete
+    with the measured stage for the GIL. Returns (process, port).
+    """
+    port = free_port()
+    process = multiprocessing.get_context("spawn").Process(target=target, args=(port,), daemon=True)
+    process.start()
+    wait_for_port(port)
+    return process, port
+
+def generate(frames):
+    """
+    Returns the test key and frames distinct telegrams as lists of M-Bus frames.
+    """
+    from frame_generator import FrameGenerator, TEST_KEY
+    generator = FrameGenerator(TEST_KEY, seed=1)
+    return TEST_KEY, [telegram for _, _, telegram in generator.generate(frames)]
+
+def payloads(telegrams):
+    from mbus_framer import MBusFramer, SegmentAssembler
+    framer = MBusFramer()
+    assembler = SegmentAssembler()
+    result = []
+    for telegram in telegrams:
+        for frame in telegram:
+            framer.feed(frame)
+            payload = assembler.add(framer.next_frame())
+        result.append(payload)
+    return result
+
+def decrypt_args(payload):
+    """
+    Arguments of SerialReader._decrypt for a telegram payload.
+    """
+    from telegram import split_ciphered_apdu
+    system_title, frame_counter, frame = split_ciphered_apdu(payload)
+    return frame, system_title, frame_counter
+
+def apdus(key, telegrams):
+    reader = benchmark.memory_reader(key, b'')
+    return [reader._decrypt(*decrypt_args(payload)) for payload in payloads(telegrams)]
+
+def snapshots(key, telegrams):
+    from power_values import PowerValues
+    from dlms_decoder import DLMSDecoder
+    decoder = DLMSDecoder()
+    result = []
+    for apdu in apdus(key, telegrams):
+        pv = PowerValues()
+        decoder.decode(apdu, pv)
+        result.append(pv.snapshot())
+    return result
+
+def mqtt_messages(snapshot):
+    # Same topics as send_mqtt without meter label and JSON topic
+    messages = [(f"{MQTT_PREFIX}{register.mqttTopicName}", value) for register, value in snapshot.items()]
+    messages.append((f"{MQTT_PREFIX}Wirkleistunggesamt", snapshot.wirkleistung_gesamt))
+    return messages
+
+def connect_mqtt(port):
+    from mqtt_handler import MQTTHandler
+    handler = MQTTHandler("127.0.0.1", port, None, None)
+    deadline = time.monotonic() + 10
+    while not handler.connected:
+        if time.monotonic() > deadline:
+            raise RuntimeError("Stand-in broker did not accept the connection")
+        time.sleep(0.01)
+    return handler
+
+def connect_influx(port):
+    from influx_handler import InfluxHandler
+    return InfluxHandler("127.0.0.1", port, "smartmeter", None, "token", 2, "smartmeter", "smartmeter")
+
+def publish_and_wait(handler, messages):
+    done = threading.Event()
+    results = []
+
+    def callback(success):
+        results.append(success)
+        done.set()
+
+    handler.publish_batch(messages, callback)
+    if not done.wait(handler.publish_timeout + 1) or not results[0]:
+        raise RuntimeError("MQTT publish failed")
+
+def timed(items, call):
+    """
+    Calls call(item) for every item, returns (total seconds, per item seconds).
+    """
+    latencies = []
+    clock = time.perf_counter
+    start = clock()
+    for item in items:
+        begin = clock()
+        call(item)
+        latencies.append(clock() - begin)
+    return clock() - start, latencies
+
+def prepare_stage(stage, frames, ports):
+    """
+    Returns (items, call) of a stage, everything the stage does not measure
+    is prepared here.
+    """
+    key, telegrams = generate(frames)
+
+    if stage == "framing":
+        from mbus_framer import MBusFramer, SegmentAssembler
+        framer = MBusFramer()
+        assembler = SegmentAssembler()
+
+        def frame(telegram):
+            for data in telegram:
+                framer.feed(data)
+                while (mbus_frame := framer.next_frame()) is not None:
+                    assembler.add(mbus_frame)
+        return telegrams, frame
+
+    if stage == "decrypt":
+        reader = benchmark.memory_reader(key, b'')
+        return [decrypt_args(payload) for payload in payloads(telegrams)], lambda args: reader._decrypt(*args)
+
+    if stage == "decode":
+        from power_values import PowerValues
+        from dlms_decoder import DLMSDecoder
+        decoder = DLMSDecoder()
+        pv = PowerValues()
+        return apdus(key, telegrams), lambda apdu: decoder.decode(apdu, pv)
+
+    if stage == "pduToXml":
+        reader = benchmark.memory_reader(key, b'', 'gurux')
+        return apdus(key, telegrams), reader.translator.pduToXml
+
+    if stage == "parse_xml":
+        from power_values import PowerValues
+        reader = benchmark.memory_reader(key, b'', 'gurux')
+        pv = PowerValues()
+        xmls = [reader.translator.pduToXml(apdu) for apdu in apdus(key, telegrams)]
+        return xmls, lambda xml: reader._parse_xml(xml, pv)
+
+    if stage == "set_value":
+        from power_values import PowerValues, REGISTERS
+        pv = PowerValues()
+        items = [list(zip([register.obis for register in REGISTERS], snapshot.raw)) for snapshot in snapshots(key, telegrams)]
+
+        def set_values(values):
+            for obis, raw in values:
+                pv.set_value(obis, raw)
+        return items, set_values
+
+    if stage == "influx_write":
+        handler = connect_influx(ports['influx'])
+
+        def write(snapshot):
+            if not handler.write_values(snapshot):
+                raise RuntimeError("InfluxDB write failed")
+        return snapshots(key, telegrams), write
+
+    if stage == "mqtt_publish":
+        handler = connect_mqtt(ports['mqtt'])
+        return [mqtt_messages(snapshot) for snapshot in snapshots(key, telegrams)], lambda messages: publish_and_wait(handler, messages)
+
+    if stage == "end_to_end":
+        from power_values import PowerValues
+        reader = benchmark.memory_reader(key, b''.join(b''.join(telegram) for telegram in telegrams))
+        mqtt = connect_mqtt(ports['mqtt'])
+        influx = connect_influx(ports['influx'])
+        pv = PowerValues()
+
+        def pipeline(_):
+            reader.read(pv)
+            snapshot = pv.snapshot()
+            publish_and_wait(mqtt, mqtt_messages(snapshot))
+            if not influx.write_values(snapshot):
+                raise RuntimeError("InfluxDB write failed")
+        return range(frames), pipeline
+
+    raise ValueError(f"Unknown stage: {stage}")
+
+def bench_stage(stage, frames):
+    """
+    Runs a stage that benchmark.py measures, returns (frames/sec, per frame
+    seconds or None without latencies).
+    """
+    latencies = []
+    if stage == "reader":
+        return benchmark.bench_reader(frames, "native", "generated", latencies), latencies
+    if stage == "influx_serialize":
+        return benchmark.bench_influx(frames, "line", latencies), latencies
+    # Telegrams arrive in bursts on the event loop, only the rate means something
+    return benchmark.bench_gateway(frames, 1, None), None
+
+def run_stage(stage, frames, ports, results):
+    """
+    Runs in a spawned process and puts the measurement on results.
+    """
+    logging.disable(logging.CRITICAL)
+    try:
+        if stage in BENCHMARK_STAGES:
+            frames_per_sec, latencies = bench_stage(stage, frames)
+        else:
+            items, call = prepare_stage(stage, frames, ports)
+            elapsed, latencies = timed(items, call)
+            frames_per_sec = len(latencies) / elapsed
+    except ImportError as e:
+        results.put({"skipped": f"{e}"})
+        return
+    except Exception as e:
+        results.put({"error": f"{e}"})
+        return
+
+    if latencies:
+        latencies.sort()
+        latency = {f"p{int(q * 100)}": latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1e6 for q in PERCENTILES}
+    else:
+        latency = None
+    results.put({
+        "frames": frames,
+        "frames_per_sec": frames_per_sec,
+        "latency_us": latency,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+    # Background clients (paho, influxdb_client) must not keep the process
+    # alive, but the result has to reach the parent first
+    results.close()
+    results.join_thread()
+    os._exit(0)
+
+def measure(stage, frames, ports):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_stage, args=(stage, frames, ports, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+                              cwd=os.path.dirname(os.path.realpath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the change against baseline per stage and returns the stages
+    whose throughput dropped or median latency rose by more than tolerance.
+    """
+    regressions = []
+    print(f"\nCompared to {baseline.get('revision') or 'baseline'} from {baseline.get('created', '?')}:")
+    for stage, result in results["stages"].items():
+        before = baseline.get("stages", {}).get(stage)
+        if not before or "frames_per_sec" not in before or "frames_per_sec" not in result:
+            continue
+        throughput = result["frames_per_sec"] / before["frames_per_sec"] - 1
+        # The median, the tail of microsecond stages is too noisy to gate on
+        p50 = result["latency_us"]["p50"] / before["latency_us"]["p50"] - 1 if result.get("latency_us") and before.get("latency_us") else None
+        regressed = throughput < -tolerance or (p50 is not None and p50 > tolerance)
+        if regressed:
+            regressions.append(stage)
+        latency = f"{p50:+7.1%} p50" if p50 is not None else "    n/a p50"
+        print(f"  {stage:<17} {throughput:+7.1%} frames/sec  {latency}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="SmartMeter pipeline benchmark suite")
+    parser.add_argument("--frames", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=3, help="the run with the best throughput is reported")
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma separated stages")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed relative slowdown per stage")
+    args = parser.parse_args()
+
+    stages = [stage for stage in args.stages.split(",") if stage]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+
+    services = []
+    ports = {}
+    if set(stages) & set(MQTT_STAGES):
+        process, ports['mqtt'] = start_service(serve_broker)
+        services.append(process)
+    if set(stages) & set(INFLUX_STAGES):
+        process, ports['influx'] = start_service(serve_influx_stub)
+        services.append(process)
+
+    results = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "host": {"machine": platform.machine(), "system": platform.system(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "frames": args.frames,
+        "stages": {},
+    }
+    try:
+        for stage in stages:
+            runs = [measure(stage, args.frames, ports) for _ in range(max(1, args.repeat))]
+            measured = [run for run in runs if "frames_per_sec" in run]
+            result = max(measured, key=lambda run: run["frames_per_sec"]) if measured else runs[0]
+            results["stages"][stage] = result
+
+            if "frames_per_sec" in result:
+                latency = result["latency_us"]
+                percentiles = f"p50 {latency['p50']:>8.1f} us  p95 {latency['p95']:>8.1f} us  p99 {latency['p99']:>8.1f} us" if latency else f"{'no per frame latency':<49}"
+                print(f"{stage:<17} {result['frames_per_sec']:>10,.0f} frames/sec  {percentiles}  peak RSS {result['peak_rss_mib']:.1f} MiB")
+            else:
+                print(f"{stage:<17} {'skipped' if 'skipped' in result else 'failed'}: {result.get('skipped') or result.get('error')}")
+    finally:
+        for process in services:
+            process.terminate()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"Regression in {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,64 +1,152 @@
 import json
 import os
 import sys
+import hashlib
 import logging
 from types import SimpleNamespace
 
-try:
-    import jsonschema
-except ImportError:
-    print("Error: jsonschema module not found. Please install it with 'pip install jsonschema'")
-    sys.exit(1)
+class ConfigError(Exception):
+    pass
+
+def diff_config(old, new, prefix=''):
+    """
+    Dotted paths of the settings that differ between two configuration
+    dicts, e.g. ['logging.console.level', 'mqtt.mqttPrefix'].
+    """
+    changed = []
+    for key in sorted(old.keys() | new.keys()):
+        path = f"{prefix}{key}"
+        old_value, new_value = old.get(key), new.get(key)
+        if isinstance(old_value, dict) and isinstance(new_value, dict):
+            changed.extend(diff_config(old_value, new_value, f"{path}."))
+        elif old_value != new_value:
+            changed.append(path)
+    return changed
 
 class ConfigHandler:
     def __init__(self):
         self.base_path = os.path.dirname(os.path.realpath(__file__))
         self.config_file = os.path.join(self.base_path, 'config.json')
         self.schema_file = os.path.join(self.base_path, 'schema.json')
+        # Hash of the config and schema validated last
+        self.validated_file = os.path.join(self.base_path, '.config.validated')
         self.config = None
+        # Merged configuration as dict, reload() diffs against it
+        self.data = None
+        self.validator = None
+        # (mtime, size) of the file last read
+        self.stat = None
         self.load_config()
 
     def load_config(self):
-        if not os.path.exists(self.config_file):
-            print(f"Config file not found: {self.config_file}")
+        try:
+            self.data = self._read()
+        except ConfigError as e:
+            print(e)
             sys.exit(1)
-        
+        # Convert to object for dot notation access
+        self.config = self._to_object(self.data)
+
+    def reload(self):
+        """
+        Reads the file again. Returns the merged data, the new configuration
+        and the paths of the settings that changed against the configuration
+        in effect, an invalid file raises ConfigError. The new configuration
+        is in effect once it was applied and passed to commit().
+        """
+        data = self._read()
+        return data, self._to_object(data), diff_config(self.data, data)
+
+    def commit(self, data):
+        self.data = data
+        self.config = self._to_object(data)
+
+    def changed_on_disk(self):
+        return self._stat() != self.stat
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.config_file)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _read(self):
+        if not os.path.exists(self.config_file):
+            raise ConfigError(f"Config file not found: {self.config_file}")
+
         if not os.path.exists(self.schema_file):
-            print(f"Schema file not found: {self.schema_file}")
-            sys.exit(1)
+            raise ConfigError(f"Schema file not found: {self.schema_file}")
 
+        # A broken file is not read again until it changes
+        self.stat = self._stat()
         try:
-            with open(self.config_file, 'r') as f:
-                config_data = json.load(f)
-            
-            with open(self.schema_file, 'r') as f:
-                schema_data = json.load(f)
-            
-            # Validate against schema
-            jsonschema.validate(instance=config_data, schema=schema_data)
-            
-            # Merge with defaults
-            full_config = self._merge_defaults(config_data)
-            
-            # Convert to object for dot notation access
-            self.config = self._to_object(full_config)
-            
+            with open(self.config_file, 'rb') as f:
+                config_bytes = f.read()
+            config_data = json.loads(config_bytes)
+
+            with open(self.schema_file, 'rb') as f:
+                schema_bytes = f.read()
+
+            # Importing jsonschema alone takes seconds on a Pi Zero, an
+            # unchanged config is not validated again
+            digest = hashlib.sha256(config_bytes + b'\0' + schema_bytes).hexdigest()
+            if digest != self._validated_digest():
+                self._validate(config_data, schema_bytes)
+                self._store_validated_digest(digest)
+        except ConfigError:
+            raise
         except json.JSONDecodeError as e:
-            print(f"Error decoding JSON: {e}")
-            sys.exit(1)
-        except jsonschema.ValidationError as e:
-            print(f"Configuration validation failed: {e.message}")
-            sys.exit(1)
+            raise ConfigError(f"Error decoding JSON: {e}")
         except Exception as e:
-            print(f"Error loading configuration: {e}")
-            sys.exit(1)
+            raise ConfigError(f"Error loading configuration: {e}")
+
+        # Merge with defaults
+        return self._merge_defaults(config_data)
+
+    def _validate(self, config_data, schema_bytes):
+        try:
+            import jsonschema
+        except ImportError:
+            raise ConfigError("Error: jsonschema module not found. Please install it with 'pip install jsonschema'")
+
+        if self.validator is None:
+            schema_data = json.loads(schema_bytes)
+            # Built once, a reload only validates
+            self.validator = jsonschema.validators.validator_for(schema_data)(schema_data)
+        try:
+            self.validator.validate(config_data)
+        except jsonschema.ValidationError as e:
+            raise ConfigError(f"Configuration validation failed: {e.message}")
+
+    def _validated_digest(self):
+        try:
+            with open(self.validated_file) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def _store_validated_digest(self, digest):
+        try:
+            with open(self.validated_file, 'w') as f:
+                f.write(digest)
+        except OSError:
+            # Read-only installation, validated again next time
+            pass
 
     def _merge_defaults(self, config):
         # Defaults based on schema.json descriptions
         defaults = {
-            "mbus": {"port": "/dev/ttyS0", "baudRate": 2400},
+            "mbus": {
+                "port": "/dev/ttyS0",
+                "baudRate": 2400,
+                "decoder": "native",
+                "replay": {"file": "", "speed": 1, "loop": False},
+                "record": {"file": ""},
+                "watchdog": {"enabled": True, "factor": 2, "minTimeout": 5, "initialTimeout": 30, "maxBackoff": 60}
+            },
             "logging": {
-                "console": {"enabled": True, "format": "raw", "level": "INFO"},
+                "console": {"enabled": True, "format": "raw", "level": "INFO", "valueTable": {"everyFrames": 1, "interval": 0}},
                 "file": {"enabled": False, "format": "json", "path": "", "level": "INFO"},
                 "loki": {"enabled": False, "url": "", "level": "INFO"}
             },
@@ -67,7 +155,11 @@ class ConfigHandler:
                 "brokerPort": 1883,
                 "authentication": {"isAuthenticated": False, "username": "", "password": ""},
                 "mqttApiVersion": 1,
-                "mqttPrefix": "smartmeter"
+                "mqttPrefix": "smartmeter",
+                "pipelined": True,
+                "inflightWindow": 20,
+                "jsonTopic": "",
+                "stream": "raw"
             },
             "influxdb": {
                 "enabled": False,
@@ -77,13 +169,71 @@ class ConfigHandler:
                 "organization": "smartmeter",
                 "version": 2,
                 "sendMetrics": False,
-                "sendValues": True
+                "sendValues": True,
+                "spool": {
+                    "enabled": False,
+                    "path": "influx_spool.db",
+                    "maxPoints": 500000,
+                    "batchSize": 5000,
+                    "evictionPolicy": "drop_oldest"
+                },
+                "stream": "raw"
             },
             "prometheus": {
                 "enabled": False,
                 "port": 8000,
                 "exposeMetrics": True,
-                "exposeValues": False
+                "exposeValues": False,
+                "stream": "raw"
+            },
+            "pipeline": {
+                "queueSize": 10,
+                "overflowPolicy": "drop_oldest"
+            },
+            "metrics": {
+                "stageTimings": True
+            },
+            "aggregation": {
+                "windows": {"1m": 60, "15m": 900, "1h": 3600}
+            },
+            "deadband": {
+                "enabled": False,
+                "heartbeat": 300,
+                "rules": {}
+            },
+            "timeseries": {
+                "enabled": False,
+                "capacity": 86400,
+                "host": "0.0.0.0",
+                "port": 8001
+            },
+            "energy": {
+                "enabled": False,
+                "stateFile": "energy_state.json",
+                "checkpointInterval": 300,
+                "publishInterval": 60,
+                "tariffs": {}
+            },
+            "archive": {
+                "enabled": False,
+                "directory": "archive",
+                "rotation": "daily",
+                "format": "auto",
+                "batchSize": 3600,
+                "flushInterval": 3600,
+                "retentionDays": 730,
+                "maxSizeMB": 2048,
+                "rawFrames": False,
+                "queueSize": 100,
+                "overflowPolicy": "block"
+            },
+            "meters": [],
+            "gateway": {
+                "decodeWorkers": -1
+            },
+            "reload": {
+                "watchFile": False,
+                "interval": 5
             }
         }
         return self._deep_merge(defaults, config)
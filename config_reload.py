@@ -0,0 +1,53 @@
+import signal
+import logging
+import threading
+from config_handler import ConfigError
+
+logger = logging.getLogger(__name__)
+
+class ConfigReloader(threading.Thread):
+    """
+    Reloads config.json on SIGHUP (systemctl reload) and, with a
+    watch_interval, when the file changed on disk. apply(config, changed)
+    gets the new configuration and the paths of the changed settings. An
+    invalid file or a failing apply is logged and the running configuration
+    stays, the next reload is compared against it.
+    """
+
+    def __init__(self, config_handler, apply, watch_interval=0):
+        super().__init__(name="config-reload", daemon=True)
+        self.config_handler = config_handler
+        self.apply = apply
+        self.watch_interval = watch_interval
+        self.requested = threading.Event()
+
+    def start(self):
+        # Signal handlers can only be installed from the main thread
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.requested.set())
+        super().start()
+
+    def run(self):
+        while True:
+            requested = self.requested.wait(self.watch_interval or None)
+            self.requested.clear()
+            if requested or self.config_handler.changed_on_disk():
+                self.reload()
+
+    def reload(self):
+        try:
+            data, config, changed = self.config_handler.reload()
+        except ConfigError as e:
+            logger.error(f"Neue Konfiguration ungültig, die laufende bleibt aktiv: {e}")
+            return
+        if not changed:
+            logger.info("Konfiguration neu geladen, keine Änderungen")
+            return
+
+        logger.info(f"Konfiguration neu geladen, geändert: {', '.join(changed)}")
+        try:
+            self.apply(config, changed)
+        except Exception as e:
+            logger.error(f"Neue Konfiguration konnte nicht übernommen werden: {e}")
+            return
+        self.config_handler.commit(data)
@@ -0,0 +1,70 @@
+import logging
+from power_values import REGISTERS, find_register, P_INDEX, N_INDEX
+
+logger = logging.getLogger(__name__)
+
+class DeadbandFilter:
+    """
+    Decides per register whether a value is worth sending. A value goes out
+    when it moved further than the deadband of its register since it was
+    last sent, or when it was not sent for heartbeat seconds (0 disables the
+    heartbeat). Registers without a rule are sent on every change.
+
+    rules maps an OBIS code (hex or dotted) or short name to
+    {"absolute": <same unit as the value>} and/or {"relative": <fraction of
+    the last sent value>}; exceeding either threshold sends the value.
+
+    Every sink needs its own filter, as it remembers what that sink sent,
+    separately per meter.
+    """
+
+    def __init__(self, rules=None, heartbeat=300):
+        self.heartbeat = heartbeat
+        self.absolute = [None] * len(REGISTERS)
+        self.relative = [None] * len(REGISTERS)
+        for key, rule in (rules or {}).items():
+            index = find_register(key)
+            if index is None:
+                logger.warning(f"Deadband rule for unknown register {key} ignored")
+                continue
+            if 'absolute' in rule:
+                self.absolute[index] = float(rule['absolute'])
+            if 'relative' in rule:
+                self.relative[index] = float(rule['relative'])
+
+        # meter -> (last sent values, time they were sent)
+        self.sent = {}
+
+    def filter(self, snapshot):
+        """
+        Returns one flag per register, True for the values to send, and
+        remembers those as sent. A last flag for Wirkleistunggesamt follows
+        its two source registers.
+        """
+        sent = self.sent.get(snapshot.meter)
+        if sent is None:
+            sent = self.sent[snapshot.meter] = ([None] * len(REGISTERS), [0.0] * len(REGISTERS))
+        last_values, last_times = sent
+
+        now = snapshot.timestamp
+        mask = []
+        for i, value in enumerate(snapshot.display):
+            last = last_values[i]
+            if last is None or (self.heartbeat and now - last_times[i] >= self.heartbeat):
+                send = True
+            else:
+                send = abs(value - last) > self._threshold(i, last)
+            if send:
+                last_values[i] = value
+                last_times[i] = now
+            mask.append(send)
+        mask.append(mask[P_INDEX] or mask[N_INDEX])
+        return mask
+
+    def _threshold(self, index, last):
+        absolute = self.absolute[index]
+        relative = self.relative[index]
+        if relative is not None:
+            relative *= abs(last)
+            return relative if absolute is None else min(absolute, relative)
+        return 0.0 if absolute is None else absolute
@@ -0,0 +1,106 @@
+import logging
+from power_values import OBIS_BYTES_INDEX
+
+logger = logging.getLogger(__name__)
+
+DATA_NOTIFICATION = 0x0F
+
+# A-XDR data type tags (DLMS Blue Book, IEC 62056-6-2)
+ARRAY = 0x01
+STRUCTURE = 0x02
+BIT_STRING = 0x04
+OCTET_STRING = 0x09
+VISIBLE_STRING = 0x0A
+UTF8_STRING = 0x0C
+
+# Tags with a fixed payload size in bytes
+FIXED_SIZES = {
+    0x00: 0,   # null-data
+    0x03: 1,   # boolean
+    0x05: 4,   # double-long
+    0x06: 4,   # double-long-unsigned
+    0x0F: 1,   # integer
+    0x10: 2,   # long
+    0x11: 1,   # unsigned
+    0x12: 2,   # long-unsigned
+    0x14: 8,   # long64
+    0x15: 8,   # long64-unsigned
+    0x16: 1,   # enum
+    0x17: 4,   # float32
+    0x18: 8,   # float64
+    0x19: 12,  # date-time
+    0x1A: 5,   # date
+    0x1B: 4,   # time
+}
+
+INTEGER_TAGS = {0x05, 0x06, 0x0F, 0x10, 0x11, 0x12, 0x14, 0x15, 0x16}
+SIGNED_TAGS = {0x05, 0x0F, 0x10, 0x14}
+
+OBIS_LENGTH = 6
+
+
+class DLMSDecoder:
+    """
+    Decodes the Data-Notification APDU sent by the T210-D directly from its
+    A-XDR encoding, without the XML round-trip through GXDLMSTranslator.
+
+    The notification body is walked as a flat sequence of data elements (the
+    same order GXDLMSTranslator emits them as XML). Whenever an octet-string
+    holding a known OBIS code is immediately followed by an integer, that
+    integer is written to PowerValues.
+    """
+
+    def decode(self, apdu, power_values):
+        if not apdu or apdu[0] != DATA_NOTIFICATION:
+            raise ValueError("APDU is not a Data-Notification")
+
+        # tag + long-invoke-id-and-priority, then the optional date-time octet-string
+        pos = 5
+        pos += 1 + apdu[pos]
+
+        end = len(apdu)
+        register = None
+        while pos < end:
+            tag = apdu[pos]
+            pos += 1
+
+            if tag == ARRAY or tag == STRUCTURE:
+                # Element count only, the elements follow inline
+                _, pos = self._read_length(apdu, pos)
+                register = None
+                continue
+
+            if tag in FIXED_SIZES:
+                size = FIXED_SIZES[tag]
+            elif tag in (OCTET_STRING, VISIBLE_STRING, UTF8_STRING):
+                size, pos = self._read_length(apdu, pos)
+            elif tag == BIT_STRING:
+                bits, pos = self._read_length(apdu, pos)
+                size = (bits + 7) // 8
+            else:
+                logger.debug(f"Unsupported A-XDR tag 0x{tag:02X} at offset {pos - 1}, stopping")
+                return
+
+            if pos + size > end:
+                # Truncated notification, keep what was decoded so far
+                return
+
+            if register is not None and tag in INTEGER_TAGS:
+                power_values.set_raw(register, int.from_bytes(apdu[pos:pos + size], 'big', signed=tag in SIGNED_TAGS))
+                register = None
+            elif tag == OCTET_STRING and size == OBIS_LENGTH:
+                register = OBIS_BYTES_INDEX.get(bytes(apdu[pos:pos + size]))
+            else:
+                register = None
+
+            pos += size
+
+    @staticmethod
+    def _read_length(apdu, pos):
+        length = apdu[pos]
+        pos += 1
+        if length & 0x80:
+            count = length & 0x7F
+            length = int.from_bytes(apdu[pos:pos + count], 'big')
+            pos += count
+        return length, pos
@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from power_values import REGISTERS, SHORT_INDEX
+
+logger = logging.getLogger(__name__)
+
+IMPORT_INDEX = SHORT_INDEX['WirkenergieP']
+EXPORT_INDEX = SHORT_INDEX['WirkenergieN']
+# kWh per raw counter unit (Wh)
+COUNTER_FACTOR = REGISTERS[IMPORT_INDEX].factor
+
+STATE_VERSION = 1
+
+class EnergyTotals:
+    """
+    Import and export (kWh) of one meter within the current periods, e.g.
+    ('tag', '2026-10-18', 3.2, 0.4). Sent to the sinks like a snapshot.
+    """
+
+    __slots__ = ('meter', 'timestamp', 'periods')
+
+    def __init__(self, meter, timestamp, periods):
+        set_attr = object.__setattr__
+        set_attr(self, 'meter', meter)
+        set_attr(self, 'timestamp', timestamp)
+        set_attr(self, 'periods', tuple(periods))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("EnergyTotals is immutable")
+
+class TariffWindow:
+    """
+    Daily time window such as 22:00-06:00. A window reaching past midnight
+    belongs to the day it started on.
+    """
+
+    def __init__(self, name, start, end):
+        self.name = name
+        self.start = self._minutes(start)
+        self.end = self._minutes(end)
+        if self.start == self.end:
+            raise ValueError(f"Tariff {name} has no length")
+
+    @staticmethod
+    def _minutes(value):
+        hours, minutes = value.split(':')
+        return int(hours) * 60 + int(minutes)
+
+    def period(self, local):
+        """
+        Key of the window instance local (datetime) falls into, else None.
+        """
+        minute = local.hour * 60 + local.minute
+        if self.start < self.end:
+            return local.date().isoformat() if self.start <= minute < self.end else None
+        if minute >= self.start:
+            return local.date().isoformat()
+        if minute < self.end:
+            return (local.date() - timedelta(days=1)).isoformat()
+        return None
+
+class EnergyCounters:
+    """
+    Import/export per day, month and tariff window of every meter, derived
+    from the energy counter registers.
+
+    Day and month keep the counter readings at the start of the period as
+    baseline, a tariff adds up the counter increase between frames inside
+    its window. Energy between the last frame of a period and the first of
+    the next one goes to the new period, like in WindowAggregator.
+
+    The state is checkpointed every checkpoint_interval seconds (and on
+    exit) to path and restored on startup, so a restart does not lose the
+    running periods. Energy consumed while the process was down is counted
+    once the next frame arrives, into the period current at that time.
+    """
+
+    def __init__(self, path, tariffs=None, checkpoint_interval=300, publish_interval=60):
+        self.path = path
+        self.tariffs = [TariffWindow(name, window['start'], window['end']) for name, window in (tariffs or {}).items()]
+        for tariff in self.tariffs:
+            if tariff.name in ('tag', 'monat'):
+                raise ValueError(f"Tariff name {tariff.name} is reserved")
+        self.checkpoint_interval = checkpoint_interval
+        self.publish_interval = publish_interval
+        self.lock = threading.Lock()
+        self.meters = self._load()
+        self.checkpointed = time.monotonic()
+        self.dirty = False
+        self.published = {}
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            if state.get('version') != STATE_VERSION:
+                raise ValueError(f"unknown version {state.get('version')}")
+            logger.info(f"Energiezähler aus {self.path} geladen")
+            return state['meters']
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Energiezähler-Datei {self.path} kann nicht gelesen werden, starte neu: {e}")
+            return {}
+
+    def checkpoint(self):
+        """
+        Writes the state atomically, a crash never leaves a broken file behind.
+        """
+        if not self.path:
+            return
+        with self.lock:
+            if not self.dirty:
+                return
+            state = json.dumps({'version': STATE_VERSION, 'meters': self.meters})
+            self.dirty = False
+            self.checkpointed = time.monotonic()
+        temp = f"{self.path}.tmp"
+        try:
+            with open(temp, 'w') as f:
+                f.write(state)
+            os.replace(temp, self.path)
+        except OSError as e:
+            logger.error(f"Energiezähler können nicht gespeichert werden: {e}")
+
+    def _period_keys(self, local):
+        keys = {'tag': local.date().isoformat(), 'monat': local.strftime('%Y-%m')}
+        for tariff in self.tariffs:
+            keys[tariff.name] = tariff.period(local)
+        return keys
+
+    @staticmethod
+    def _ended(period, key):
+        if 'baseline' in period:
+            return period['key'] != key
+        # A tariff ends with the first frame outside of its window
+        return period['open'] and period['key'] != key
+
+    def _totals(self, meter, state, timestamp):
+        last = state['last']
+        periods = []
+        for name, period in state['periods'].items():
+            if 'baseline' in period:
+                consumed = (last[0] - period['baseline'][0], last[1] - period['baseline'][1])
+            else:
+                consumed = period['total']
+            periods.append((name, period['key'], consumed[0] * COUNTER_FACTOR, consumed[1] * COUNTER_FACTOR))
+        return EnergyTotals(meter, timestamp, periods)
+
+    def update(self, snapshot):
+        """
+        Accounts the counter readings of snapshot. Returns the EnergyTotals
+        to publish: the final totals of every period that just ended and the
+        current ones every publish_interval seconds.
+        """
+        reading = [snapshot.raw[IMPORT_INDEX], snapshot.raw[EXPORT_INDEX]]
+        keys = self._period_keys(datetime.fromtimestamp(snapshot.timestamp))
+        meter = snapshot.meter
+        published = []
+
+        with self.lock:
+            state = self.meters.get(meter)
+            if state is None:
+                state = self.meters[meter] = {'last': reading, 'timestamp': snapshot.timestamp, 'periods': {}}
+            last = state['last']
+            if reading[0] < last[0] or reading[1] < last[1]:
+                # Meter replaced or counter reset, start over from the new readings
+                logger.warning(f"Energiezähler von Zähler {meter or '-'} gesunken, Perioden beginnen neu")
+                state['periods'] = {}
+                last = state['last'] = reading
+
+            periods = state['periods']
+            for name in [name for name in periods if name not in keys]:
+                # Tariff no longer configured
+                del periods[name]
+            ended = [name for name, period in periods.items() if self._ended(period, keys[name])]
+            if ended:
+                published.append(self._totals(meter, state, state['timestamp']))
+
+            for name, key in keys.items():
+                period = periods.get(name)
+                if name in ('tag', 'monat'):
+                    if period is None or period['key'] != key:
+                        periods[name] = {'key': key, 'baseline': list(last)}
+                elif key is None:
+                    # Outside of the tariff window the last totals stay until the next one starts
+                    if period:
+                        period['open'] = False
+                elif period is None or period['key'] != key:
+                    periods[name] = {'key': key, 'open': True, 'total': [reading[0] - last[0], reading[1] - last[1]]}
+                else:
+                    period['total'] = [period['total'][0] + reading[0] - last[0], period['total'][1] + reading[1] - last[1]]
+
+            state['last'] = reading
+            state['timestamp'] = snapshot.timestamp
+            self.dirty = True
+
+            now = time.monotonic()
+            previous = self.published.get(meter)
+            if ended or previous is None or now - previous >= self.publish_interval:
+                self.published[meter] = now
+                published.append(self._totals(meter, state, snapshot.timestamp))
+            checkpoint_due = now - self.checkpointed >= self.checkpoint_interval
+
+        if checkpoint_due:
+            self.checkpoint()
+        return published
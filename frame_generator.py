@@ -0,0 +1,304 @@
+"""
+Synthetic T210-D telegrams for load tests and fuzzing.
+
+Register values are encoded into the same Data-Notification APDU the meter
+sends, encrypted under a test key (security control 0x20, AES-GCM without
+tag like the customer interface) and wrapped into the two M-Bus long
+frames SerialReader reads. With the values, date-time, system title and
+frame counter of the EVN documentation the sample telegram is reproduced
+byte for byte.
+
+    python3 frame_generator.py --count 100000 --out frames.smfr [--key HEX] [--rate 1] [--seed 1] [--verify] [--differential]
+    python3 frame_generator.py --count 100000 --raw --out frames.bin
+
+The .smfr output is a FrameRecorder file and can be played back through the
+whole pipeline with mbus.replay (speed 0: as fast as possible), --raw
+writes the plain M-Bus byte stream. --differential decodes the sample
+telegram and every generated one with the native decoder and with Gurux
+and fails if they disagree.
+"""
+import time
+import random
+import logging
+import argparse
+from binascii import unhexlify
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from power_values import REGISTERS, SHORT_INDEX
+from telegram import GENERAL_GLO_CIPHERING, TelegramCipher
+
+logger = logging.getLogger(__name__)
+
+TEST_KEY = "000102030405060708090A0B0C0D0E0F"
+SYSTEM_TITLE = bytes.fromhex("4B464D6750000009")
+METER_NUMBER = b"181220000009"
+TIMEZONE = ZoneInfo("Europe/Vienna")
+
+SECURITY_ENCRYPTED = 0x20
+
+# M-Bus header fields of the T210-D frames
+MBUS_CONTROL = 0x53
+MBUS_ADDRESS = 0xFF
+MBUS_STSAP = 0x01
+MBUS_DTSAP = 0x67
+# DLMS bytes per frame, the meter splits the telegram after 245 bytes
+SEGMENT_SIZE = 245
+
+# A-XDR encoding per register: (type tag, size, scaler, unit) as sent by the meter
+REGISTER_ENCODING = {
+    'WirkenergieP': (0x06, 4, 0, 0x1E),
+    'WirkenergieN': (0x06, 4, 0, 0x1E),
+    'MomentanleistungP': (0x06, 4, 0, 0x1B),
+    'MomentanleistungN': (0x06, 4, 0, 0x1B),
+    'SpannungL1': (0x12, 2, -1, 0x23),
+    'SpannungL2': (0x12, 2, -1, 0x23),
+    'SpannungL3': (0x12, 2, -1, 0x23),
+    'StromL1': (0x12, 2, -2, 0x21),
+    'StromL2': (0x12, 2, -2, 0x21),
+    'StromL3': (0x12, 2, -2, 0x21),
+    'Leistungsfaktor': (0x12, 2, -3, 0xFF),
+}
+
+def encode_datetime(timestamp, tz=TIMEZONE):
+    """
+    DLMS date-time (12 bytes) in local time of tz with deviation and the
+    daylight saving status bit.
+    """
+    local = datetime.fromtimestamp(timestamp, tz)
+    deviation = -int(local.utcoffset().total_seconds() // 60)
+    status = 0x80 if local.dst() else 0x00
+    return b''.join((
+        local.year.to_bytes(2, 'big'),
+        bytes((local.month, local.day, local.isoweekday(), local.hour, local.minute, local.second, local.microsecond // 10000)),
+        deviation.to_bytes(2, 'big', signed=True),
+        bytes((status,)),
+    ))
+
+def encode_notification(raw, timestamp, invoke_id, meter_number=METER_NUMBER):
+    """
+    Data-Notification APDU with the raw values in the order of REGISTERS.
+    """
+    date_time = encode_datetime(timestamp)
+    parts = [
+        b'\x0f', (invoke_id | 0x80000000).to_bytes(4, 'big'),
+        b'\x0c', date_time,
+        # Structure: date-time, (OBIS, value, scaler-unit) per register, meter number
+        bytes((0x02, 2 + 3 * len(REGISTERS))),
+        b'\x09\x0c', date_time,
+    ]
+    for register, value in zip(REGISTERS, raw):
+        tag, size, scaler, unit = REGISTER_ENCODING[register.short]
+        parts.append(b'\x09\x06' + bytes.fromhex(register.obis))
+        parts.append(bytes((tag,)) + int(value).to_bytes(size, 'big'))
+        parts.append(bytes((0x02, 0x02, 0x0F, scaler & 0xFF, 0x16, unit)))
+    parts.append(bytes((0x09, len(meter_number))) + meter_number)
+    return b''.join(parts)
+
+def encrypt_apdu(apdu, cipher, system_title, frame_counter):
+    """
+    general-glo-ciphering payload of apdu, encrypted without tag.
+    """
+    counter = frame_counter.to_bytes(4, 'big')
+    length = 5 + len(apdu)
+    return b''.join((
+        bytes((GENERAL_GLO_CIPHERING, len(system_title))), system_title,
+        b'\x81' + bytes((length,)) if length < 256 else b'\x82' + length.to_bytes(2, 'big'),
+        bytes((SECURITY_ENCRYPTED,)), counter,
+        cipher.encrypt(apdu, system_title, counter),
+    ))
+
+def mbus_frames(payload, segment_size=SEGMENT_SIZE):
+    """
+    Splits payload into M-Bus long frames, the CI field counts the segments
+    and marks the last one.
+    """
+    frames = []
+    segments = [payload[i:i + segment_size] for i in range(0, len(payload), segment_size)]
+    for sequence, segment in enumerate(segments):
+        ci = sequence | (0x10 if sequence == len(segments) - 1 else 0x00)
+        body = bytes((MBUS_CONTROL, MBUS_ADDRESS, ci, MBUS_STSAP, MBUS_DTSAP)) + segment
+        frames.append(bytes((0x68, len(body), len(body), 0x68)) + body + bytes((sum(body) & 0xFF, 0x16)))
+    return frames
+
+class ValueDrift:
+    """
+    Plausible consecutive meter readings: the net power walks randomly
+    between import and feed-in, the energy counters integrate it, voltages
+    wander around 230 V and the currents follow power and voltage.
+    """
+
+    def __init__(self, seed=None, energy_in=12_000_000, energy_out=3_000_000):
+        self.random = random.Random(seed)
+        self.power = 500.0
+        self.voltages = [2300, 2305, 2295]
+        self.energy = [float(energy_in), float(energy_out)]
+
+    def step(self, seconds=1.0):
+        """
+        Returns the raw values (order of REGISTERS) seconds after the last step.
+        """
+        rnd = self.random
+        self.power = min(15000.0, max(-8000.0, self.power + rnd.gauss(0, 150)))
+        power_in = max(0, round(self.power))
+        power_out = max(0, round(-self.power))
+        self.energy[0] += power_in * seconds / 3600
+        self.energy[1] += power_out * seconds / 3600
+        self.voltages = [min(2530, max(2070, v + rnd.randint(-3, 3))) for v in self.voltages]
+        phase_power = (power_in + power_out) / 3
+        currents = [round(phase_power / (v / 10) * 100) for v in self.voltages]
+        power_factor = rnd.randint(900, 1000) if power_in or power_out else 1000
+
+        raw = [0] * len(REGISTERS)
+        raw[SHORT_INDEX['WirkenergieP']] = int(self.energy[0])
+        raw[SHORT_INDEX['WirkenergieN']] = int(self.energy[1])
+        raw[SHORT_INDEX['MomentanleistungP']] = power_in
+        raw[SHORT_INDEX['MomentanleistungN']] = power_out
+        for name, value in zip(('SpannungL1', 'SpannungL2', 'SpannungL3'), self.voltages):
+            raw[SHORT_INDEX[name]] = value
+        for name, value in zip(('StromL1', 'StromL2', 'StromL3'), currents):
+            raw[SHORT_INDEX[name]] = value
+        raw[SHORT_INDEX['Leistungsfaktor']] = power_factor
+        return raw
+
+class FrameGenerator:
+    """
+    Encrypted telegrams (the M-Bus frames of one notification each) with
+    drifting values, one frame counter and invoke id step per telegram.
+    """
+
+    def __init__(self, key=TEST_KEY, system_title=SYSTEM_TITLE, frame_counter=1, seed=None):
+        self.cipher = TelegramCipher(unhexlify(key))
+        self.system_title = system_title
+        self.frame_counter = frame_counter
+        self.drift = ValueDrift(seed)
+
+    def telegram(self, raw, timestamp):
+        apdu = encode_notification(raw, timestamp, self.frame_counter)
+        payload = encrypt_apdu(apdu, self.cipher, self.system_title, self.frame_counter)
+        self.frame_counter += 1
+        return mbus_frames(payload)
+
+    def generate(self, count, start=None, interval=1.0):
+        """
+        Yields (timestamp, raw values, frames) for count telegrams.
+        """
+        timestamp = time.time() if start is None else start
+        for _ in range(count):
+            raw = self.drift.step(interval)
+            yield timestamp, raw, self.telegram(raw, timestamp)
+            timestamp += interval
+
+def telegram_payloads(telegrams):
+    """
+    Yields the assembled payload of every telegram, each a list of the bytes
+    of its M-Bus frames.
+    """
+    from mbus_framer import MBusFramer, SegmentAssembler
+
+    framer = MBusFramer()
+    assembler = SegmentAssembler()
+    for frames in telegrams:
+        payload = None
+        for data in frames:
+            framer.feed(data)
+            while (frame := framer.next_frame()) is not None:
+                payload = assembler.add(frame)
+        yield payload
+
+def verify(key, telegrams):
+    """
+    Decodes the generated telegrams like SerialReader does and returns the
+    number of telegrams whose values differ from the encoded ones.
+    """
+    from gateway import decode_telegram
+
+    mismatches = 0
+    for (raw, _), payload in zip(telegrams, telegram_payloads(frames for _, frames in telegrams)):
+        result = decode_telegram(key, payload)
+        if result is None or result[0] != raw:
+            mismatches += 1
+    return mismatches
+
+def differential(key, telegrams):
+    """
+    Decodes the sample telegram of the EVN documentation and the generated
+    telegrams with the native decoder and with Gurux (SerialReader with
+    decoder 'gurux') and returns the number of telegrams on which the two
+    disagree.
+    """
+    from gurux_dlms.GXDLMSTranslator import GXDLMSTranslator
+    from benchmark import SAMPLE_KEY, SAMPLE_TELEGRAM
+    from dlms_decoder import DLMSDecoder
+    from power_values import PowerValues
+    from serial_reader import SerialReader
+    from telegram import split_ciphered_apdu
+
+    translator = GXDLMSTranslator()
+    decoder = DLMSDecoder()
+    keys = [SAMPLE_KEY] + [key] * len(telegrams)
+    ciphers = {}
+    mismatches = 0
+    for telegram_key, payload in zip(keys, telegram_payloads([[SAMPLE_TELEGRAM]] + [frames for _, frames in telegrams])):
+        cipher = ciphers.setdefault(telegram_key, TelegramCipher(unhexlify(telegram_key)))
+        system_title, frame_counter, frame = split_ciphered_apdu(payload)
+        apdu = cipher.decrypt(frame, system_title, frame_counter)
+        native = PowerValues()
+        gurux = PowerValues()
+        decoder.decode(apdu, native)
+        SerialReader._parse_xml(translator.pduToXml(apdu), gurux)
+        if native.raw != gurux.raw:
+            mismatches += 1
+            logger.warning(f"Frame counter {int.from_bytes(frame_counter, 'big')}: native {native.raw}, gurux {gurux.raw}")
+    return mismatches
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic T210-D telegram generator")
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--key", default=TEST_KEY, help=f"AES key in hex (default: {TEST_KEY})")
+    parser.add_argument("--system-title", default=SYSTEM_TITLE.hex().upper())
+    parser.add_argument("--frame-counter", type=int, default=1)
+    parser.add_argument("--rate", type=float, default=1.0, help="telegrams per second of recorded time")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--raw", action="store_true", help="write the plain M-Bus byte stream instead of a recording")
+    parser.add_argument("--verify", action="store_true", help="decode every telegram again and compare the values")
+    parser.add_argument("--differential", action="store_true", help="compare the native decoder with Gurux on the sample and every generated telegram")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    generator = FrameGenerator(args.key, bytes.fromhex(args.system_title), args.frame_counter, args.seed)
+    checked = []
+    start = time.perf_counter()
+    if args.raw:
+        with open(args.out, 'wb') as f:
+            for _, raw, frames in generator.generate(args.count, interval=1 / args.rate):
+                f.write(b''.join(frames))
+                if args.verify or args.differential:
+                    checked.append((raw, frames))
+    else:
+        from frame_recorder import FrameRecorder
+        # FrameRecorder appends, a generated recording always starts empty
+        open(args.out, 'wb').close()
+        recorder = FrameRecorder(args.out)
+        for timestamp, raw, frames in generator.generate(args.count, interval=1 / args.rate):
+            for frame in frames:
+                recorder.record(frame, timestamp)
+            if args.verify or args.differential:
+                checked.append((raw, frames))
+        recorder.close()
+    elapsed = time.perf_counter() - start
+    logger.info(f"{args.count} telegrams written to {args.out} ({args.count / elapsed:,.0f} telegrams/sec)")
+
+    if args.verify:
+        mismatches = verify(args.key, checked)
+        logger.info(f"Verified {len(checked)} telegrams, {mismatches} mismatches")
+        if mismatches:
+            raise SystemExit(1)
+    if args.differential:
+        mismatches = differential(args.key, checked)
+        logger.info(f"Native and Gurux decoder compared on {len(checked) + 1} telegrams, {mismatches} mismatches")
+        if mismatches:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
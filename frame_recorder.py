@@ -0,0 +1,148 @@
+import os
+import time
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+
+# File layout: MAGIC, then per frame a RECORD header (receive time, length) and the raw M-Bus frame
+MAGIC = b'SMFR\x01'
+RECORD = struct.Struct('<dH')
+
+class ReplayFinished(EOFError):
+    """Raised by ReplaySerial when the recording is exhausted."""
+
+class FrameRecorder:
+    """
+    Appends raw M-Bus frames with their receive time to a compact binary file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'ab')
+        if new_file:
+            self.file.write(MAGIC)
+            self.file.flush()
+        logger.info(f"Recording M-Bus frames to {path}")
+
+    def record(self, frame, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self.file.write(RECORD.pack(timestamp, len(frame)))
+        self.file.write(frame)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def read_recording(path):
+    """
+    Yields (receive time, frame) of a file written by FrameRecorder.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a frame recording")
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, length = RECORD.unpack(header)
+            frame = f.read(length)
+            if len(frame) < length:
+                return
+            yield timestamp, frame
+
+class ReplaySerial:
+    """
+    Stand-in for serial.Serial that plays back a FrameRecorder file, so the
+    whole read/decrypt/decode/sink pipeline runs without a meter.
+
+    speed 1 replays in real time, N at N times the original pace and 0 as
+    fast as possible. With loop the recording starts over at the end,
+    otherwise ReplayFinished is raised.
+
+    close() and open() (a reconnect of SerialReader) pause the replay, it
+    resumes with the next frame. receive_time is the recorded receive time
+    of the last frame read, shifted by the length of the recording on
+    every loop so it keeps increasing.
+    """
+
+    def __init__(self, path, speed=1.0, loop=False):
+        self.path = path
+        self.speed = float(speed)
+        self.loop = loop
+        self.buffer = bytearray()
+        self.records = None
+        self.receive_time = None
+        self.offset = 0.0
+        self.closed_at = None
+        self.is_open = False
+        self.open()
+
+    def open(self):
+        if self.records is None:
+            self._rewind()
+            logger.info(f"Replaying M-Bus frames from {self.path} (speed {self.speed:g})")
+        elif self.closed_at is not None:
+            # The pause does not count towards the pace
+            self.start += time.monotonic() - self.closed_at
+        self.closed_at = None
+        self.is_open = True
+
+    def close(self):
+        if self.is_open:
+            self.closed_at = time.monotonic()
+        self.is_open = False
+
+    def flushOutput(self):
+        pass
+
+    @property
+    def in_waiting(self):
+        return len(self.buffer)
+
+    def read(self, size=1):
+        while not self.buffer:
+            self._load_next()
+        chunk = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return chunk
+
+    def _rewind(self):
+        if self.records is not None:
+            self.records.close()
+            if self.frames:
+                # One mean frame interval between the passes
+                duration = self.last_timestamp - self.first_timestamp
+                self.offset += duration + (duration / (self.frames - 1) if self.frames > 1 else 1.0)
+        self.records = read_recording(self.path)
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self.frames = 0
+        self.start = time.monotonic()
+
+    def _load_next(self):
+        record = next(self.records, None)
+        if record is None:
+            if not self.loop:
+                raise ReplayFinished(f"Replay of {self.path} finished")
+            self._rewind()
+            record = next(self.records, None)
+            if record is None:
+                raise ReplayFinished(f"{self.path} contains no frames")
+
+        timestamp, frame = record
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+        self.last_timestamp = timestamp
+        self.frames += 1
+
+        if self.speed > 0:
+            due = self.start + (timestamp - self.first_timestamp) / self.speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        self.receive_time = timestamp + self.offset
+        self.buffer += frame
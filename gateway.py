@@ -0,0 +1,409 @@
+"""
+Network ingestion of M-Bus byte streams, e.g. from ser2net style TCP/UDP
+adapters, for many meters in one process.
+
+Framing happens on the asyncio event loop, decryption and APDU decoding in
+a pool of worker processes. Every meter is pinned to one worker, so its
+telegrams are decoded in order and its cipher stays cached in that process.
+
+The stand-in streams a recording (or the sample telegram) over loopback,
+which is enough to test the ingestion without adapters:
+
+    python3 gateway.py standin --port 7000 [--file frames.smfr] [--interval 1]
+    python3 gateway.py standin --udp 127.0.0.1:7000 [--file frames.smfr] [--interval 1]
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+import multiprocessing
+from binascii import unhexlify
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from mbus_framer import MBusFramer, SegmentAssembler
+from telegram import GENERAL_GLO_CIPHERING, DATA_NOTIFICATION_HEADER, TelegramCipher, FrameCounterTracker, check_ciphered_apdu, split_ciphered_apdu
+from dlms_decoder import DLMSDecoder
+from power_values import PowerValues
+
+logger = logging.getLogger(__name__)
+
+GATEWAY_MODES = ('tcp-client', 'tcp-server', 'udp')
+
+# Telegrams waiting for decoding per meter
+QUEUE_SIZE = 100
+
+# Telegrams of one meter decoded per pool call, amortizes the IPC
+BATCH_SIZE = 64
+
+# Bytes handed to the framer at once, well below its buffer limit
+FEED_CHUNK = 1024
+
+RECONNECT_DELAY = 5
+
+# Per worker process: key -> (cipher, decoder)
+_decoders = {}
+
+def decode_telegram(key, payload):
+    """
+    Decrypts and decodes one complete telegram payload. Runs in a pool
+    process, returns (raw values, frame counter) or None if the payload is
+    no Data-Notification.
+    """
+    entry = _decoders.get(key)
+    if entry is None:
+        entry = _decoders[key] = (TelegramCipher(unhexlify(key)), DLMSDecoder())
+    cipher, decoder = entry
+
+    if payload[0] != GENERAL_GLO_CIPHERING:
+        return None
+    system_title, frame_counter, frame = split_ciphered_apdu(payload)
+    apdu = cipher.decrypt(frame, system_title, frame_counter)
+    if apdu[0:2] != DATA_NOTIFICATION_HEADER:
+        return None
+
+    pv = PowerValues()
+    decoder.decode(apdu, pv)
+    return pv.raw, int.from_bytes(frame_counter, 'big')
+
+def decode_telegrams(key, payloads):
+    """
+    Batch of decode_telegram, one result (or exception) per payload.
+    """
+    results = []
+    for payload in payloads:
+        try:
+            results.append(decode_telegram(key, payload))
+        except Exception as e:
+            results.append(e)
+    return results
+
+def pool_context():
+    """
+    Start method of the decode processes. The gateway runs in a thread next
+    to the readers and sinks, a forked child would inherit their locks in
+    whatever state they are, so the processes come from a fork server
+    (spawn where there is none) that only has this module imported.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([__name__])
+        return context
+    return multiprocessing.get_context('spawn')
+
+class DecodePool:
+    """
+    workers single-process executors, a meter always uses the same one.
+    With 0 workers telegrams are decoded on the event loop. A worker that
+    died is replaced and the batch decoded again.
+    """
+
+    def __init__(self, workers):
+        self.context = pool_context() if workers else None
+        self.executors = [self._executor() for _ in range(workers)]
+
+    def _executor(self):
+        return ProcessPoolExecutor(max_workers=1, mp_context=self.context)
+
+    async def decode(self, slot, key, payloads):
+        if not self.executors:
+            return decode_telegrams(key, payloads)
+        index = slot % len(self.executors)
+        executor = self.executors[index]
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, decode_telegrams, key, payloads)
+        except BrokenProcessPool:
+            # Meters sharing the slot see the same broken executor, replace it once
+            if self.executors[index] is executor:
+                logger.error(f"Decode worker {index} died, starting a new one")
+                executor.shutdown(wait=False)
+                self.executors[index] = self._executor()
+        return await asyncio.get_running_loop().run_in_executor(self.executors[index], decode_telegrams, key, payloads)
+
+    def shutdown(self):
+        for executor in self.executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+class TelegramStream:
+    """
+    Framer and segment assembler of one byte stream (a TCP connection or
+    the datagrams of one UDP sender).
+    """
+
+    def __init__(self):
+        self.framer = MBusFramer()
+        self.assembler = SegmentAssembler()
+
+    def feed(self, data):
+        """
+        Returns the complete telegram payloads contained in data.
+        """
+        payloads = []
+        for offset in range(0, len(data), FEED_CHUNK):
+            self.framer.feed(data[offset:offset + FEED_CHUNK])
+            while True:
+                frame = self.framer.next_frame()
+                if frame is None:
+                    break
+                payload = self.assembler.add(frame)
+                if payload is not None:
+                    payloads.append(payload)
+        return payloads
+
+class UDPReceiver(asyncio.DatagramProtocol):
+    def __init__(self, meter):
+        self.meter = meter
+        self.streams = {}
+
+    def datagram_received(self, data, addr):
+        stream = self.streams.get(addr)
+        if stream is None:
+            stream = self.streams[addr] = TelegramStream()
+        for payload in stream.feed(data):
+            self.meter.offer(payload)
+
+class GatewayMeter:
+    """
+    One meter reached over the network: its source and the queue of
+    telegrams waiting for the decode pool.
+
+    mode tcp-client connects to host:port (ser2net), tcp-server accepts
+    adapters connecting to host:port and udp receives datagrams on it.
+    track_frame_counter rejects telegrams whose frame counter is not above
+    the last one of their system title, like SerialReader.
+    """
+
+    def __init__(self, label, key, mode, host, port, track_frame_counter=True):
+        if mode not in GATEWAY_MODES:
+            raise ValueError(f"Unknown gateway mode: {mode}")
+        self.label = label
+        self.key = key
+        self.mode = mode
+        self.host = host
+        self.port = int(port)
+        self.queue = None
+        self.dropped = 0
+        self.frame_counters = FrameCounterTracker() if track_frame_counter else None
+
+    def offer(self, payload):
+        # Datagrams cannot be pushed back, drop when the decoder falls behind
+        try:
+            self.queue.put_nowait((payload, time.time()))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning(f"Meter {self.label}: decoder behind, telegram dropped")
+
+    async def read_stream(self, reader):
+        stream = TelegramStream()
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                return
+            for payload in stream.feed(data):
+                await self.queue.put((payload, time.time()))
+
+    async def run_source(self):
+        if self.mode == 'tcp-client':
+            while True:
+                try:
+                    reader, writer = await asyncio.open_connection(self.host, self.port)
+                    logger.info(f"Meter {self.label}: connected to {self.host}:{self.port}")
+                    await self.read_stream(reader)
+                    writer.close()
+                    logger.warning(f"Meter {self.label}: {self.host}:{self.port} closed the connection")
+                except OSError as e:
+                    logger.error(f"Meter {self.label}: connection to {self.host}:{self.port} failed: {e}")
+                await asyncio.sleep(RECONNECT_DELAY)
+
+        elif self.mode == 'tcp-server':
+            async def handle(reader, writer):
+                logger.info(f"Meter {self.label}: adapter {writer.get_extra_info('peername')} connected")
+                try:
+                    await self.read_stream(reader)
+                finally:
+                    writer.close()
+            server = await asyncio.start_server(handle, self.host, self.port)
+            logger.info(f"Meter {self.label}: listening on {self.host}:{self.port}")
+            async with server:
+                await server.serve_forever()
+
+        else:
+            await asyncio.get_running_loop().create_datagram_endpoint(lambda: UDPReceiver(self), local_addr=(self.host, self.port))
+            logger.info(f"Meter {self.label}: receiving UDP on {self.host}:{self.port}")
+            await asyncio.Future()
+
+class GatewayIngest:
+    """
+    Runs the sources of all gateway meters on one event loop in a thread of
+    its own and calls on_values(label, raw values, receive time, frame
+    counter, payload) for every decoded telegram, in order per meter.
+
+    By default one core is left to the event loop and the others decode, on
+    a single core machine telegrams are decoded on the event loop.
+    """
+
+    def __init__(self, meters, on_values, workers=None, metrics=None):
+        self.meters = meters
+        self.on_values = on_values
+        self.workers = max(0, (os.cpu_count() or 1) - 1) if workers is None else workers
+        self.metrics = metrics
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="gateway", daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        pool = DecodePool(self.workers)
+        try:
+            tasks = []
+            for slot, meter in enumerate(self.meters):
+                meter.queue = asyncio.Queue(QUEUE_SIZE)
+                tasks.append(asyncio.create_task(meter.run_source()))
+                tasks.append(asyncio.create_task(self.decode_loop(slot, meter, pool)))
+            await asyncio.gather(*tasks)
+        finally:
+            pool.shutdown()
+
+    def _reject(self, meter, reason):
+        if self.metrics:
+            self.metrics.count_frame_reject(reason)
+        logger.warning(f"Meter {meter.label}: telegram rejected ({reason}), skipping")
+
+    def _check(self, meter, payload):
+        """
+        The checks of SerialReader before decryption, returns the reject
+        reason or None. Runs on the event loop, a bad or replayed telegram
+        costs neither IPC nor AES.
+        """
+        if payload[0] != GENERAL_GLO_CIPHERING:
+            return 'apdu_tag'
+        if check_ciphered_apdu(payload):
+            return 'length'
+        if meter.frame_counters:
+            system_title, frame_counter, _ = split_ciphered_apdu(payload)
+            return meter.frame_counters.check(system_title, frame_counter)
+        return None
+
+    def _accept(self, meter, payload):
+        """
+        Records the frame counter of a decoded telegram, returns the reject
+        reason if an earlier telegram of the same batch already had it.
+        """
+        if not meter.frame_counters:
+            return None
+        system_title, frame_counter, _ = split_ciphered_apdu(payload)
+        reason = meter.frame_counters.check(system_title, frame_counter)
+        if reason is None:
+            meter.frame_counters.accept(system_title, frame_counter)
+        return reason
+
+    async def decode_loop(self, slot, meter, pool):
+        queue = meter.queue
+        while True:
+            # Everything waiting goes to the pool in one call
+            waiting = [await queue.get()]
+            while len(waiting) < BATCH_SIZE and not queue.empty():
+                waiting.append(queue.get_nowait())
+
+            batch = []
+            for payload, receive_time in waiting:
+                reason = self._check(meter, payload)
+                if reason:
+                    self._reject(meter, reason)
+                else:
+                    batch.append((payload, receive_time))
+            if not batch:
+                continue
+
+            start = self.metrics.timings.start() if self.metrics else 0.0
+            try:
+                results = await pool.decode(slot, meter.key, [payload for payload, _ in batch])
+            except Exception as e:
+                logger.error(f"Meter {meter.label}: decoding failed: {e}")
+                continue
+            if self.metrics:
+                self.metrics.timings.observe('decode', start)
+
+            for (payload, receive_time), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    logger.error(f"Meter {meter.label}: decoding failed: {result}")
+                elif result is None:
+                    self._reject(meter, 'not_notification')
+                elif reason := self._accept(meter, payload):
+                    self._reject(meter, reason)
+                else:
+                    raw, frame_counter = result
+                    self.on_values(meter.label, raw, receive_time, frame_counter, payload)
+
+def standin_frames(path=None):
+    """
+    Frames to stream: the recording at path or the sample telegram.
+    """
+    if path:
+        from frame_recorder import read_recording
+        return [frame for _, frame in read_recording(path)]
+    from benchmark import SAMPLE_TELEGRAM
+    return [SAMPLE_TELEGRAM]
+
+async def serve_standin(frames, host, port, interval=1.0, count=0):
+    """
+    TCP stand-in for a ser2net adapter: every client gets the frames over
+    and over (count telegrams, 0 for endless), interval seconds apart
+    (0 for as fast as possible), then the connection is closed.
+    """
+    async def handle(reader, writer):
+        sent = 0
+        try:
+            while not count or sent < count:
+                for frame in frames:
+                    writer.write(frame)
+                sent += 1
+                await writer.drain()
+                if interval:
+                    await asyncio.sleep(interval)
+        except ConnectionError:
+            pass
+        writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+async def send_standin_udp(frames, host, port, interval=1.0, count=0):
+    transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(host, port))
+    sent = 0
+    while not count or sent < count:
+        for frame in frames:
+            transport.sendto(frame)
+        sent += 1
+        await asyncio.sleep(interval)
+    transport.close()
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="M-Bus gateway stand-in")
+    commands = parser.add_subparsers(dest="command", required=True)
+    standin = commands.add_parser("standin", help="stream frames over loopback")
+    standin.add_argument("--file", help="FrameRecorder file (default: sample telegram)")
+    standin.add_argument("--host", default="127.0.0.1")
+    standin.add_argument("--port", type=int, default=7000, help="TCP port to listen on")
+    standin.add_argument("--udp", metavar="HOST:PORT", help="send datagrams to HOST:PORT instead")
+    standin.add_argument("--interval", type=float, default=1.0)
+    standin.add_argument("--count", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    frames = standin_frames(args.file)
+    if args.udp:
+        host, port = args.udp.rsplit(':', 1)
+        asyncio.run(send_standin_udp(frames, host, int(port), args.interval or 0.001, args.count))
+    else:
+        asyncio.run(serve_standin(frames, args.host, args.port, args.interval, args.count))
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,19 @@ import sys
 import os
 import time
 import logging
+from line_protocol import LineProtocolSerializer
+from aggregator import AggregateSnapshot
+from energy_counters import EnergyTotals
 
 logger = logging.getLogger(__name__)
 
+# Results of a write: retried later or dropped for good
+WRITTEN, FAILED, REJECTED = 'written', 'failed', 'rejected'
+# Client errors a later retry can fix
+RETRYABLE_STATUS = (401, 403, 429)
+
 class InfluxHandler:
-    def __init__(self, host, port, database, user, password, version, organisation, dbname):
+    def __init__(self, host, port, database, user, password, version, organisation, dbname, spool=None):
         self.host = host
         self.port = port
         self.database = database
@@ -16,12 +24,19 @@ class InfluxHandler:
         self.version = int(version)
         self.dbname = dbname
         self.organisation = organisation
+        self.spool = spool
+        # Points InfluxDB refused for good (field type conflict, beyond retention policy, ...)
+        self.rejected = 0
+        self.client_error = None
+        self.serializer = LineProtocolSerializer()
 
         self.url = f"http://{self.host}:{self.port}"
 
         if self.version == 1:
             try:
                 from influxdb import InfluxDBClient
+                from influxdb.exceptions import InfluxDBClientError
+                self.client_error = InfluxDBClientError
                 self.client = InfluxDBClient(host=self.host, port=self.port, username=self.user, password=self.password, database=self.database)
             except Exception as err:
                 logger.error(f"Kann nicht mit InfluxDB v1 verbinden! Fehler: {err}")
@@ -30,140 +45,179 @@ class InfluxHandler:
             try:
                 from influxdb_client import InfluxDBClient
                 from influxdb_client.client.write_api import SYNCHRONOUS
-                
+                from influxdb_client.rest import ApiException
+                self.client_error = ApiException
+
                 self.client = InfluxDBClient(url=self.url, token=self.password, org=self.organisation)
                 self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
 
             except Exception as err:
                 logger.error(f"Kann nicht mit InfluxDB v{self.version} verbinden! Fehler: {err}")
 
-    def write_values(self, pv):
+    def _ready(self):
         if self.version == 1:
             if not self.client:
                 logger.error("InfluxDB Client not initialized")
                 return False
-
-            try:
-                mytime = int(time.time()*1000000000)
-                json_body = [
-                {
-                    "measurement": "Wirkenergie",
-                    "fields": {
-                        "Bezug": pv.get_display_value('WirkenergieP'),
-                        "Lieferung": pv.get_display_value('WirkenergieN')
-                    },
-                    "time": mytime
-                },
-                {
-                    "measurement": "Momentanleistung",
-                    "fields": {
-                        "Bezug": pv.get_display_value('MomentanleistungP'),
-                        "Lieferung": pv.get_display_value('MomentanleistungN'),
-                        "Gesamt": pv.get_display_value('MomentanleistungP') - pv.get_display_value('MomentanleistungN')
-                    },
-                    "time": mytime
-                },
-                {
-                    "measurement": "Spannung",
-                    "fields": {
-                        "L1": pv.get_display_value('SpannungL1'),
-                        "L2": pv.get_display_value('SpannungL2'),
-                        "L3": pv.get_display_value('SpannungL3'),
-                    },
-                    "time": mytime
-                },
-                {
-                    "measurement": "Strom",
-                    "fields": {
-                        "L1": pv.get_display_value('StromL1'),
-                        "L2": pv.get_display_value('StromL2'),
-                        "L3": pv.get_display_value('StromL3'),
-                    },
-                    "time": mytime
-                },
-                {
-                    "measurement": "Leistungsfaktor",
-                    "fields": {
-                        "value": pv.get_display_value('Leistungsfaktor')
-                    },
-                    "time": mytime
-                }
-                ]
-                self.client.write_points(json_body, database=self.database)
-                return True
-            except BaseException as err:
-                logger.error(f"Es ist ein Fehler aufgetreten. Fehler: {err}")
-                return False
         elif self.version == 2 or self.version == 3:
             if not hasattr(self, 'write_api') or not self.write_api:
                 logger.error("InfluxDB Write API not initialized")
                 return False
-            try:
-                from influxdb_client import Point
-                mytime = int(time.time()*1000000000)
-                
-                points = []
-                
-                point1 = Point("Wirkenergie").field("Bezug", pv.get_display_value('WirkenergieP')).field("Lieferung", pv.get_display_value('WirkenergieN')).time(mytime)
-                points.append(point1)
-                
-                point2 = Point("Momentanleistung").field("Bezug", pv.get_display_value('MomentanleistungP')).field("Lieferung", pv.get_display_value('MomentanleistungN')).field("Gesamt", pv.get_display_value('MomentanleistungP') - pv.get_display_value('MomentanleistungN')).time(mytime)
-                points.append(point2)
-                
-                point3 = Point("Spannung").field("L1", pv.get_display_value('SpannungL1')).field("L2", pv.get_display_value('SpannungL2')).field("L3", pv.get_display_value('SpannungL3')).time(mytime)
-                points.append(point3)
-                
-                point4 = Point("Strom").field("L1", pv.get_display_value('StromL1')).field("L2", pv.get_display_value('StromL2')).field("L3", pv.get_display_value('StromL3')).time(mytime)
-                points.append(point4)
-                
-                point5 = Point("Leistungsfaktor").field("value", pv.get_display_value('Leistungsfaktor')).time(mytime)
-                points.append(point5)
-                
-                self.write_api.write(bucket=self.database, record=points)
-                return True
-            except BaseException as err:
-                logger.error(f"Es ist ein Fehler aufgetreten. Fehler: {err}")
-                return False
-
         else:
             logger.error("Ungültige InfluxDB Version angegeben!")
             return False
+        return True
+
+    def write_values(self, pv, mask=None):
+        """
+        mask leaves out the values the deadband filter suppressed.
+        """
+        if not self._ready():
+            return False
+
+        try:
+            if isinstance(pv, AggregateSnapshot):
+                payload = self.serializer.serialize_aggregate(pv)
+            elif isinstance(pv, EnergyTotals):
+                payload = self.serializer.serialize_energy(pv)
+            else:
+                payload = self.serializer.serialize_values(pv, mask=mask)
+        except BaseException as err:
+            logger.error(f"Es ist ein Fehler aufgetreten. Fehler: {err}")
+            return False
+        if not payload:
+            return True
+        return self._write_or_spool(payload)
+
+    def _permanent(self, err):
+        """
+        True for a client error (4xx) a retry cannot fix, authentication and
+        rate limiting excepted.
+        """
+        if not self.client_error or not isinstance(err, self.client_error):
+            return False
+        status = err.code if self.version == 1 else err.status
+        return isinstance(status, int) and 400 <= status < 500 and status not in RETRYABLE_STATUS
+
+    def _write_lines(self, payload):
+        """
+        Writes line protocol, either one string with newline separated lines
+        or a list of lines, with the v1 or v2/v3 client. Returns WRITTEN,
+        FAILED (worth a retry) or REJECTED (dropped and counted).
+        """
+        try:
+            if self.version == 1:
+                self.client.write_points(payload, database=self.database, protocol='line')
+            else:
+                self.write_api.write(bucket=self.database, record=payload)
+            return WRITTEN
+        except BaseException as err:
+            if self._permanent(err):
+                points = len(payload) if isinstance(payload, list) else payload.count('\n') + 1
+                self.rejected += points
+                logger.error(f"InfluxDB hat {points} Punkte abgelehnt, werden verworfen. Fehler: {err}")
+                return REJECTED
+            logger.error(f"Es ist ein Fehler aufgetreten. Fehler: {err}")
+            return FAILED
+
+    def _write_or_spool(self, payload):
+        """
+        Writes the line protocol of one frame. While the spool holds points,
+        new lines are appended behind them so the replay keeps their order.
+        """
+        if self.spool and self.spool.depth:
+            self.spool.append(payload.split('\n'))
+            return self.replay_spool()
+
+        result = self._write_lines(payload)
+        if result == WRITTEN:
+            return True
+
+        if result == FAILED and self.spool:
+            self.spool.append(payload.split('\n'))
+            self.spool.record_failure()
+            logger.warning(f"InfluxDB nicht erreichbar, {self.spool.depth} Punkte zwischengespeichert")
+        return False
+
+    def replay_spool(self, max_batches=10):
+        """
+        Writes spooled points in batches, oldest first. Returns True once the
+        spool is empty.
+        """
+        if not self.spool.retry_due():
+            return False
+
+        for _ in range(max_batches):
+            last_id, lines = self.spool.peek()
+            if not lines:
+                break
+            result = self._write_lines(lines)
+            if result == FAILED:
+                self.spool.record_failure()
+                return False
+            # A rejected batch would block the spool for good
+            self.spool.remove(last_id)
+            self.spool.record_success()
+
+        if self.spool.depth:
+            return False
+        logger.info("InfluxDB spool replayed")
+        return True
+
+    def close(self):
+        if self.client:
+            self.client.close()
+        if self.spool:
+            self.spool.close()
+
+    def spool_depth(self):
+        return self.spool.depth if self.spool else 0
+
+    def spool_evicted(self):
+        return self.spool.evicted if self.spool else 0
 
     def write_metrics(self, metrics):
-        if not self.client:
-            logger.error("InfluxDB Client not initialized")
+        if not self._ready():
             return False
-        
+
         try:
-            mytime = int(time.time()*1000000000)
-            
             fields = {
                 "uptime_seconds": metrics.get_uptime(),
                 "serial_restarts": metrics.serial_restarts,
+                "serial_stalls": metrics.serial_stalls,
+                "serial_recoveries": metrics.serial_recoveries,
+                "serial_stalled": metrics.serial_stalled,
+                "serial_last_stall_seconds": float(metrics.serial_last_stall_seconds),
                 "mqtt_last_success": 1 if metrics.mqtt_last_success else 0,
                 "mqtt_failures": metrics.mqtt_failures,
                 "mqtt_successes": metrics.mqtt_successes,
                 "influxdb_last_success": 1 if metrics.influxdb_last_success else 0,
                 "influxdb_failures": metrics.influxdb_failures,
-                "influxdb_successes": metrics.influxdb_successes
+                "influxdb_successes": metrics.influxdb_successes,
+                "influxdb_spool_depth": metrics.influxdb_spool_depth,
+                "influxdb_spool_evicted": metrics.influxdb_spool_evicted,
+                "influxdb_rejected": metrics.influxdb_rejected,
+                "archive_rows": metrics.archive_rows,
+                "archive_files": metrics.archive_files,
+                "archive_failures": metrics.archive_failures
             }
+            for phase, seconds in list(metrics.startup.items()):
+                fields[f"startup_{phase}_seconds"] = seconds
+            for reason, rejects in list(metrics.frame_rejects.items()):
+                fields[f"frame_rejects_{reason}"] = rejects
+            for sink, depth in list(metrics.sink_queue_depth.items()):
+                fields[f"queue_depth_{sink}"] = depth
+            for sink, drops in list(metrics.sink_drops.items()):
+                fields[f"queue_drops_{sink}"] = drops
+            for sink, sent in list(metrics.deadband_sent.items()):
+                fields[f"deadband_sent_{sink}"] = sent
+                fields[f"deadband_suppressed_{sink}"] = metrics.deadband_suppressed.get(sink, 0)
+            for stage, timing in metrics.timings.items():
+                for quantile, seconds in timing.percentiles().items():
+                    fields[f"stage_{stage}_p{round(quantile * 100)}_ms"] = seconds * 1000.0
 
-            if self.version == 1:
-                json_body = [{"measurement": "app_metrics", "fields": fields, "time": mytime}]
-                self.client.write_points(json_body, database=self.database)
-
-            elif self.version == 2 or self.version == 3:
-                if not hasattr(self, 'write_api') or not self.write_api:
-                    logger.error("InfluxDB Write API not initialized")
-                    return False
-                
-                from influxdb_client import Point
-                point = Point("app_metrics").time(mytime)
-                for key, value in fields.items():
-                    point.field(key, value)
-                self.write_api.write(bucket=self.database, record=point)
-            
-            return True
+            payload = self.serializer.serialize_metrics(fields, time.time_ns())
         except BaseException as err:
             logger.error(f"Fehler beim Schreiben der App-Metriken: {err}")
             return False
+        return self._write_lines(payload) == WRITTEN
@@ -0,0 +1,86 @@
+import sqlite3
+import time
+import random
+import logging
+
+logger = logging.getLogger(__name__)
+
+EVICTION_POLICIES = ('drop_oldest', 'drop_newest')
+
+class InfluxSpool:
+    """
+    Append-only SQLite buffer for line protocol points which could not be
+    written to InfluxDB. The points are replayed in batches once the server
+    is reachable again, retries back off exponentially.
+    """
+
+    def __init__(self, path, max_points=500000, batch_size=5000, eviction_policy='drop_oldest',
+                 min_retry_delay=5, max_retry_delay=300):
+        if eviction_policy not in EVICTION_POLICIES:
+            raise ValueError(f"Unknown eviction policy: {eviction_policy}")
+
+        self.path = path
+        self.max_points = int(max_points)
+        self.batch_size = int(batch_size)
+        self.eviction_policy = eviction_policy
+        self.min_retry_delay = min_retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.retry_delay = min_retry_delay
+        self.next_attempt = 0
+        self.evicted = 0
+
+        # Only the InfluxDB sink worker uses the connection, but it is created in the main thread
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS points (id INTEGER PRIMARY KEY AUTOINCREMENT, line TEXT NOT NULL)")
+        self.conn.commit()
+        self.depth = self.conn.execute("SELECT COUNT(*) FROM points").fetchone()[0]
+        if self.depth:
+            logger.info(f"InfluxDB spool {self.path} contains {self.depth} points")
+
+    def close(self):
+        self.conn.close()
+
+    def append(self, lines):
+        if self.eviction_policy == 'drop_newest':
+            free = max(0, self.max_points - self.depth)
+            if len(lines) > free:
+                self.evicted += len(lines) - free
+                lines = lines[:free]
+
+        with self.conn:
+            self.conn.executemany("INSERT INTO points (line) VALUES (?)", [(line,) for line in lines])
+            self.depth += len(lines)
+
+            overflow = self.depth - self.max_points
+            if overflow > 0:
+                self.conn.execute("DELETE FROM points WHERE id IN (SELECT id FROM points ORDER BY id LIMIT ?)", (overflow,))
+                self.depth -= overflow
+                self.evicted += overflow
+
+    def peek(self):
+        """
+        Returns the id of the last point and the lines of the oldest batch.
+        """
+        rows = self.conn.execute("SELECT id, line FROM points ORDER BY id LIMIT ?", (self.batch_size,)).fetchall()
+        if not rows:
+            return None, []
+        return rows[-1][0], [row[1] for row in rows]
+
+    def remove(self, last_id):
+        with self.conn:
+            removed = self.conn.execute("DELETE FROM points WHERE id <= ?", (last_id,)).rowcount
+        self.depth = max(0, self.depth - removed)
+
+    def retry_due(self):
+        return time.monotonic() >= self.next_attempt
+
+    def record_failure(self):
+        # Exponential backoff with +-20 % jitter
+        delay = self.retry_delay * random.uniform(0.8, 1.2)
+        self.next_attempt = time.monotonic() + delay
+        self.retry_delay = min(self.retry_delay * 2, self.max_retry_delay)
+
+    def record_success(self):
+        self.retry_delay = self.min_retry_delay
+        self.next_attempt = 0
@@ -0,0 +1,132 @@
+import logging
+from power_values import REGISTERS
+
+logger = logging.getLogger(__name__)
+
+# Fields which are not a register of their own: (measurement, field, snapshot attribute)
+DERIVED_FIELDS = [
+    ('Momentanleistung', 'Gesamt', 'wirkleistung_gesamt'),
+]
+
+def _escape_key(key):
+    return str(key).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+def _escape_measurement(name):
+    return str(name).replace('\\', '\\\\').replace(',', '\\,').replace(' ', '\\ ')
+
+def _tag_set(meter):
+    return f",meter={_escape_key(meter)}" if meter else ''
+
+def _format_field(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return f"{value}i"
+    return repr(float(value))
+
+class LineProtocolSerializer:
+    """
+    Serializes PowerValues to InfluxDB line protocol.
+
+    The measurement/field layout ('influxMeasurement' and 'influxField' of
+    each register) is compiled once per meter into a single format string
+    for the whole frame, so per frame only the numbers and the timestamp are
+    formatted. Frames of a labelled meter carry a meter tag. Registers with a factor of 1 are written as integer fields,
+    all others as floats, the same types the Point based writes produced.
+    """
+
+    def __init__(self, registers=REGISTERS):
+        layout = {}
+        for i, register in enumerate(registers):
+            integer = register.factor == 1
+            layout.setdefault(register.influxMeasurement, []).append((register.influxField, i, integer))
+
+        # Derived values are appended behind the register values
+        self.derived = []
+        for measurement, field, attribute in DERIVED_FIELDS:
+            integer = all(register.factor == 1 for register in registers if register.influxMeasurement == measurement)
+            self.derived.append(attribute)
+            layout.setdefault(measurement, []).append((field, len(registers) + len(self.derived) - 1, integer))
+
+        self.timestamp_index = len(registers) + len(self.derived)
+        self.layout = [(_escape_measurement(measurement), fields) for measurement, fields in layout.items()]
+        # Per field formats for frames which only carry some of the fields
+        self.field_formats = [(measurement, [(i, f"{_escape_key(field)}={{}}{'i' if integer else ''}") for field, i, integer in fields])
+                              for measurement, fields in self.layout]
+        self.registers = registers
+        # Compiled line templates per meter label, the label goes into a meter tag
+        self.templates = {}
+
+    def _template(self, meter):
+        template = self.templates.get(meter)
+        if template is None:
+            tags = _tag_set(meter)
+            lines = []
+            for measurement, fields in self.layout:
+                field_set = ','.join(f"{_escape_key(field)}={{{i}}}{'i' if integer else ''}" for field, i, integer in fields)
+                lines.append(f"{measurement}{tags} {field_set} {{{self.timestamp_index}}}")
+            template = self.templates[meter] = '\n'.join(lines)
+        return template
+
+    def serialize_values(self, snapshot, timestamp_ns=None, mask=None):
+        """
+        mask (one flag per register and derived field, see DeadbandFilter)
+        leaves out the fields flagged False and measurements without any
+        field left. Returns an empty string if nothing is left.
+        """
+        if timestamp_ns is None:
+            timestamp_ns = int(snapshot.timestamp * 1000000000)
+        values = (*snapshot.display, *[getattr(snapshot, attribute) for attribute in self.derived])
+        if mask is None or all(mask):
+            return self._template(snapshot.meter).format(*values, timestamp_ns)
+
+        tags = _tag_set(snapshot.meter)
+        lines = []
+        for measurement, fields in self.field_formats:
+            field_set = ','.join(fmt.format(values[i]) for i, fmt in fields if mask[i])
+            if field_set:
+                lines.append(f"{measurement}{tags} {field_set} {timestamp_ns}")
+        return '\n'.join(lines)
+
+    def serialize_aggregate(self, aggregate, timestamp_ns=None):
+        """
+        One line per measurement named <measurement>_<window> (e.g.
+        Momentanleistung_15m) with <field> holding the mean and
+        <field>_min/_max/_last, plus <field>_delta for the energy counters.
+        Separate measurements keep the float means from clashing with the
+        integer fields of the raw values.
+        """
+        if timestamp_ns is None:
+            timestamp_ns = int(aggregate.timestamp * 1000000000)
+        fields = {}
+        for i, register in enumerate(self.registers):
+            measurement = fields.setdefault(register.influxMeasurement, {})
+            field = register.influxField
+            measurement[field] = float(aggregate.display[i])
+            measurement[f"{field}_min"] = float(aggregate.minimum[i])
+            measurement[f"{field}_max"] = float(aggregate.maximum[i])
+            measurement[f"{field}_last"] = float(aggregate.last[i])
+            if register.short in aggregate.energy:
+                measurement[f"{field}_delta"] = float(aggregate.energy[register.short])
+        for measurement, field, attribute in DERIVED_FIELDS:
+            fields.setdefault(measurement, {})[field] = float(getattr(aggregate, attribute))
+        tags = {'meter': aggregate.meter} if aggregate.meter else None
+        return '\n'.join(self.serialize_metrics(values, timestamp_ns, f"{measurement}_{aggregate.window}", tags) for measurement, values in fields.items())
+
+    def serialize_energy(self, totals, timestamp_ns=None):
+        """
+        One Energie line per period (tag period: tag, monat or the tariff)
+        with Bezug and Lieferung in kWh.
+        """
+        if timestamp_ns is None:
+            timestamp_ns = int(totals.timestamp * 1000000000)
+        lines = []
+        for name, _, imported, exported in totals.periods:
+            tags = {'meter': totals.meter, 'period': name} if totals.meter else {'period': name}
+            lines.append(self.serialize_metrics({'Bezug': float(imported), 'Lieferung': float(exported)}, timestamp_ns, 'Energie', tags))
+        return '\n'.join(lines)
+
+    def serialize_metrics(self, fields, timestamp_ns, measurement='app_metrics', tags=None):
+        field_set = ','.join(f"{_escape_key(key)}={_format_field(value)}" for key, value in fields.items())
+        tag_set = ''.join(f",{_escape_key(key)}={_escape_key(value)}" for key, value in (tags or {}).items())
+        return f"{_escape_measurement(measurement)}{tag_set} {field_set} {timestamp_ns}"
@@ -0,0 +1,131 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+MBUS_START = 0x68
+MBUS_STOP = 0x16
+HEADER_LENGTH = 4  # 68 L L 68
+TRAILER_LENGTH = 2  # checksum + stop byte
+
+
+class MBusFramer:
+    """
+    Byte-stream synchronizer for M-Bus long frames (68 L L 68 <user data> CS 16).
+
+    Bytes are appended with feed() as they arrive from the serial port and
+    complete frames are taken out with next_frame(). The L field determines
+    where a frame ends, so meters with other frame lengths work as well.
+    A start pattern whose checksum or stop byte does not match is skipped
+    and the scan continues with the next candidate in the same buffer,
+    on_reject is called with 'checksum' or 'stop_byte' for it.
+    """
+
+    def __init__(self, max_buffer=4096, on_reject=None):
+        self.max_buffer = max_buffer
+        self.on_reject = on_reject
+        self.buffer = bytearray()
+        self.start = 0
+        self.discarded_bytes = 0
+
+    def feed(self, data):
+        self.buffer += data
+        overflow = len(self.buffer) - self.start - self.max_buffer
+        if overflow > 0:
+            # Drop the oldest bytes, nothing sensible can be synchronized in there anymore
+            self.start += overflow
+            self.discarded_bytes += overflow
+        self._compact()
+
+    def next_frame(self):
+        """
+        Returns the next complete and valid frame as bytes or None if more
+        data is needed.
+        """
+        buf = self.buffer
+        end = len(buf)
+        pos = self.start
+
+        while True:
+            pos = buf.find(MBUS_START, pos, end)
+            if pos < 0:
+                self._discard(end)
+                return None
+
+            if end - pos < HEADER_LENGTH:
+                self._discard(pos)
+                return None
+
+            length = buf[pos + 1]
+            if length != buf[pos + 2] or buf[pos + 3] != MBUS_START:
+                pos += 1
+                continue
+
+            frame_end = pos + HEADER_LENGTH + length + TRAILER_LENGTH
+            if frame_end > end:
+                # Wait for the rest of the frame
+                self._discard(pos)
+                return None
+
+            checksum = sum(buf[pos + HEADER_LENGTH:frame_end - TRAILER_LENGTH]) & 0xFF
+            if checksum != buf[frame_end - 2] or buf[frame_end - 1] != MBUS_STOP:
+                if self.on_reject:
+                    self.on_reject('checksum' if checksum != buf[frame_end - 2] else 'stop_byte')
+                pos += 1
+                continue
+
+            self._discard(pos)
+            frame = bytes(buf[pos:frame_end])
+            self.start = frame_end
+            self._compact()
+            return frame
+
+    def _discard(self, pos):
+        skipped = pos - self.start
+        if skipped > 0:
+            logger.warning(f"M-Bus resync: discarded {skipped} bytes")
+            self.discarded_bytes += skipped
+            self.start = pos
+
+    def _compact(self):
+        # Move the unread tail to the front once the consumed part dominates
+        if self.start and self.start * 2 >= len(self.buffer):
+            del self.buffer[:self.start]
+            self.start = 0
+
+
+class SegmentAssembler:
+    """
+    Joins the DLMS segments carried by consecutive M-Bus frames. The low
+    nibble of the CI field counts the segments, bit 0x10 marks the last one.
+    """
+
+    def __init__(self, on_reject=None):
+        self.segments = []
+        self.on_reject = on_reject
+
+    def add(self, frame):
+        """
+        Returns the complete payload once the final segment arrived,
+        otherwise None.
+        """
+        ci = frame[6]
+        sequence = ci & 0x0F
+
+        if sequence == 0:
+            self.segments = []
+        elif sequence != len(self.segments):
+            logger.warning(f"M-Bus segment {sequence} out of order, dropping telegram")
+            self.segments = []
+            if self.on_reject:
+                self.on_reject('segment')
+            return None
+
+        # 68 L L 68, C, A, CI, STSAP and DTSAP precede the DLMS segment
+        self.segments.append(memoryview(frame)[9:-2])
+
+        if not ci & 0x10:
+            return None
+
+        payload = b''.join(self.segments)
+        self.segments = []
+        return payload
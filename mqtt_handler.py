@@ -1,14 +1,61 @@
 import sys
 import os
 import time
+import threading
 import paho.mqtt.client as mqtt
 import logging
 
 logger = logging.getLogger(__name__)
 
+class PublishBatch:
+    """
+    All messages of one frame. The callback gets True once every message
+    was acknowledged by the broker, False if one failed or timed out. Acks
+    come from the paho network thread and the sink worker. The callback
+    runs exactly once and under lock, which all batches of a handler share,
+    so it can update counters.
+    """
+
+    def __init__(self, count, callback, timeout, lock):
+        self.remaining = count
+        self.callback = callback
+        self.deadline = time.monotonic() + timeout
+        self.failed = False
+        self.done = False
+        self.lock = lock
+
+    def ack(self, failed=False):
+        with self.lock:
+            self.failed = self.failed or failed
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self._finish()
+
+    def fail(self):
+        self.ack(failed=True)
+
+    def finish(self, failed=False):
+        with self.lock:
+            self.failed = self.failed or failed
+            self._finish()
+
+    def _finish(self):
+        if not self.done:
+            self.done = True
+            self.callback(not self.failed)
+
 class MQTTHandler:
-    def __init__(self, broker_ip, port, user, password, mqtt_version=1):
+    def __init__(self, broker_ip, port, user, password, mqtt_version=1, inflight_window=20, publish_timeout=2):
         self.connected = False
+        self.publish_timeout = publish_timeout
+
+        # Pipelined publishing: mid -> batch of all QoS 1 messages waiting for their PUBACK
+        self.pending = {}
+        self.early_acks = set()
+        self.pending_lock = threading.Lock()
+        # Shared by all batches, see PublishBatch
+        self.batch_lock = threading.Lock()
+        self.window = threading.BoundedSemaphore(inflight_window)
         
         # Handle paho-mqtt v2 migration
         client_args = {"client_id": "SmartMeter"}
@@ -25,6 +72,8 @@ class MQTTHandler:
         
         self.client.on_connect = self.on_connect
         self.client.on_disconnect = self.on_disconnect
+        self.client.on_publish = self.on_publish
+        self.client.max_inflight_messages_set(inflight_window)
                    
         try:
             self.client.connect(broker_ip, int(port), 60)
@@ -68,6 +117,26 @@ class MQTTHandler:
             logger.info("Disconnected from MQTT Broker")
         self.connected = False
 
+    def on_publish(self, client, userdata, mid, *args):
+        with self.pending_lock:
+            entry = self.pending.pop(mid, None)
+            if entry is None:
+                # PUBACK arrived before publish_batch registered the mid
+                self.early_acks.add(mid)
+                return
+        self.window.release()
+        entry.ack()
+
+    def close(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+        # Nothing acknowledges the waiting batches anymore
+        with self.pending_lock:
+            batches = set(self.pending.values())
+            self.pending.clear()
+        for batch in batches:
+            batch.finish(failed=True)
+
     def ensure_connection(self):
         # Connection is handled automatically by loop_start()
         pass
@@ -86,4 +155,69 @@ class MQTTHandler:
             return True
         except Exception as e:
             logger.error(f"Exception during publish: {e}")
-            return False
\ No newline at end of file
+            return False
+
+    def publish_batch(self, messages, callback):
+        """
+        Queues all (topic, payload) messages of a frame at once with QoS 1.
+        The PUBACKs are confirmed asynchronously through on_publish; at most
+        inflight_window messages are unacknowledged at any time. Once the
+        window stays full for publish_timeout the rest of the frame fails
+        without waiting again.
+        """
+        batch = PublishBatch(len(messages), callback, self.publish_timeout, self.batch_lock)
+        stalled = False
+        for topic, payload in messages:
+            if stalled:
+                batch.fail()
+                continue
+            # Frees the slots of messages the broker did not acknowledge in time
+            self.expire_pending()
+            if not self.window.acquire(timeout=self.publish_timeout):
+                logger.error(f"Failed to publish to {topic} (too many unacknowledged messages), skipping the rest of the frame")
+                stalled = True
+                batch.fail()
+                continue
+
+            try:
+                info = self.client.publish(topic, payload, qos=1)
+            except Exception as e:
+                logger.error(f"Exception during publish: {e}")
+                self.window.release()
+                batch.fail()
+                continue
+
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                logger.error(f"Failed to queue publish to {topic}, return code {info.rc}")
+                self.window.release()
+                batch.fail()
+                continue
+
+            with self.pending_lock:
+                acked = info.mid in self.early_acks
+                if acked:
+                    self.early_acks.discard(info.mid)
+                else:
+                    self.pending[info.mid] = batch
+            if acked:
+                self.window.release()
+                batch.ack()
+
+    def expire_pending(self):
+        """
+        Fails all batches whose messages were not acknowledged in time.
+        """
+        now = time.monotonic()
+        expired = []
+        with self.pending_lock:
+            for mid, batch in list(self.pending.items()):
+                if batch.deadline < now:
+                    del self.pending[mid]
+                    expired.append(batch)
+            self.early_acks.clear()
+
+        for batch in expired:
+            self.window.release()
+            if not batch.failed:
+                logger.error("Failed to publish (Timeout or Broker rejected)")
+            batch.fail()
@@ -1,39 +1,118 @@
+import time
+from collections import namedtuple
+
+Register = namedtuple('Register', ['obis', 'short', 'long', 'unit', 'factor', 'mqttTopicName', 'keySmartmeter', 'influxMeasurement', 'influxField'])
+
+# Static register table, the position of a register is its index in every snapshot
+REGISTERS = (
+    Register('0100010800FF', 'WirkenergieP', 'Wirkenergie Bezug', 'kWh', 0.001, 'WirkenergieBezug', '1.0.1.8.0.255', 'Wirkenergie', 'Bezug'),
+    Register('0100020800FF', 'WirkenergieN', 'Wirkenergie Lieferung', 'kWh', 0.001, 'WirkenergieLieferung', '1.0.2.8.0.255', 'Wirkenergie', 'Lieferung'),
+    Register('0100010700FF', 'MomentanleistungP', 'Wirkleistung Bezug', 'W', 1, 'WirkleistungBezug', '1.0.1.7.0.255', 'Momentanleistung', 'Bezug'),
+    Register('0100020700FF', 'MomentanleistungN', 'Wirkleistung Lieferung', 'W', 1, 'WirkleistungLieferung', '1.0.2.7.0.255', 'Momentanleistung', 'Lieferung'),
+    Register('0100200700FF', 'SpannungL1', 'Spannung L1', 'V', 0.1, 'SpannungL1', '1.0.32.7.0.255', 'Spannung', 'L1'),
+    Register('0100340700FF', 'SpannungL2', 'Spannung L2', 'V', 0.1, 'SpannungL2', '1.0.52.7.0.255', 'Spannung', 'L2'),
+    Register('0100480700FF', 'SpannungL3', 'Spannung L3', 'V', 0.1, 'SpannungL3', '1.0.72.7.0.255', 'Spannung', 'L3'),
+    Register('01001F0700FF', 'StromL1', 'Strom L1', 'A', 0.01, 'StromL1', '1.0.31.7.0.255', 'Strom', 'L1'),
+    Register('0100330700FF', 'StromL2', 'Strom L2', 'A', 0.01, 'StromL2', '1.0.51.7.0.255', 'Strom', 'L2'),
+    Register('0100470700FF', 'StromL3', 'Strom L3', 'A', 0.01, 'StromL3', '1.0.71.7.0.255', 'Strom', 'L3'),
+    Register('01000D0700FF', 'Leistungsfaktor', 'Leistungsfaktor', '', 0.001, 'Leistungsfaktor', '-------------', 'Leistungsfaktor', 'value'),
+)
+
+OBIS_INDEX = {register.obis: i for i, register in enumerate(REGISTERS)}
+OBIS_BYTES_INDEX = {bytes.fromhex(register.obis): i for i, register in enumerate(REGISTERS)}
+SHORT_INDEX = {register.short: i for i, register in enumerate(REGISTERS)}
+FACTORS = tuple(register.factor for register in REGISTERS)
+
+def find_register(key):
+    """
+    Index of the register named by its OBIS code in hex ('0100200700FF') or
+    dotted notation ('1.0.32.7.0.255') or by its short name, else None.
+    """
+    if key in SHORT_INDEX:
+        return SHORT_INDEX[key]
+    if '.' in key:
+        try:
+            key = bytes(int(part) for part in key.split('.')).hex()
+        except ValueError:
+            return None
+    return OBIS_INDEX.get(key.upper())
+
+P_INDEX = SHORT_INDEX['MomentanleistungP']
+N_INDEX = SHORT_INDEX['MomentanleistungN']
+
+class PowerValuesSnapshot:
+    """
+    Immutable values of one frame with capture time, DLMS frame counter,
+    the label of the meter ('' with a single meter) and the encrypted
+    telegram payload the values were decoded from, if known. Sinks get the
+    same instance without copying.
+    """
+
+    __slots__ = ('raw', 'display', 'timestamp', 'frame_counter', 'meter', 'wirkleistung_gesamt', 'payload')
+
+    def __init__(self, raw, timestamp, frame_counter, meter='', payload=None):
+        display = tuple([value * factor for value, factor in zip(raw, FACTORS)])
+        set_attr = object.__setattr__
+        set_attr(self, 'raw', tuple(raw))
+        set_attr(self, 'display', display)
+        set_attr(self, 'timestamp', timestamp)
+        set_attr(self, 'frame_counter', frame_counter)
+        set_attr(self, 'meter', meter)
+        set_attr(self, 'wirkleistung_gesamt', display[P_INDEX] - display[N_INDEX])
+        set_attr(self, 'payload', payload)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PowerValuesSnapshot is immutable")
+
+    def items(self):
+        """
+        Yields (register, display value) in the order of REGISTERS.
+        """
+        return zip(REGISTERS, self.display)
+
+    def get_display_value(self, short_name):
+        index = SHORT_INDEX.get(short_name)
+        return 0 if index is None else self.display[index]
+
+    def get_raw_value(self, short_name):
+        index = SHORT_INDEX.get(short_name)
+        return 0 if index is None else self.raw[index]
+
 class PowerValues:
-    def __init__(self):
-        self.values = {
-            '0100010800FF': { "short": 'WirkenergieP', "long": 'Wirkenergie Bezug', "unit": 'kWh', "factor": 0.001, "mqttTopicName": 'WirkenergieBezug', "keySmartmeter": '1.0.1.8.0.255' },
-            '0100020800FF': { "short": 'WirkenergieN', "long": 'Wirkenergie Lieferung', "unit": 'kWh', "factor": 0.001, "mqttTopicName": 'WirkenergieLieferung', "keySmartmeter": '1.0.2.8.0.255' },
-            '0100010700FF': { "short": 'MomentanleistungP', "long": 'Wirkleistung Bezug', "unit": 'W', "factor": 1, "mqttTopicName": 'WirkleistungBezug', "keySmartmeter": '1.0.1.7.0.255' },
-            '0100020700FF': { "short": 'MomentanleistungN', "long": 'Wirkleistung Lieferung', "unit": 'W', "factor": 1, "mqttTopicName": 'WirkleistungLieferung', "keySmartmeter": '1.0.2.7.0.255' },
-            '0100200700FF': { "short": 'SpannungL1', "long": 'Spannung L1', "unit": 'V', "factor": 0.1, "mqttTopicName": 'SpannungL1', "keySmartmeter": '1.0.32.7.0.255' },
-            '0100340700FF': { "short": 'SpannungL2', "long": 'Spannung L2', "unit": 'V', "factor": 0.1, "mqttTopicName": 'SpannungL2', "keySmartmeter": '1.0.52.7.0.255' },
-            '0100480700FF': { "short": 'SpannungL3', "long": 'Spannung L3', "unit": 'V', "factor": 0.1, "mqttTopicName": 'SpannungL3', "keySmartmeter": '1.0.72.7.0.255' },
-            '01001F0700FF': { "short": 'StromL1', "long": 'Strom L1', "unit": 'A', "factor": 0.01, "mqttTopicName": 'StromL1', "keySmartmeter": '1.0.31.7.0.255' },
-            '0100330700FF': { "short": 'StromL2', "long": 'Strom L2', "unit": 'A', "factor": 0.01, "mqttTopicName": 'StromL2', "keySmartmeter": '1.0.51.7.0.255' },
-            '0100470700FF': { "short": 'StromL3', "long": 'Strom L3', "unit": 'A', "factor": 0.01, "mqttTopicName": 'StromL3', "keySmartmeter": '1.0.71.7.0.255' },
-            '01000D0700FF': { "short": 'Leistungsfaktor', "long": 'Leistungsfaktor', "unit": '', "factor": 0.001, "mqttTopicName": 'Leistungsfaktor', "keySmartmeter": '-------------' }
-        }
-        
-        self.short_map = {}
-
-        # Initialize values
-        for key in self.values:
-            self.values[key]['valueSmartmeter'] = 0
-            self.values[key]['valueDisplay'] = 0
-            self.short_map[self.values[key]['short']] = key
-
-    def __iter__(self):
-        return iter(self.values.values())
+    """
+    Raw register values of the frame currently being decoded, one instance
+    per meter.
+    """
+
+    __slots__ = ('raw', 'timestamp', 'frame_counter', 'meter', 'payload')
+
+    def __init__(self, meter=''):
+        self.raw = [0] * len(REGISTERS)
+        self.timestamp = None
+        self.frame_counter = None
+        self.meter = meter
+        # Encrypted telegram payload (bytes) of the current values
+        self.payload = None
 
     def is_valid_obis(self, obis):
-        return obis in self.values
+        return obis in OBIS_INDEX
 
     def set_value(self, obis, raw_value):
-        if obis in self.values:
-            self.values[obis]['valueSmartmeter'] = raw_value
-            self.values[obis]['valueDisplay'] = raw_value * self.values[obis]['factor']
+        index = OBIS_INDEX.get(obis)
+        if index is not None:
+            self.raw[index] = raw_value
+
+    def set_raw(self, index, raw_value):
+        self.raw[index] = raw_value
 
     def get_display_value(self, short_name):
-        if short_name in self.short_map:
-            return self.values[self.short_map[short_name]]['valueDisplay']
-        return 0
\ No newline at end of file
+        index = SHORT_INDEX.get(short_name)
+        return 0 if index is None else self.raw[index] * FACTORS[index]
+
+    def snapshot(self):
+        """
+        Returns the immutable snapshot of the current values which the sinks
+        can read while the next frame is decoded into this instance.
+        """
+        timestamp = self.timestamp if self.timestamp is not None else time.time()
+        return PowerValuesSnapshot(self.raw, timestamp, self.frame_counter, self.meter, self.payload)
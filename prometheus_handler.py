@@ -1,54 +1,149 @@
-import sys
 import logging
-from prometheus_client import start_http_server, Gauge
+from prometheus_client import start_http_server, REGISTRY
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, HistogramMetricFamily
+from power_values import REGISTERS
+from energy_counters import EnergyTotals
 
 logger = logging.getLogger(__name__)
 
+def _obis_label(obis):
+    # '0100010800FF' -> '1.0.1.8.0.255', the notation used on the meter display
+    return '.'.join(str(b) for b in bytes.fromhex(obis))
+
+class ValuesCollector:
+    """
+    Renders the latest snapshot of every meter at scrape time. A frame only
+    replaces the snapshot reference, nothing is formatted unless Prometheus
+    scrapes.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.labels = [[_obis_label(register.obis), register.short, register.unit] for register in REGISTERS]
+
+    def collect(self):
+        snapshots = list(self.handler.latest.values())
+        if not snapshots:
+            return
+
+        values = GaugeMetricFamily('smartmeter_value', 'Latest value of a smart meter register.', labels=['meter', 'obis', 'name', 'unit'])
+        last_frame = GaugeMetricFamily('smartmeter_last_frame_timestamp_seconds', 'Unix time the latest frame was received.', labels=['meter'])
+        for snapshot in snapshots:
+            meter = snapshot.meter
+            for labels, value in zip(self.labels, snapshot.display):
+                values.add_metric([meter, *labels], value)
+            values.add_metric([meter, '', 'Wirkleistunggesamt', 'W'], snapshot.wirkleistung_gesamt)
+            last_frame.add_metric([meter], snapshot.timestamp)
+        yield values
+        yield last_frame
+
+        totals = list(self.handler.energy.values())
+        if totals:
+            energy = GaugeMetricFamily('smartmeter_energy_period_kwh', 'Energy imported or exported within the current day, month or tariff window.', labels=['meter', 'period', 'direction'])
+            for total in totals:
+                for name, _, imported, exported in total.periods:
+                    energy.add_metric([total.meter, name, 'import'], imported)
+                    energy.add_metric([total.meter, name, 'export'], exported)
+            yield energy
+
+class AppMetricsCollector:
+    """
+    Renders AppMetrics at scrape time, counters as real Prometheus counters.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def collect(self):
+        m = self.metrics
+        yield GaugeMetricFamily('smartmeter_app_uptime_seconds', 'Application uptime in seconds.', value=m.get_uptime())
+        yield CounterMetricFamily('smartmeter_app_serial_restarts', 'Total number of serial connection restarts.', value=m.serial_restarts)
+        yield CounterMetricFamily('smartmeter_app_serial_stalls', 'Total number of times the watchdog found a meter silent for longer than its expected frame interval.', value=m.serial_stalls)
+        yield CounterMetricFamily('smartmeter_app_serial_recoveries', 'Total number of stalls that ended with a telegram.', value=m.serial_recoveries)
+        yield GaugeMetricFamily('smartmeter_app_serial_stalled', 'Number of serial readers currently stalled.', value=m.serial_stalled)
+        yield GaugeMetricFamily('smartmeter_app_serial_last_stall_seconds', 'Duration of the last stall that ended.', value=m.serial_last_stall_seconds)
+        yield GaugeMetricFamily('smartmeter_app_mqtt_write_success', 'Status of the last MQTT write cycle (1 for success, 0 for failure).', value=1 if m.mqtt_last_success else 0)
+        yield CounterMetricFamily('smartmeter_app_mqtt_write_failures', 'Total number of failed MQTT write cycles.', value=m.mqtt_failures)
+        yield CounterMetricFamily('smartmeter_app_mqtt_write_successes', 'Total number of successful MQTT write cycles.', value=m.mqtt_successes)
+        yield GaugeMetricFamily('smartmeter_app_influxdb_write_success', 'Status of the last InfluxDB write (1 for success, 0 for failure).', value=1 if m.influxdb_last_success else 0)
+        yield CounterMetricFamily('smartmeter_app_influxdb_write_failures', 'Total number of failed InfluxDB writes.', value=m.influxdb_failures)
+        yield CounterMetricFamily('smartmeter_app_influxdb_write_successes', 'Total number of successful InfluxDB writes.', value=m.influxdb_successes)
+        yield GaugeMetricFamily('smartmeter_app_influxdb_spool_depth', 'Number of points waiting in the InfluxDB spool.', value=m.influxdb_spool_depth)
+        yield CounterMetricFamily('smartmeter_app_influxdb_spool_evicted', 'Total number of points evicted from the full InfluxDB spool.', value=m.influxdb_spool_evicted)
+        yield CounterMetricFamily('smartmeter_app_influxdb_rejected', 'Total number of points InfluxDB refused with a client error, dropped instead of spooled.', value=m.influxdb_rejected)
+        yield CounterMetricFamily('smartmeter_app_archive_rows', 'Total number of frames written to the archive.', value=m.archive_rows)
+        yield CounterMetricFamily('smartmeter_app_archive_files', 'Total number of archive files written.', value=m.archive_files)
+        yield CounterMetricFamily('smartmeter_app_archive_failures', 'Total number of archive batches that could not be written.', value=m.archive_failures)
+
+        depth = GaugeMetricFamily('smartmeter_app_sink_queue_depth', 'Number of snapshots waiting in the queue of a sink.', labels=['sink'])
+        for sink, value in list(m.sink_queue_depth.items()):
+            depth.add_metric([sink], value)
+        yield depth
+
+        if m.startup:
+            startup = GaugeMetricFamily('smartmeter_app_startup_seconds', 'Seconds from the start of the script to the end of a startup phase.', labels=['phase'])
+            for phase, value in list(m.startup.items()):
+                startup.add_metric([phase], value)
+            yield startup
+
+        rejects = CounterMetricFamily('smartmeter_app_frame_rejects', 'Total number of frames or telegrams dropped before decoding, by reason.', labels=['reason'])
+        for reason, value in list(m.frame_rejects.items()):
+            rejects.add_metric([reason], value)
+        yield rejects
+
+        drops = CounterMetricFamily('smartmeter_app_sink_queue_drops', 'Total number of snapshots dropped because the queue of a sink was full.', labels=['sink'])
+        for sink, value in list(m.sink_drops.items()):
+            drops.add_metric([sink], value)
+        yield drops
+
+        if m.deadband_sent:
+            sent = CounterMetricFamily('smartmeter_app_deadband_sent_values', 'Total number of values sent by a sink with deadband filter.', labels=['sink'])
+            suppressed = CounterMetricFamily('smartmeter_app_deadband_suppressed_values', 'Total number of values a sink did not send because they stayed within their deadband.', labels=['sink'])
+            for sink, value in list(m.deadband_sent.items()):
+                sent.add_metric([sink], value)
+                suppressed.add_metric([sink], m.deadband_suppressed.get(sink, 0))
+            yield sent
+            yield suppressed
+
+        if m.timings.enabled:
+            stages = HistogramMetricFamily('smartmeter_app_stage_duration_seconds', 'Duration of the processing stages of a frame in seconds.', labels=['stage'])
+            for stage, timing in m.timings.items():
+                buckets = [('+Inf' if bound == float('inf') else str(bound), count) for bound, count in timing.cumulative_buckets()]
+                stages.add_metric([stage], buckets, timing.total)
+            yield stages
+
 class PrometheusHandler:
-    def __init__(self, port, metrics):
+    def __init__(self, port, metrics, expose_values=False, expose_metrics=True):
         self.port = int(port)
         self.metrics = metrics
-        self.gauges = {}
-        self.app_metrics = {
-            'uptime_seconds': Gauge('smartmeter_app_uptime_seconds', 'Application uptime in seconds.'),
-            'serial_restarts_total': Gauge('smartmeter_app_serial_restarts_total', 'Total number of serial connection restarts.'),
-            'mqtt_write_success': Gauge('smartmeter_app_mqtt_write_success', 'Status of the last MQTT write cycle (1 for success, 0 for failure).'),
-            'mqtt_write_failures_total': Gauge('smartmeter_app_mqtt_write_failures_total', 'Total number of failed MQTT write cycles.'),
-            'mqtt_write_successes_total': Gauge('smartmeter_app_mqtt_write_successes_total', 'Total number of successful MQTT write cycles.'),
-            'influxdb_write_success': Gauge('smartmeter_app_influxdb_write_success', 'Status of the last InfluxDB write (1 for success, 0 for failure).'),
-            'influxdb_write_failures_total': Gauge('smartmeter_app_influxdb_write_failures_total', 'Total number of failed InfluxDB writes.'),
-            'influxdb_write_successes_total': Gauge('smartmeter_app_influxdb_write_successes_total', 'Total number of successful InfluxDB writes.')
-        }
-
-        try:
-            start_http_server(self.port)
-            logger.info(f"Prometheus metrics server started on port {self.port}")
-        except Exception as e:
-            logger.error(f"Failed to start Prometheus server: {e}")
-            sys.exit(1)
+        # meter label -> latest snapshot and latest EnergyTotals
+        self.latest = {}
+        self.energy = {}
+
+        # Raises OSError if the port is taken, before anything is registered
+        server = start_http_server(self.port)
+        # Older prometheus_client versions return nothing, their server cannot be stopped
+        self.server = server[0] if server else None
+        logger.info(f"Prometheus metrics server started on port {self.port}")
+
+        self.collectors = []
+        if expose_values:
+            self.collectors.append(ValuesCollector(self))
+        if expose_metrics:
+            self.collectors.append(AppMetricsCollector(metrics))
+        for collector in self.collectors:
+            REGISTRY.register(collector)
+
+    def close(self):
+        for collector in self.collectors:
+            REGISTRY.unregister(collector)
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
 
     def update_values(self, pv):
-        # Update gauges for each value in PowerValues
-        for item in pv:
-            key = item['short']
-            if key not in self.gauges:
-                self.gauges[key] = Gauge(key, item['long'])
-            
-            self.gauges[key].set(item['valueDisplay'])
-            
-        # Calculate and update total power
-        gesamt = pv.get_display_value('MomentanleistungP') - pv.get_display_value('MomentanleistungN')
-        key_gesamt = 'Wirkleistunggesamt'
-        if key_gesamt not in self.gauges:
-             self.gauges[key_gesamt] = Gauge(key_gesamt, 'Wirkleistung Gesamt')
-        self.gauges[key_gesamt].set(gesamt)
-
-    def update_metrics(self):
-        self.app_metrics['uptime_seconds'].set(self.metrics.get_uptime())
-        self.app_metrics['serial_restarts_total'].set(self.metrics.serial_restarts)
-        self.app_metrics['mqtt_write_success'].set(1 if self.metrics.mqtt_last_success else 0)
-        self.app_metrics['mqtt_write_failures_total'].set(self.metrics.mqtt_failures)
-        self.app_metrics['mqtt_write_successes_total'].set(self.metrics.mqtt_successes)
-        self.app_metrics['influxdb_write_success'].set(1 if self.metrics.influxdb_last_success else 0)
-        self.app_metrics['influxdb_write_failures_total'].set(self.metrics.influxdb_failures)
-        self.app_metrics['influxdb_write_successes_total'].set(self.metrics.influxdb_successes)
+        # Rendered by ValuesCollector on the next scrape
+        if isinstance(pv, EnergyTotals):
+            self.energy[pv.meter] = pv
+        else:
+            self.latest[pv.meter] = pv
@@ -1,46 +1,85 @@
 import serial
-import sys
 import time
 import logging
 import xml.etree.ElementTree as ET
 from binascii import unhexlify
-from Cryptodome.Cipher import AES
-from gurux_dlms.GXDLMSTranslator import GXDLMSTranslator
+from dlms_decoder import DLMSDecoder
+from mbus_framer import MBusFramer, SegmentAssembler
+from frame_recorder import ReplayFinished
+from serial_watchdog import Backoff
+from telegram import GENERAL_GLO_CIPHERING, DATA_NOTIFICATION_HEADER, TelegramCipher, FrameCounterTracker, check_ciphered_apdu, split_ciphered_apdu
 
 logger = logging.getLogger(__name__)
 
+# Seconds a read on the serial port waits for data, the watchdog gets to run in between
+READ_TIMEOUT = 1.0
+
 class SerialReader:
-    def __init__(self, port, baudrate, key, metrics):
+    def __init__(self, port, baudrate, key, metrics, decoder='native', source=None, recorder=None, track_frame_counter=True, watchdog=None, max_backoff=60):
+        """
+        source replaces the serial port with another serial-like object
+        (e.g. ReplaySerial, whose receive_time then stamps the values),
+        recorder gets every valid M-Bus frame.
+        track_frame_counter rejects telegrams whose frame counter is not
+        above the last one of their system title (off for looped replays).
+        watchdog (FrameWatchdog) reopens the port when the meter falls
+        silent. Failed opens and restarts are retried with exponential
+        backoff up to max_backoff seconds.
+        """
         self.port = port
         self.baudrate = baudrate
-        self.key = key
+        # Parsed once, the hot path only works on bytes
+        self.key = unhexlify(key)
+        self.cipher = TelegramCipher(self.key)
         self.ser = None
-        self.translator = GXDLMSTranslator()
+        self.source = source
+        self.recorder = recorder
+        self.decoder = decoder
+        self.translator = None
+        self.dlms_decoder = None
+        if self.decoder == 'gurux':
+            from gurux_dlms.GXDLMSTranslator import GXDLMSTranslator
+            self.translator = GXDLMSTranslator()
+        else:
+            self.dlms_decoder = DLMSDecoder()
         self.metrics = metrics
         self.retry_count = 0
+        self.backoff = Backoff(maximum=max_backoff)
+        self.watchdog = watchdog
+        self.framer = MBusFramer(on_reject=metrics.count_frame_reject)
+        self.assembler = SegmentAssembler(on_reject=metrics.count_frame_reject)
+        self.frame_counters = FrameCounterTracker() if track_frame_counter else None
         self._connect()
 
     def _connect(self):
+        if self.source:
+            if not self.source.is_open:
+                self.source.open()
+            self.ser = self.source
+            return
+
         try:
             self.ser = serial.Serial(
                 port=self.port,
                 baudrate=self.baudrate,
                 bytesize=serial.EIGHTBITS,
                 parity=serial.PARITY_NONE,
-                stopbits=serial.STOPBITS_ONE
+                stopbits=serial.STOPBITS_ONE,
+                timeout=READ_TIMEOUT
             )
             self.retry_count = 0
         except Exception as e:
             self.retry_count += 1
-            logger.error(f"Failed to open serial port {self.port}: {e} (Attempt {self.retry_count}/5)")
-            if self.retry_count >= 5:
-                logger.critical("Failed to open serial port 5 times in a row. Exiting.")
-                sys.exit(1)
+            logger.error(f"Failed to open serial port {self.port}: {e} (Attempt {self.retry_count})")
+
+    def _wait(self):
+        delay = self.backoff.next()
+        logger.warning(f"Retrying serial connection in {delay:.1f} s")
+        time.sleep(delay)
 
     def _reconnect(self):
         self.metrics.inc_serial_restarts()
-        logger.warning("wrong M-Bus Start, restarting")
-        time.sleep(2.5)
+        self._wait()
         try:
             if self.ser:
                 self.ser.flushOutput()
@@ -51,18 +90,34 @@ class SerialReader:
         except Exception as e:
             logger.error(f"Failed to reconnect serial port: {e}")
 
+    def _stalled(self):
+        watchdog = self.watchdog
+        if watchdog.missed == 1:
+            self.metrics.serial_stall_started()
+        expected = f"{watchdog.interval:.1f} s" if watchdog.interval is not None else "unknown"
+        logger.warning(f"No telegram for {time.monotonic() - watchdog.stalled_since:.0f} s (expected interval {expected}), restarting serial connection")
+        self._reconnect()
+        watchdog.rearm(time.monotonic())
+
+    def _received(self):
+        stall = self.watchdog.frame(time.monotonic())
+        if stall is not None:
+            self.metrics.serial_stall_recovered(stall)
+            logger.info(f"Telegrams received again after {stall:.0f} s")
+
+    def _reject(self, reason, message):
+        self.metrics.count_frame_reject(reason)
+        logger.warning(f"{message}, skipping telegram ({reason})")
+
     def _decrypt(self, frame, system_title, frame_counter):
         try:
-            frame_bytes = unhexlify(frame)
-            encryption_key = unhexlify(self.key)
-            init_vector = unhexlify(system_title + frame_counter)
-            cipher = AES.new(encryption_key, AES.MODE_GCM, nonce=init_vector)
-            return cipher.decrypt(frame_bytes).hex()
+            return self.cipher.decrypt(frame, system_title, frame_counter)
         except Exception as e:
             logger.error(f"Decryption failed: {e}")
             return None
 
-    def _parse_xml(self, xml_data, power_values):
+    @staticmethod
+    def _parse_xml(xml_data, power_values):
         try:
             root = ET.fromstring(xml_data)
             items = list(root.iter())
@@ -76,57 +131,111 @@ class SerialReader:
         except Exception as e:
             logger.error(f"XML Parsing failed: {e}")
 
+    def _parse_apdu(self, apdu, power_values, start):
+        timings = self.metrics.timings
+        if self.decoder == 'gurux':
+            xml = self.translator.pduToXml(apdu)
+            start = timings.observe('translate', start)
+            self._parse_xml(xml, power_values)
+            timings.observe('parse', start)
+            return
+
+        try:
+            self.dlms_decoder.decode(apdu, power_values)
+        except Exception as e:
+            logger.error(f"APDU decoding failed: {e}")
+        timings.observe('parse', start)
+
+    def _read_telegram(self):
+        """
+        Feeds the bytes waiting on the serial port into the framer and
+        assembles the DLMS segments carried by the M-Bus frames. Returns the
+        complete payload once the final segment arrived, otherwise None.
+        """
+        frame = self.framer.next_frame()
+        if frame is None:
+            self.framer.feed(self.ser.read(size=self.ser.in_waiting or 1))
+            return None
+
+        if self.recorder:
+            self.recorder.record(frame)
+
+        return self.assembler.add(frame)
+
     def read(self, power_values):
         """
-        Reads from serial, decrypts, parses XML and updates power_values.
-        Blocking call until one full valid frame is processed.
+        Reads from serial, decrypts, decodes the APDU and updates power_values.
+        Blocking call until one full valid telegram is processed.
         """
         raw_serial_data = None
         decrypted_apdu = None
+        timings = self.metrics.timings
+        start = timings.start()
         while True:
             try:
                 if not self.ser or not self.ser.is_open:
                     self._connect()
                     if not self.ser or not self.ser.is_open:
-                        time.sleep(5)
+                        self._wait()
                         continue
 
-                data = self.ser.read(size=282).hex()
-                raw_serial_data = data
-                decrypted_apdu = None
-                
-                if not data:
+                payload = self._read_telegram()
+                if payload is None:
+                    if self.watchdog and self.watchdog.check(time.monotonic()):
+                        self._stalled()
                     continue
+                if self.watchdog:
+                    # Any complete telegram proves the link works, valid or not
+                    self._received()
+                # A replay stamps the telegram with its recorded receive time
+                receive_time = getattr(self.ser, 'receive_time', None) or time.time()
+                # A skipped telegram must not count towards the wait for the next one
+                start = timings.observe('serial', start)
+
+                raw_serial_data = payload
+                decrypted_apdu = None
 
-                mbus_start = data[0:8]
-                
-                if not (mbus_start[0:2] == "68" and mbus_start[2:4] == mbus_start[4:6] and mbus_start[6:8] == "68"):
-                    self._reconnect()
+                # Validation before decryption, a bad telegram costs no AES and no reconnect
+                if payload[0] != GENERAL_GLO_CIPHERING:
+                    self._reject('apdu_tag', f"Unexpected APDU tag 0x{payload[0]:02X}")
                     continue
-                
-                logger.info("Daten ok")
+                if check_ciphered_apdu(payload):
+                    self._reject('length', f"Length field does not match the {len(payload)} bytes received")
+                    continue
+                system_title, frame_counter, frame = split_ciphered_apdu(payload)
+                if self.frame_counters:
+                    reason = self.frame_counters.check(system_title, frame_counter)
+                    if reason:
+                        self._reject(reason, f"Frame counter {int.from_bytes(frame_counter, 'big')} already seen")
+                        continue
 
-                frame_len = int("0x" + mbus_start[2:4], 16)
-                system_title = data[22:38]
-                frame_counter = data[44:52]
-                frame = data[52:12+frame_len*2]
+                logger.debug("Daten ok")
 
+                decrypt_start = timings.start()
                 apdu = self._decrypt(frame, system_title, frame_counter)
                 decrypted_apdu = apdu
-                
-                if not apdu or apdu[0:4] != "0f80":
+                decrypt_done = timings.observe('decrypt', decrypt_start)
+
+                if not apdu or apdu[0:2] != DATA_NOTIFICATION_HEADER:
+                    self._reject('not_notification', "Decrypted APDU is no Data-Notification, wrong key?")
                     continue
+                if self.frame_counters:
+                    self.frame_counters.accept(system_title, frame_counter)
 
-                xml = self.translator.pduToXml(apdu)
-                self._parse_xml(xml, power_values)
+                power_values.timestamp = receive_time
+                power_values.frame_counter = int.from_bytes(frame_counter, 'big')
+                power_values.payload = payload
+                self._parse_apdu(apdu, power_values, decrypt_done)
+                self.backoff.reset()
                 return
 
+            except ReplayFinished:
+                raise
             except Exception as e:
                 logger.error(f"Error in serial read loop: {e}")
-                logger.error(f"Original serial data: {raw_serial_data}")
+                logger.error(f"Original serial data: {raw_serial_data.hex() if raw_serial_data else None}")
                 if decrypted_apdu:
-                    logger.error(f"Decrypted APDU: {decrypted_apdu}")
+                    logger.error(f"Decrypted APDU: {decrypted_apdu.hex()}")
                 else:
                     logger.error("Decrypted APDU: not available")
-                self._reconnect()
-                time.sleep(1)
\ No newline at end of file
+                self._reconnect()
\ No newline at end of file
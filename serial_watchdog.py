@@ -0,0 +1,92 @@
+import random
+
+class Backoff:
+    """
+    Exponential backoff with jitter: initial, 2x, 4x, ... up to maximum
+    seconds, each delay randomly shortened by up to jitter so several
+    readers do not retry in lockstep. reset() after a success.
+    """
+
+    def __init__(self, initial=1.0, maximum=60.0, factor=2.0, jitter=0.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+
+    def next(self):
+        delay = min(self.maximum, self.initial * self.factor ** self.attempts)
+        self.attempts += 1
+        return delay * (1 - self.jitter * random.random())
+
+    def reset(self):
+        self.attempts = 0
+
+class FrameWatchdog:
+    """
+    Learns the interval between telegrams as moving average and reports a
+    stall once no telegram arrived for factor times that interval (at
+    least min_timeout seconds, initial_timeout until the interval is
+    known). All times are time.monotonic() values.
+    """
+
+    def __init__(self, factor=2.0, min_timeout=5.0, initial_timeout=30.0, smoothing=0.2):
+        self.factor = factor
+        self.min_timeout = min_timeout
+        self.initial_timeout = initial_timeout
+        self.smoothing = smoothing
+        self.interval = None
+        self.last_frame = None
+        # Last telegram or last stall action, the next deadline counts from it
+        self.reference = None
+        self.stalled_since = None
+        # Deadlines missed in the current stall
+        self.missed = 0
+
+    def timeout(self):
+        if self.interval is None:
+            return self.initial_timeout
+        return max(self.min_timeout, self.factor * self.interval)
+
+    def frame(self, now):
+        """
+        Records a telegram. Returns the length of the stall it ended in
+        seconds, else None.
+        """
+        stall = None
+        if self.stalled_since is not None:
+            stall = now - self.stalled_since
+            self.stalled_since = None
+            self.missed = 0
+        elif self.last_frame is not None:
+            # The gap of a stall would distort the interval
+            elapsed = now - self.last_frame
+            self.interval = elapsed if self.interval is None else self.interval + self.smoothing * (elapsed - self.interval)
+        self.last_frame = now
+        self.reference = now
+        return stall
+
+    def check(self, now):
+        """
+        True when no telegram arrived within the timeout since the last
+        telegram or the last deadline. The caller acts on it (e.g. reopens
+        the port) and calls rearm() when done, the next deadline is one
+        timeout later.
+        """
+        if self.reference is None:
+            self.reference = now
+            return False
+        if now - self.reference < self.timeout():
+            return False
+        if self.stalled_since is None:
+            self.stalled_since = self.last_frame if self.last_frame is not None else self.reference
+        self.missed += 1
+        self.reference = now
+        return True
+
+    def rearm(self, now):
+        self.reference = now
+
+    @property
+    def stalled(self):
+        return self.stalled_since is not None
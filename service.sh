@@ -14,6 +14,7 @@ echo "Type=simple" >> "$filename"
 echo "Restart=always" >> "$filename"
 echo "RestartSec=3" >> "$filename"
 echo "ExecStart=/usr/bin/python3 $dateipfad/smartmeter.py" >> "$filename"
+echo "ExecReload=/bin/kill -HUP \$MAINPID" >> "$filename"
 echo "" >> "$filename"
 echo "[Install]" >> "$filename"
 echo "WantedBy=multi-user.target" >> "$filename"
@@ -0,0 +1,126 @@
+import threading
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'coalesce')
+
+class SinkWorker(threading.Thread):
+    """
+    Delivers value snapshots to one sink (MQTT, InfluxDB, ...) from its own
+    bounded queue, so a slow sink never blocks the serial read.
+
+    Overflow policies when the queue is full:
+      block       - put() waits until the sink caught up, drops the oldest
+                    while the sink has no handler (backend not ready)
+      drop_oldest - the oldest queued snapshot is dropped
+      coalesce    - only the latest snapshot of each meter (and type) is kept
+    """
+
+    def __init__(self, name, handler, metrics, queue_size=10, overflow_policy='drop_oldest'):
+        super().__init__(name=f"sink-{name}", daemon=True)
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+
+        self.sink = name
+        self.handler = handler
+        self.metrics = metrics
+        self.overflow_policy = overflow_policy
+        self.queue_size = max(1, int(queue_size))
+        self.queue = deque()
+        self.busy = False
+        self.paused = False
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.metrics.register_sink(self.sink)
+
+    def put(self, snapshot):
+        with self.condition:
+            if self.overflow_policy == 'coalesce':
+                for i, queued in enumerate(self.queue):
+                    # Energy totals and values of a meter are not interchangeable
+                    if queued.meter == snapshot.meter and type(queued) is type(snapshot):
+                        del self.queue[i]
+                        self.metrics.inc_sink_drops(self.sink)
+                        break
+            elif self.overflow_policy == 'block':
+                # Without a handler (backend down) nothing drains the queue,
+                # waiting would hold up the readers for good
+                while len(self.queue) >= self.queue_size and self.handler is not None:
+                    self.condition.wait()
+            if self.overflow_policy != 'coalesce' and len(self.queue) >= self.queue_size:
+                self.queue.popleft()
+                self.metrics.inc_sink_drops(self.sink)
+
+            self.queue.append(snapshot)
+            self.metrics.sink_queue_depth[self.sink] = len(self.queue)
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and (self.paused or not self.queue):
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                snapshot = self.queue.popleft()
+                self.busy = True
+                self.metrics.sink_queue_depth[self.sink] = len(self.queue)
+                self.condition.notify_all()
+
+            start = self.metrics.timings.start()
+            try:
+                self.handler(snapshot)
+            except Exception as e:
+                logger.error(f"Sink {self.sink} failed: {e}")
+            self.metrics.timings.observe(self.sink, start)
+
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+
+    def pause(self):
+        """
+        Holds the queued snapshots back once the current one is done, e.g.
+        while the sink reconnects. put() keeps queueing meanwhile.
+        """
+        with self.condition:
+            self.paused = True
+            self.condition.wait_for(lambda: not self.busy)
+
+    def resume(self):
+        with self.condition:
+            self.paused = False
+            self.condition.notify_all()
+
+    def reconfigure(self, handler, queue_size, overflow_policy):
+        """
+        Switches to a new handler and queue settings, the queued snapshots
+        stay.
+        """
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+        with self.condition:
+            self.handler = handler
+            self.queue_size = max(1, int(queue_size))
+            self.overflow_policy = overflow_policy
+            self.condition.notify_all()
+
+    def stop(self):
+        """
+        Ends the thread once the current snapshot is done, the queued ones
+        are dropped.
+        """
+        with self.condition:
+            self.stopped = True
+            self.queue.clear()
+            self.metrics.sink_queue_depth[self.sink] = 0
+            self.condition.notify_all()
+
+    def wait_idle(self, timeout=None):
+        """
+        Waits until all queued snapshots were handed to the sink.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.queue and not self.busy, timeout)
@@ -1,27 +1,63 @@
+import time
+# Reference of the startup report, taken before the imports below
+STARTED = time.monotonic()
 import json
 import sys
 import os
 from datetime import datetime
-import time
 import logging
+import signal
 import socket
+import threading
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener
+from types import SimpleNamespace
+from functools import partial
 from power_values import PowerValues
-from config_handler import get_configuration
+from config_handler import ConfigHandler
+from config_reload import ConfigReloader
 from serial_reader import SerialReader
+from serial_watchdog import FrameWatchdog
+from frame_recorder import ReplayFinished
+from sink_worker import SinkWorker
+from aggregator import WindowAggregator, AggregateSnapshot
+from deadband import DeadbandFilter
+from energy_counters import EnergyCounters, EnergyTotals
+from stage_timings import StageTimings
+from telegram import REJECT_REASONS
 
-# Load Configuration
-cfg = get_configuration()
+base_path = os.path.dirname(os.path.realpath(__file__))
+logger = logging.getLogger("SmartMeter")
 
 class AppMetrics:
-    def __init__(self):
+    def __init__(self, stage_timings=True):
         self.start_time = time.time()
         self.serial_restarts = 0
+        self.serial_stalls = 0
+        self.serial_recoveries = 0
+        self.serial_stalled = 0
+        self.serial_last_stall_seconds = 0.0
         self.mqtt_last_success = True
         self.mqtt_failures = 0
         self.mqtt_successes = 0
         self.influxdb_last_success = True
         self.influxdb_failures = 0
         self.influxdb_successes = 0
+        self.influxdb_spool_depth = 0
+        self.influxdb_spool_evicted = 0
+        self.influxdb_rejected = 0
+        self.archive_rows = 0
+        self.archive_files = 0
+        self.archive_failures = 0
+        self.sink_queue_depth = {}
+        self.sink_drops = {}
+        self.deadband_sent = {}
+        self.deadband_suppressed = {}
+        self.frame_rejects = dict.fromkeys(REJECT_REASONS, 0)
+        # Startup phase -> seconds since the script started, see StartupTimer
+        self.startup = {}
+        self.timings = StageTimings(stage_timings)
 
     def get_uptime(self):
         return time.time() - self.start_time
@@ -29,6 +65,30 @@ class AppMetrics:
     def inc_serial_restarts(self):
         self.serial_restarts += 1
 
+    def serial_stall_started(self):
+        self.serial_stalls += 1
+        self.serial_stalled += 1
+
+    def serial_stall_recovered(self, duration):
+        self.serial_recoveries += 1
+        self.serial_stalled -= 1
+        self.serial_last_stall_seconds = duration
+
+    def register_sink(self, name):
+        self.sink_queue_depth.setdefault(name, 0)
+        self.sink_drops.setdefault(name, 0)
+
+    def inc_sink_drops(self, name):
+        self.sink_drops[name] = self.sink_drops.get(name, 0) + 1
+
+    def count_frame_reject(self, reason):
+        self.frame_rejects[reason] += 1
+
+    def count_deadband(self, name, mask):
+        sent = sum(mask)
+        self.deadband_sent[name] = self.deadband_sent.get(name, 0) + sent
+        self.deadband_suppressed[name] = self.deadband_suppressed.get(name, 0) + len(mask) - sent
+
 # Setup Logging
 class JSONFormatter(logging.Formatter):
     def format(self, record):
@@ -51,139 +111,718 @@ class ErrorLocationFormatter(logging.Formatter):
             record.error_location = f" ({record.filename}:{record.lineno})"
         return super().format(record)
 
-root_logger = logging.getLogger()
-root_logger.setLevel(logging.DEBUG) # Set root logger to the most permissive level
-
-if cfg.logging.console.enabled:
-    console_handler = logging.StreamHandler(sys.stdout)
-    console_level = getattr(logging, cfg.logging.console.level.upper(), logging.INFO)
-    console_handler.setLevel(console_level)
-    
-    if cfg.logging.console.format == 'json':
-        console_handler.setFormatter(JSONFormatter())
-    elif cfg.logging.console.format == 'raw':
-        console_handler.setFormatter(ErrorLocationFormatter('%(message)s%(error_location)s'))
-    else:
-        console_handler.setFormatter(
-            ErrorLocationFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s%(error_location)s')
-        )
-    root_logger.addHandler(console_handler)
-
-if cfg.logging.file.enabled and cfg.logging.file.path:
-    file_handler = logging.FileHandler(cfg.logging.file.path)
-    file_level = getattr(logging, cfg.logging.file.level.upper(), logging.INFO)
-    file_handler.setLevel(file_level)
-
-    if cfg.logging.file.format == 'json':
-        file_handler.setFormatter(JSONFormatter())
-    else:
-        file_handler.setFormatter(
-            ErrorLocationFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s%(error_location)s')
-        )
-    root_logger.addHandler(file_handler)
+class DeferredQueueHandler(QueueHandler):
+    """
+    Hands records to the listener thread unformatted, the formatting and
+    all I/O happen there instead of on the thread that logs.
+    """
 
-if hasattr(cfg.logging, 'loki') and cfg.logging.loki.enabled and cfg.logging.loki.url:
-    try:
-        import logging_loki
-        from multiprocessing import Queue
-        loki_handler = logging_loki.LokiQueueHandler(
-            Queue(-1),
-            url=cfg.logging.loki.url,
-            tags={"application": "smartmeter", "hostname": socket.gethostname()},
-            version="1",
-        )
-        loki_level = getattr(logging, cfg.logging.loki.level.upper(), logging.INFO)
-        loki_handler.setLevel(loki_level)
-        root_logger.addHandler(loki_handler)
-    except ImportError:
+    def prepare(self, record):
+        return record
+
+def create_log_handlers(cfg):
+    """
+    Returns the configured console, file and Loki handlers and whether Loki
+    is enabled but its module is missing.
+    """
+    log_handlers = []
+
+    if cfg.logging.console.enabled:
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_level = getattr(logging, cfg.logging.console.level.upper(), logging.INFO)
+        console_handler.setLevel(console_level)
+
+        if cfg.logging.console.format == 'json':
+            console_handler.setFormatter(JSONFormatter())
+        elif cfg.logging.console.format == 'raw':
+            console_handler.setFormatter(ErrorLocationFormatter('%(message)s%(error_location)s'))
+        else:
+            console_handler.setFormatter(
+                ErrorLocationFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s%(error_location)s')
+            )
+        log_handlers.append(console_handler)
+
+    if cfg.logging.file.enabled and cfg.logging.file.path:
+        file_handler = logging.FileHandler(cfg.logging.file.path)
+        file_level = getattr(logging, cfg.logging.file.level.upper(), logging.INFO)
+        file_handler.setLevel(file_level)
+
+        if cfg.logging.file.format == 'json':
+            file_handler.setFormatter(JSONFormatter())
+        else:
+            file_handler.setFormatter(
+                ErrorLocationFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s%(error_location)s')
+            )
+        log_handlers.append(file_handler)
+
+    loki_missing = False
+    if hasattr(cfg.logging, 'loki') and cfg.logging.loki.enabled and cfg.logging.loki.url:
+        try:
+            import logging_loki
+            # Plain handler, it already runs on the listener thread
+            loki_handler = logging_loki.LokiHandler(
+                url=cfg.logging.loki.url,
+                tags={"application": "smartmeter", "hostname": socket.gethostname()},
+                version="1",
+            )
+            loki_level = getattr(logging, cfg.logging.loki.level.upper(), logging.INFO)
+            loki_handler.setLevel(loki_level)
+            log_handlers.append(loki_handler)
+        except ImportError:
+            loki_missing = True
+
+    # Without any handler warnings still reach stderr, like without a root handler
+    return log_handlers or [logging.lastResort], loki_missing
+
+def start_logging(cfg):
+    """
+    Sends all log records through a queue to the configured handlers and
+    returns the listener running them.
+    """
+    log_handlers, loki_missing = create_log_handlers(cfg)
+
+    # All handlers run on one listener thread, logging only enqueues the record
+    root_logger = logging.getLogger()
+    # Records no handler wants are dropped before they are created
+    root_logger.setLevel(min(handler.level for handler in log_handlers))
+    log_queue = queue.SimpleQueue()
+    root_logger.addHandler(DeferredQueueHandler(log_queue))
+    log_listener = QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+    if loki_missing:
         logging.error("python-logging-loki module not found. Please install it to use Loki logging.")
+    return log_listener
 
-logger = logging.getLogger("SmartMeter")
+def reload_log_handlers(cfg, log_listener):
+    log_handlers, loki_missing = create_log_handlers(cfg)
+    # Stopping writes out the queued records with the old handlers, records
+    # logged meanwhile wait in the queue for the new ones
+    log_listener.stop()
+    old_handlers = log_listener.handlers
+    log_listener.handlers = tuple(log_handlers)
+    logging.getLogger().setLevel(min(handler.level for handler in log_handlers))
+    log_listener.start()
+    for handler in old_handlers:
+        if handler is not logging.lastResort:
+            handler.close()
+    if loki_missing:
+        logging.error("python-logging-loki module not found. Please install it to use Loki logging.")
 
-#Print used configuration from dict config
-logger.info("Verwendete Konfiguration:")
-logger.info(cfg)
-logger.info("\n")
+# Serial Reader Init, one reader per meter
+def configured_meters(cfg):
+    """
+    Returns the meters list of the configuration or, without one, the single
+    meter on mbus.port with an empty label.
+    """
+    if not cfg.meters:
+        return [SimpleNamespace(label='', port=cfg.mbus.port, baudRate=cfg.mbus.baudRate, key=cfg.key, gateway=None)]
+
+    meters = []
+    for meter in cfg.meters:
+        meters.append(SimpleNamespace(label=meter.label, port=getattr(meter, 'port', ''),
+                                      baudRate=getattr(meter, 'baudRate', cfg.mbus.baudRate),
+                                      key=getattr(meter, 'key', cfg.key),
+                                      gateway=getattr(meter, 'gateway', None)))
+    labels = [meter.label for meter in meters]
+    if len(set(labels)) != len(labels):
+        logger.critical(f"Meter labels must be unique: {labels}")
+        sys.exit(1)
+    return meters
+
+def create_readers(cfg, meters, metrics):
+    """
+    One SerialReader per meter on a serial port. A single meter can read a
+    recording instead of the port and record its frames.
+    """
+    source = None
+    recorder = None
+    if len(meters) == 1:
+        if cfg.mbus.replay.file:
+            from frame_recorder import ReplaySerial
+            source = ReplaySerial(os.path.join(base_path, cfg.mbus.replay.file), cfg.mbus.replay.speed, cfg.mbus.replay.loop)
 
-metrics = AppMetrics()
+        if cfg.mbus.record.file:
+            from frame_recorder import FrameRecorder
+            recorder = FrameRecorder(os.path.join(base_path, cfg.mbus.record.file))
+    elif cfg.mbus.replay.file or cfg.mbus.record.file:
+        logger.warning("mbus.replay and mbus.record only work with a single meter, ignored")
 
-# Serial Reader Init
-reader = SerialReader(cfg.mbus.port, cfg.mbus.baudRate, cfg.key, metrics)
+    # A looped replay repeats its frame counters
+    track_frame_counter = not (source and cfg.mbus.replay.loop)
+
+    def serial_watchdog():
+        # A replay has no link that could stall
+        if source or not cfg.mbus.watchdog.enabled:
+            return None
+        return FrameWatchdog(cfg.mbus.watchdog.factor, cfg.mbus.watchdog.minTimeout, cfg.mbus.watchdog.initialTimeout)
+
+    return [(meter, SerialReader(meter.port, meter.baudRate, meter.key, metrics, cfg.mbus.decoder, source, recorder, track_frame_counter,
+                                 serial_watchdog(), cfg.mbus.watchdog.maxBackoff))
+            for meter in meters if not meter.gateway]
 
 #MQTT Init
-mqtt_handler = None
-if cfg.mqtt.enabled:
+def create_mqtt_handler(cfg):
+    if not cfg.mqtt.enabled:
+        return None
     from mqtt_handler import MQTTHandler
-    mqtt_handler = MQTTHandler(cfg.mqtt.brokerIP, cfg.mqtt.brokerPort, cfg.mqtt.authentication.username, cfg.mqtt.authentication.password, cfg.mqtt.mqttApiVersion)
+    return MQTTHandler(cfg.mqtt.brokerIP, cfg.mqtt.brokerPort, cfg.mqtt.authentication.username, cfg.mqtt.authentication.password, cfg.mqtt.mqttApiVersion, cfg.mqtt.inflightWindow)
 
-influx_handler = None
-if cfg.influxdb.enabled:
+def create_influx_handler(cfg):
+    if not cfg.influxdb.enabled:
+        return None
     from influx_handler import InfluxHandler
-    influx_handler = InfluxHandler(cfg.influxdb.serverIP, cfg.influxdb.serverPort, cfg.influxdb.database, cfg.influxdb.authentication.username, cfg.influxdb.authentication.password, cfg.influxdb.version, cfg.influxdb.organization, cfg.influxdb.database)
-    
-prometheus_handler = None
-if cfg.prometheus.enabled:
+    influx_spool = None
+    if cfg.influxdb.spool.enabled:
+        from influx_spool import InfluxSpool
+        spool_path = os.path.join(base_path, cfg.influxdb.spool.path)
+        influx_spool = InfluxSpool(spool_path, cfg.influxdb.spool.maxPoints, cfg.influxdb.spool.batchSize, cfg.influxdb.spool.evictionPolicy)
+    return InfluxHandler(cfg.influxdb.serverIP, cfg.influxdb.serverPort, cfg.influxdb.database, cfg.influxdb.authentication.username, cfg.influxdb.authentication.password, cfg.influxdb.version, cfg.influxdb.organization, cfg.influxdb.database, influx_spool)
+
+def create_prometheus_handler(cfg, metrics):
+    if not cfg.prometheus.enabled:
+        return None
     from prometheus_handler import PrometheusHandler
-    prometheus_handler = PrometheusHandler(cfg.prometheus.port, metrics)
+    return PrometheusHandler(cfg.prometheus.port, metrics, cfg.prometheus.exposeValues, cfg.prometheus.exposeMetrics)
+
+class Backends:
+    """
+    The MQTT, InfluxDB and Prometheus handlers of the sinks. On startup
+    connect() creates them on a background thread while the first frames
+    are read, the workers of their sinks buffer them meanwhile.
+    """
+
+    SECTIONS = ('mqtt', 'influxdb', 'prometheus')
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.mqtt = None
+        self.influxdb = None
+        self.prometheus = None
+        # The background connect and reloads take turns
+        self.lock = threading.Lock()
+
+    def _rebuild(self, cfg, sections):
+        """
+        Closes the handlers of sections and creates them anew for cfg. A
+        handler that cannot be created stays None, the worker of its sink
+        stays paused until a reload of its section succeeds.
+        """
+        factories = {
+            'mqtt': lambda: create_mqtt_handler(cfg),
+            'influxdb': lambda: create_influx_handler(cfg),
+            'prometheus': lambda: create_prometheus_handler(cfg, self.metrics),
+        }
+        for section in self.SECTIONS:
+            if section not in sections:
+                continue
+            old_handler = getattr(self, section)
+            setattr(self, section, None)
+            if old_handler:
+                old_handler.close()
+            try:
+                handler = factories[section]()
+            except Exception as e:
+                logger.error(f"{section} kann nicht gestartet werden, die Werte werden verworfen, bis die Konfiguration neu geladen wird: {e!r}")
+                continue
+            if section == 'prometheus' and handler and old_handler:
+                handler.latest.update(old_handler.latest)
+                handler.energy.update(old_handler.energy)
+            setattr(self, section, handler)
+
+    def connect(self, cfg, pipeline, startup):
+        def run():
+            with self.lock:
+                try:
+                    self._rebuild(cfg, self.SECTIONS)
+                    pipeline.configure(cfg, self, reset_deadband=False)
+                except Exception as e:
+                    logger.error(f"Ausgaben können nicht gestartet werden: {e!r}")
+                finally:
+                    # Only the workers whose handler is ready
+                    pipeline.resume()
+            startup.mark('connect')
+
+        threading.Thread(target=run, name="connect", daemon=True).start()
 
-pv = PowerValues()
+    def apply(self, cfg, sections, pipeline):
+        """
+        Rebuilds the handlers of the changed sections and reconfigures the
+        pipeline, its workers wait meanwhile.
+        """
+        with self.lock:
+            pipeline.pause()
+            try:
+                self._rebuild(cfg, sections.intersection(self.SECTIONS))
+                pipeline.configure(cfg, self, reset_deadband='deadband' in sections)
+            finally:
+                pipeline.resume()
 
-def process_data_handlers(pv, metrics, cfg, mqtt_handler, influx_handler, prometheus_handler):
+class ValueTableLimiter:
     """
-    Handles logging, and sending data to MQTT, InfluxDB, and Prometheus.
+    Decides per meter whether a frame is printed as value table: every
+    every_frames-th frame, and at most once per interval seconds.
     """
-    # Console Logging of Power Values
-    if cfg.logging.console.enabled:
-        now = datetime.now()
-        logger.info("\n\t\t*** KUNDENSCHNITTSTELLE ***\n\nOBIS Code\tBezeichnung\t\t\t Wert")
-        logger.info(now.strftime("%d.%m.%Y %H:%M:%S"))
-        for item in pv:
-            val = item['valueDisplay']
-            if item['unit'] in ['V', 'A']:
-                val = round(val, 2)
-            logger.info("{0:<14}\t{1:<30} [{2}]:\t {3}".format(item['keySmartmeter'], item['long'], item['unit'], val))
-        
-        gesamt = pv.get_display_value('MomentanleistungP') - pv.get_display_value('MomentanleistungN')
-        logger.info(f"-------------\tWirkleistunggesamt [W]:\t\t {gesamt}")
-
-    # MQTT Handler
-    if cfg.mqtt.enabled and mqtt_handler:
-        mqtt_handler.ensure_connection()
-        all_published = True
-        for item in pv:
-            if not mqtt_handler.publish(f"{cfg.mqtt.mqttPrefix}{item['mqttTopicName']}", item['valueDisplay']):
-                all_published = False
-
-        gesamt = pv.get_display_value('MomentanleistungP') - pv.get_display_value('MomentanleistungN')
-        if not mqtt_handler.publish(f"{cfg.mqtt.mqttPrefix}Wirkleistunggesamt", gesamt):
+
+    def __init__(self, every_frames=1, interval=0):
+        self.every_frames = max(1, every_frames)
+        self.interval = interval
+        self.frames = {}
+        self.printed = {}
+
+    def due(self, meter, now):
+        count = self.frames.get(meter, 0) + 1
+        self.frames[meter] = count
+        if count % self.every_frames:
+            return False
+        last = self.printed.get(meter)
+        if last is not None and now - last < self.interval:
+            return False
+        self.printed[meter] = now
+        return True
+
+def log_values(pv, cfg, limiter=None):
+    """
+    Prints the current values as table on the console, one log record per
+    table.
+    """
+    if limiter and not limiter.due(pv.meter, time.monotonic()):
+        return
+    now = datetime.now()
+    title = f"KUNDENSCHNITTSTELLE {pv.meter}" if pv.meter else "KUNDENSCHNITTSTELLE"
+    lines = [f"\n\t\t*** {title} ***\n\nOBIS Code\tBezeichnung\t\t\t Wert", now.strftime("%d.%m.%Y %H:%M:%S")]
+    for register, val in pv.items():
+        if register.unit in ['V', 'A']:
+            val = round(val, 2)
+        lines.append("{0:<14}\t{1:<30} [{2}]:\t {3}".format(register.keySmartmeter, register.long, register.unit, val))
+
+    lines.append(f"-------------\tWirkleistunggesamt [W]:\t\t {pv.wirkleistung_gesamt}")
+    logger.info("\n".join(lines))
+
+def record_mqtt_result(metrics, all_published):
+    metrics.mqtt_last_success = all_published
+    if all_published:
+        metrics.mqtt_successes += 1
+    else:
+        metrics.mqtt_failures += 1
+
+def send_mqtt(pv, metrics, cfg, mqtt_handler, deadband=None):
+    mqtt_handler.ensure_connection()
+    # Topics of a labelled meter: <mqttPrefix><label>/<topic>
+    prefix = f"{cfg.mqtt.mqttPrefix}{pv.meter}/" if pv.meter else cfg.mqtt.mqttPrefix
+    if isinstance(pv, EnergyTotals):
+        # <prefix>Energie/<period>/Bezug|Lieferung in kWh
+        messages = []
+        for name, _, imported, exported in pv.periods:
+            messages.append((f"{prefix}Energie/{name}/Bezug", round(imported, 3)))
+            messages.append((f"{prefix}Energie/{name}/Lieferung", round(exported, 3)))
+        publish_mqtt(messages, metrics, cfg, mqtt_handler)
+        return
+
+    messages = [(f"{prefix}{register.mqttTopicName}", value) for register, value in pv.items()]
+    messages.append((f"{prefix}Wirkleistunggesamt", pv.wirkleistung_gesamt))
+    # Aggregated streams are not filtered, like send_influx
+    if deadband and not isinstance(pv, AggregateSnapshot):
+        mask = deadband.filter(pv)
+        metrics.count_deadband('mqtt', mask)
+        messages = [message for message, send in zip(messages, mask) if send]
+
+    if cfg.mqtt.jsonTopic:
+        snapshot = {register.mqttTopicName: value for register, value in pv.items()}
+        snapshot['Wirkleistunggesamt'] = pv.wirkleistung_gesamt
+        snapshot['timestamp'] = pv.timestamp
+        snapshot['frameCounter'] = pv.frame_counter
+        if pv.meter:
+            snapshot['meter'] = pv.meter
+        messages.append((f"{prefix}{cfg.mqtt.jsonTopic}", json.dumps(snapshot)))
+
+    if not messages:
+        # Every value stayed within its deadband
+        return
+    publish_mqtt(messages, metrics, cfg, mqtt_handler)
+
+def publish_mqtt(messages, metrics, cfg, mqtt_handler):
+    if cfg.mqtt.pipelined:
+        mqtt_handler.publish_batch(messages, partial(record_mqtt_result, metrics))
+        return
+
+    all_published = True
+    for topic, payload in messages:
+        if not mqtt_handler.publish(topic, payload):
             all_published = False
+    record_mqtt_result(metrics, all_published)
 
-        metrics.mqtt_last_success = all_published
-        if all_published:
-            metrics.mqtt_successes += 1
+def send_influx(pv, metrics, cfg, influx_handler, deadband=None):
+    if cfg.influxdb.sendValues:
+        mask = None
+        if deadband and not isinstance(pv, (AggregateSnapshot, EnergyTotals)):
+            mask = deadband.filter(pv)
+            metrics.count_deadband('influxdb', mask)
+        if influx_handler.write_values(pv, mask):
+            metrics.influxdb_successes += 1
+            metrics.influxdb_last_success = True
         else:
-            metrics.mqtt_failures += 1
-
-    # InfluxDB Handler
-    if cfg.influxdb.enabled and influx_handler:
-        if cfg.influxdb.sendValues:
-            if influx_handler.write_values(pv):
-                metrics.influxdb_successes += 1
-                metrics.influxdb_last_success = True
+            metrics.influxdb_failures += 1
+            metrics.influxdb_last_success = False
+        metrics.influxdb_spool_depth = influx_handler.spool_depth()
+        metrics.influxdb_spool_evicted = influx_handler.spool_evicted()
+        metrics.influxdb_rejected = influx_handler.rejected
+
+    if cfg.influxdb.sendMetrics:
+        influx_handler.write_metrics(metrics)
+
+def create_deadband_filters(cfg):
+    if not cfg.deadband.enabled:
+        return {'mqtt': None, 'influxdb': None}
+    rules = {key: vars(rule) for key, rule in vars(cfg.deadband.rules).items()}
+    return {name: DeadbandFilter(rules, cfg.deadband.heartbeat) for name in ('mqtt', 'influxdb')}
+
+def sink_streams(cfg, windows):
+    """
+    Returns the stream ('raw' or the name of one of the aggregation windows)
+    of every enabled sink.
+    """
+    streams = {}
+    if cfg.logging.console.enabled:
+        streams['console'] = 'raw'
+    if cfg.mqtt.enabled:
+        streams['mqtt'] = cfg.mqtt.stream
+    if cfg.influxdb.enabled:
+        streams['influxdb'] = cfg.influxdb.stream
+    if cfg.prometheus.enabled and cfg.prometheus.exposeValues:
+        # App metrics are read at scrape time, only the values need the latest snapshot
+        streams['prometheus'] = cfg.prometheus.stream
+    for name, stream in streams.items():
+        if stream != 'raw' and stream not in vars(windows):
+            raise ValueError(f"Sink {name} uses unknown stream {stream}, configure it in aggregation.windows")
+    return streams
+
+class SinkPipeline:
+    """
+    One worker with its own bounded queue per enabled sink, grouped by the
+    stream the sink consumes. configure() is called again once the backends
+    are connected and after a reload: the workers of sinks that stay
+    enabled keep their queues, the read loops pick up the new streams with
+    their next frame. The worker of a sink whose backend is not ready yet
+    is paused and buffers.
+    """
+
+    def __init__(self, metrics, windows, timeseries_store=None, energy_counters=None, archive=None):
+        self.metrics = metrics
+        # aggregation.windows, only a restart changes them
+        self.windows = windows
+        self.timeseries_store = timeseries_store
+        self.energy_counters = energy_counters
+        self.archive = archive
+        self.workers = {}
+        self.streams = {}
+        self.energy_workers = []
+        self.deadband = None
+        # Changes with every configure(), see MeterWindows
+        self.generation = 0
+
+    def _handlers(self, cfg, backends):
+        # None for a sink whose backend is not ready
+        handlers = {}
+        if cfg.logging.console.enabled:
+            table = cfg.logging.console.valueTable
+            handlers['console'] = partial(log_values, cfg=cfg, limiter=ValueTableLimiter(table.everyFrames, table.interval))
+        if cfg.mqtt.enabled:
+            handlers['mqtt'] = partial(send_mqtt, metrics=self.metrics, cfg=cfg, mqtt_handler=backends.mqtt, deadband=self.deadband['mqtt']) if backends.mqtt else None
+        if cfg.influxdb.enabled:
+            handlers['influxdb'] = partial(send_influx, metrics=self.metrics, cfg=cfg, influx_handler=backends.influxdb, deadband=self.deadband['influxdb']) if backends.influxdb else None
+        if cfg.prometheus.enabled and cfg.prometheus.exposeValues:
+            handlers['prometheus'] = backends.prometheus.update_values if backends.prometheus else None
+        return handlers
+
+    def configure(self, cfg, backends, reset_deadband=True):
+        """
+        Starts the workers of newly enabled sinks, hands the others their
+        handler for cfg and stops the workers of disabled sinks. The
+        deadband filters keep their state unless reset_deadband is set.
+        """
+        streams = sink_streams(cfg, self.windows)
+        if reset_deadband or self.deadband is None:
+            self.deadband = create_deadband_filters(cfg)
+        sinks = {name: (streams[name], handler) for name, handler in self._handlers(cfg, backends).items()}
+        if self.timeseries_store:
+            sinks['timeseries'] = ('raw', self.timeseries_store.add)
+        queues = {name: (cfg.pipeline.queueSize, cfg.pipeline.overflowPolicy) for name in sinks}
+        if self.archive:
+            sinks['archive'] = ('raw', self.archive.add)
+            # The archive wants every frame, by default a full queue holds up the readers
+            queues['archive'] = (cfg.archive.queueSize, cfg.archive.overflowPolicy)
+
+        by_stream = {}
+        for name, (stream, handler) in sinks.items():
+            queue_size, overflow_policy = queues[name]
+            worker = self.workers.get(name)
+            if worker is None:
+                worker = self.workers[name] = SinkWorker(name, handler, self.metrics, queue_size, overflow_policy)
+                worker.start()
             else:
-                metrics.influxdb_failures += 1
-                metrics.influxdb_last_success = False
-
-        if cfg.influxdb.sendMetrics:
-            influx_handler.write_metrics(metrics)
-
-    # Prometheus Handler
-    if cfg.prometheus.enabled and prometheus_handler:
-        if cfg.prometheus.exposeValues:
-            prometheus_handler.update_values(pv)
-        if cfg.prometheus.exposeMetrics:
-            prometheus_handler.update_metrics()
-
-while 1:
-    reader.read(pv)
-    process_data_handlers(pv, metrics, cfg, mqtt_handler, influx_handler, prometheus_handler)
+                worker.reconfigure(handler, queue_size, overflow_policy)
+            if handler is None:
+                worker.pause()
+            by_stream.setdefault(stream, []).append(worker)
+        for name in [name for name in self.workers if name not in sinks]:
+            self.workers.pop(name).stop()
+
+        self.energy_workers = [worker for name, worker in self.workers.items() if name in ('mqtt', 'influxdb', 'prometheus')]
+        self.streams = by_stream
+        self.generation += 1
+
+    def pause(self):
+        for worker in self.workers.values():
+            worker.pause()
+
+    def resume(self):
+        for worker in self.workers.values():
+            if worker.handler:
+                worker.resume()
+
+def create_aggregators(windows, streams, meter='', aggregators=()):
+    """
+    Creates the tumbling windows of one meter which at least one sink
+    consumes. Windows of aggregators still consumed are kept with their
+    running state.
+    """
+    existing = {aggregator.name: aggregator for aggregator in aggregators}
+    return [existing.get(name) or WindowAggregator(name, length, meter)
+            for name, length in vars(windows).items() if name in streams]
+
+class MeterWindows:
+    """
+    The aggregators of one meter, updated when a reload changed the streams
+    of the pipeline.
+    """
+
+    def __init__(self, meter, pipeline):
+        self.meter = meter
+        self.pipeline = pipeline
+        self.generation = None
+        self.aggregators = []
+
+    def current(self):
+        if self.generation != self.pipeline.generation:
+            self.generation = self.pipeline.generation
+            self.aggregators = create_aggregators(self.pipeline.windows, self.pipeline.streams, self.meter, self.aggregators)
+        return self.aggregators
+
+def dispatch_aggregate(aggregate, streams):
+    if aggregate is not None:
+        # The stream may be gone since a reload
+        for worker in streams.get(aggregate.window, ()):
+            worker.put(aggregate)
+
+def process_data_handlers(pv, pipeline, windows):
+    """
+    Hands a snapshot of the current values to every sink worker (console,
+    MQTT, InfluxDB, Prometheus, time series and archive) of the raw stream
+    and feeds the windows, whose aggregates go to the workers of that window
+    when it closes. The period energy totals go to MQTT, InfluxDB and
+    Prometheus whatever stream they consume.
+    """
+    snapshot = pv.snapshot()
+    aggregators = windows.current()
+    streams = pipeline.streams
+    for worker in streams.get('raw', ()):
+        worker.put(snapshot)
+    for aggregator in aggregators:
+        dispatch_aggregate(aggregator.add(snapshot), streams)
+    if pipeline.energy_counters:
+        for totals in pipeline.energy_counters.update(snapshot):
+            for worker in pipeline.energy_workers:
+                worker.put(totals)
+
+def run_meter(meter, reader, pipeline, startup):
+    """
+    Read loop of one meter, all meters share the sink workers.
+    """
+    pv = PowerValues(meter.label)
+    windows = MeterWindows(meter.label, pipeline)
+    try:
+        while 1:
+            reader.read(pv)
+            process_data_handlers(pv, pipeline, windows)
+            startup.mark('first_frame')
+    except ReplayFinished as e:
+        logger.info(e)
+        # Hand out the partial windows, the recording ends inside of them
+        for aggregator in windows.aggregators:
+            dispatch_aggregate(aggregator.flush(), pipeline.streams)
+
+def run_meter_thread(meter, reader, pipeline, startup, log_listener):
+    try:
+        run_meter(meter, reader, pipeline, startup)
+    except BaseException as e:
+        # Same as a single meter: a reader giving up ends the process
+        logger.critical(f"Reader of meter {meter.label} stopped: {e!r}")
+        # os._exit skips atexit, write out the queued log records first
+        log_listener.stop()
+        os._exit(1)
+
+def start_gateway(cfg, gateway_meters, pipeline, metrics, startup):
+    """
+    Receives the network meters on an event loop thread, the values of each
+    meter go through its own PowerValues and windows like a serial meter.
+    """
+    from gateway import GatewayIngest, GatewayMeter
+
+    state = {meter.label: (PowerValues(meter.label), MeterWindows(meter.label, pipeline)) for meter in gateway_meters}
+
+    def on_values(label, raw, receive_time, frame_counter, payload):
+        pv, windows = state[label]
+        pv.raw[:] = raw
+        pv.timestamp = receive_time
+        pv.frame_counter = frame_counter
+        pv.payload = payload
+        process_data_handlers(pv, pipeline, windows)
+        startup.mark('first_frame')
+
+    sources = [GatewayMeter(meter.label, meter.key, meter.gateway.mode, meter.gateway.host, meter.gateway.port) for meter in gateway_meters]
+    workers = cfg.gateway.decodeWorkers if cfg.gateway.decodeWorkers >= 0 else None
+    return GatewayIngest(sources, on_values, workers, metrics).start()
+
+class StartupTimer:
+    """
+    Seconds from the start of the script to the end of each startup phase,
+    kept in AppMetrics.startup and logged once all phases are done. The
+    sinks connect while the first frame is read, so connect may come last.
+    """
+
+    PHASES = ('import', 'config', 'connect', 'first_frame')
+
+    def __init__(self, metrics, started):
+        self.metrics = metrics
+        self.started = started
+        self.lock = threading.Lock()
+
+    def mark(self, phase, at=None):
+        # Called for every frame, after the first one only the lookup remains
+        if phase in self.metrics.startup:
+            return
+        with self.lock:
+            if phase in self.metrics.startup:
+                return
+            self.metrics.startup[phase] = (at or time.monotonic()) - self.started
+            done = len(self.metrics.startup) == len(self.PHASES)
+        if done:
+            logger.info("Startzeit: " + ", ".join(f"{phase} {self.metrics.startup[phase]:.2f} s" for phase in self.PHASES))
+
+# Only a restart applies these, the serial link and the in-memory state stay as they are
+RESTART_SECTIONS = ('mbus', 'key', 'meters', 'gateway', 'aggregation', 'timeseries', 'energy', 'archive', 'metrics')
+SINK_SECTIONS = ('logging', 'mqtt', 'influxdb', 'prometheus', 'pipeline', 'deadband')
+
+def apply_config(cfg, new_cfg, changed, backends, pipeline, log_listener, config_reloader):
+    """
+    Applies a reloaded configuration: rebuilds the log handlers and the
+    MQTT, InfluxDB and Prometheus handlers whose section changed and
+    reconfigures the sink workers. The readers keep running meanwhile, the
+    sink queues fill up while the workers are paused. Returns the
+    configuration in effect.
+    """
+    sections = {path.split('.')[0] for path in changed}
+    restart = sorted(sections.intersection(RESTART_SECTIONS))
+    if restart:
+        logger.warning(f"Änderungen an {', '.join(restart)} werden erst nach einem Neustart wirksam")
+    new_cfg = SimpleNamespace(**{**vars(new_cfg), **{name: getattr(cfg, name) for name in RESTART_SECTIONS}})
+
+    if 'reload' in sections:
+        config_reloader.watch_interval = new_cfg.reload.interval if new_cfg.reload.watchFile else 0
+    if not sections.intersection(SINK_SECTIONS):
+        return new_cfg
+    # Fails before anything was torn down
+    sink_streams(new_cfg, pipeline.windows)
+
+    if 'logging' in sections:
+        reload_log_handlers(new_cfg, log_listener)
+    backends.apply(new_cfg, sections, pipeline)
+    logger.info("Neue Konfiguration übernommen")
+    return new_cfg
+
+def main():
+    imported = time.monotonic()
+    # Load Configuration
+    config_handler = ConfigHandler()
+    cfg = config_handler.get_config()
+    log_listener = start_logging(cfg)
+    configured = time.monotonic()
+
+    #Print used configuration from dict config
+    logger.info("Verwendete Konfiguration:")
+    logger.info(cfg)
+    logger.info("\n")
+
+    metrics = AppMetrics(cfg.metrics.stageTimings)
+    startup = StartupTimer(metrics, STARTED)
+    startup.mark('import', imported)
+    startup.mark('config', configured)
+
+    meters = configured_meters(cfg)
+    readers = create_readers(cfg, meters, metrics)
+    gateway_meters = [meter for meter in meters if meter.gateway]
+
+    timeseries_store = None
+    if cfg.timeseries.enabled:
+        from timeseries import TimeSeriesStore, start_server
+        timeseries_store = TimeSeriesStore(cfg.timeseries.capacity)
+        try:
+            start_server(timeseries_store, cfg.timeseries.host, cfg.timeseries.port)
+        except OSError as e:
+            logger.critical(f"Zeitreihen-API kann nicht gestartet werden: {e}")
+            sys.exit(1)
+
+    energy_counters = None
+    if cfg.energy.enabled:
+        tariffs = {name: vars(window) for name, window in vars(cfg.energy.tariffs).items()}
+        energy_counters = EnergyCounters(os.path.join(base_path, cfg.energy.stateFile), tariffs, cfg.energy.checkpointInterval, cfg.energy.publishInterval)
+        atexit.register(energy_counters.checkpoint)
+
+    archive = None
+    if cfg.archive.enabled:
+        from archive import ArchiveWriter
+        archive = ArchiveWriter(os.path.join(base_path, cfg.archive.directory), metrics, cfg.archive.rotation, cfg.archive.format, cfg.archive.batchSize,
+                                cfg.archive.flushInterval, cfg.archive.retentionDays, cfg.archive.maxSizeMB, cfg.archive.rawFrames)
+        atexit.register(archive.close)
+
+    pipeline = SinkPipeline(metrics, cfg.aggregation.windows, timeseries_store, energy_counters, archive)
+    backends = Backends(metrics)
+    try:
+        pipeline.configure(cfg, backends)
+    except ValueError as e:
+        logger.critical(e)
+        sys.exit(1)
+    backends.connect(cfg, pipeline, startup)
+
+    def reload(new_cfg, changed):
+        nonlocal cfg
+        cfg = apply_config(cfg, new_cfg, changed, backends, pipeline, log_listener, config_reloader)
+
+    config_reloader = ConfigReloader(config_handler, reload, cfg.reload.interval if cfg.reload.watchFile else 0)
+    config_reloader.start()
+
+    # systemctl stop sends SIGTERM, as SystemExit it runs the finally below
+    # and the atexit handlers (archive, energy counters, log queue)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if len(readers) == 1 and not gateway_meters:
+            run_meter(*readers[0], pipeline, startup)
+        else:
+            threads = [threading.Thread(target=run_meter_thread, args=(meter, reader, pipeline, startup, log_listener), name=f"meter-{meter.label}", daemon=True)
+                       for meter, reader in readers]
+            for thread in threads:
+                thread.start()
+            if gateway_meters:
+                threads.append(start_gateway(cfg, gateway_meters, pipeline, metrics, startup))
+            for thread in threads:
+                thread.join()
+    finally:
+        for worker in pipeline.workers.values():
+            # A paused worker has no sink to hand its queue to
+            if not worker.paused:
+                worker.wait_idle(timeout=10)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import time
+import threading
+from bisect import bisect_left
+from collections import deque
+
+# Upper bounds of the histogram buckets in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Number of recent observations per stage used for the percentiles
+RECENT_SIZE = 512
+
+class StageTiming:
+    """
+    Duration histogram of one processing stage plus the most recent
+    observations for percentiles. Meter threads and sink workers observe
+    the same stages while the exporters read them, hence the lock.
+    """
+
+    __slots__ = ('count', 'total', 'buckets', 'recent', 'lock')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.recent = deque(maxlen=RECENT_SIZE)
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        bucket = bisect_left(BUCKETS, seconds)
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            self.buckets[bucket] += 1
+            self.recent.append(seconds)
+
+    def cumulative_buckets(self):
+        """
+        Returns [(upper bound, cumulative count), ...] ending with +Inf.
+        """
+        with self.lock:
+            buckets = list(self.buckets)
+        result = []
+        cumulative = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), buckets):
+            cumulative += count
+            result.append((bound, cumulative))
+        return result
+
+    def percentiles(self, quantiles=(0.5, 0.95, 0.99)):
+        with self.lock:
+            values = sorted(self.recent)
+        if not values:
+            return {q: 0.0 for q in quantiles}
+        last = len(values) - 1
+        return {q: values[min(last, int(q * len(values)))] for q in quantiles}
+
+class StageTimings:
+    """
+    Per stage latency of the frame processing (serial wait, decrypt,
+    translate, parse and the sinks). Observing costs one perf_counter call,
+    an uncontended lock and a few list operations; with enabled False it
+    is a no-op.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        return time.perf_counter() if self.enabled else 0.0
+
+    def observe(self, stage, start):
+        """
+        Records the time since start (as returned by start()) for stage and
+        returns the current time, so consecutive stages can be chained.
+        """
+        if not self.enabled:
+            return 0.0
+        now = time.perf_counter()
+        timing = self.stages.get(stage)
+        if timing is None:
+            with self.lock:
+                timing = self.stages.setdefault(stage, StageTiming())
+        timing.observe(now - start)
+        return now
+
+    def items(self):
+        return list(self.stages.items())
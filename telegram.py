@@ -0,0 +1,123 @@
+import logging
+from Cryptodome.Cipher import AES
+
+logger = logging.getLogger(__name__)
+
+GENERAL_GLO_CIPHERING = 0xDB
+SECURITY_AUTHENTICATED = 0x10
+GCM_TAG_LENGTH = 12
+DATA_NOTIFICATION_HEADER = b'\x0f\x80'
+
+# Why a frame or telegram was dropped, one counter each in AppMetrics
+REJECT_REASONS = ('checksum', 'stop_byte', 'segment', 'apdu_tag', 'length', 'duplicate', 'out_of_order', 'not_notification')
+
+def check_ciphered_apdu(payload):
+    """
+    Returns 'length' if the length fields of a general-glo-ciphering APDU
+    do not match the bytes received, else None. Keeps split_ciphered_apdu
+    from slicing a truncated telegram.
+    """
+    if len(payload) < 2:
+        return 'length'
+    pos = 2 + payload[1]
+    if pos >= len(payload):
+        return 'length'
+    length = payload[pos]
+    pos += 1
+    if length & 0x80:
+        count = length & 0x7F
+        length = int.from_bytes(payload[pos:pos + count], 'big')
+        pos += count
+    # Security control and frame counter at least, the length covers the rest exactly
+    if length < 5 or pos + length != len(payload):
+        return 'length'
+    return None
+
+def split_ciphered_apdu(payload):
+    """
+    Returns (system title, frame counter, ciphertext) of a
+    general-glo-ciphering APDU as memoryviews into payload.
+    """
+    # general-glo-ciphering: tag, system title, length, security control, frame counter, ciphertext
+    payload = memoryview(payload)
+    pos = 1
+    title_length = payload[pos]
+    system_title = payload[pos + 1:pos + 1 + title_length]
+    pos += 1 + title_length
+
+    length = payload[pos]
+    pos += 1
+    if length & 0x80:
+        count = length & 0x7F
+        length = int.from_bytes(payload[pos:pos + count], 'big')
+        pos += count
+
+    security_control = payload[pos]
+    frame_counter = payload[pos + 1:pos + 5]
+    end = pos + length
+    if security_control & SECURITY_AUTHENTICATED:
+        # The P1 port has no authentication key, drop the tag instead of decrypting it
+        end -= GCM_TAG_LENGTH
+    frame = payload[pos + 5:end]
+    return system_title, frame_counter, frame
+
+class TelegramCipher:
+    """
+    AES-GCM decryption without tag check, which is plain CTR mode starting
+    at counter block 2. The keystream is produced with a cached ECB cipher
+    so the key schedule is not rebuilt for every frame.
+    """
+
+    def __init__(self, key):
+        self.cipher = AES.new(key, AES.MODE_ECB)
+
+    def decrypt(self, frame, system_title, frame_counter):
+        init_vector = b''.join((system_title, frame_counter))
+        length = len(frame)
+        blocks = (length + 15) // 16
+        counters = b''.join([init_vector + i.to_bytes(4, 'big') for i in range(2, blocks + 2)])
+        keystream = self.cipher.encrypt(counters)
+        plain = int.from_bytes(frame, 'big') ^ int.from_bytes(keystream[:length], 'big')
+        return plain.to_bytes(length, 'big')
+
+    # CTR mode is symmetric, used by the frame generator
+    encrypt = decrypt
+
+class FrameCounterTracker:
+    """
+    Last accepted frame counter per system title. A telegram whose counter
+    is not above it is a duplicate or replay and rejected before it is
+    decrypted.
+
+    check() only looks, accept() records the counter once the telegram
+    decrypted to a Data-Notification, so a garbled telegram can not push
+    the counter up. After resync_after rejections in a row (meter replaced
+    or its counter reset) the counter of the meter starts over.
+    """
+
+    def __init__(self, resync_after=10):
+        self.resync_after = resync_after
+        self.last = {}
+        self.rejected = {}
+
+    def check(self, system_title, frame_counter):
+        """
+        Returns 'duplicate', 'out_of_order' or None if the telegram is new.
+        """
+        title = bytes(system_title)
+        last = self.last.get(title)
+        counter = int.from_bytes(frame_counter, 'big')
+        if last is None or counter > last:
+            return None
+
+        rejected = self.rejected.get(title, 0) + 1
+        if rejected >= self.resync_after:
+            logger.warning(f"Frame counter of {title.hex().upper()} restarted at {counter} (was {last}), accepting it")
+            return None
+        self.rejected[title] = rejected
+        return 'duplicate' if counter == last else 'out_of_order'
+
+    def accept(self, system_title, frame_counter):
+        title = bytes(system_title)
+        self.last[title] = int.from_bytes(frame_counter, 'big')
+        self.rejected[title] = 0
@@ -0,0 +1,56 @@
+import os
+import signal
+import asyncio
+from gateway import DecodePool, GatewayIngest, GatewayMeter, TelegramStream
+from benchmark import SAMPLE_KEY, SAMPLE_TELEGRAM
+from frame_generator import FrameGenerator, TEST_KEY, telegram_payloads
+from smartmeter import AppMetrics
+
+
+def test_dead_decode_worker_is_replaced():
+    payloads = TelegramStream().feed(SAMPLE_TELEGRAM)
+    pool = DecodePool(1)
+
+    async def run():
+        first = await pool.decode(0, SAMPLE_KEY, payloads)
+        broken = pool.executors[0]
+        for pid in list(broken._processes):
+            os.kill(pid, signal.SIGKILL)
+        second = await pool.decode(0, SAMPLE_KEY, payloads)
+        assert pool.executors[0] is not broken
+        return first, second
+
+    try:
+        first, second = asyncio.run(run())
+    finally:
+        pool.shutdown()
+    assert first == second
+    assert first[0] is not None
+
+
+def test_gateway_rejects_like_the_serial_reader():
+    first, second, third = telegram_payloads(frames for _, _, frames in FrameGenerator(TEST_KEY, seed=1).generate(3))
+    truncated = first[:-1]
+    no_cipher = b'\x0f' + first[1:]
+    telegrams = [first, second, truncated, no_cipher, second, first, third]
+
+    metrics = AppMetrics()
+    meter = GatewayMeter("pv", TEST_KEY, "udp", "127.0.0.1", 0)
+    decoded = []
+
+    async def run():
+        meter.queue = asyncio.Queue()
+        for payload in telegrams:
+            meter.queue.put_nowait((payload, 0.0))
+        ingest = GatewayIngest([meter], lambda label, raw, receive_time, frame_counter, payload: decoded.append(frame_counter), workers=0, metrics=metrics)
+        task = asyncio.create_task(ingest.decode_loop(0, meter, DecodePool(0)))
+        while not meter.queue.empty():
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+    asyncio.run(run())
+    assert decoded == [1, 2, 3]
+    assert metrics.frame_rejects['length'] == 1
+    assert metrics.frame_rejects['apdu_tag'] == 1
+    assert metrics.frame_rejects['duplicate'] == 1
+    assert metrics.frame_rejects['out_of_order'] == 1
@@ -0,0 +1,40 @@
+import time
+import itertools
+import paho.mqtt.client as mqtt
+from mqtt_handler import MQTTHandler
+
+
+class SilentClient:
+    """Queues every message but never gets a PUBACK."""
+
+    def __init__(self):
+        self.mids = itertools.count(1)
+
+    def publish(self, topic, payload, qos=0):
+        info = mqtt.MQTTMessageInfo(next(self.mids))
+        info.rc = mqtt.MQTT_ERR_SUCCESS
+        return info
+
+
+def handler(inflight_window, publish_timeout):
+    # Nothing listens on port 1, the connect error is only logged
+    mqtt_handler = MQTTHandler('127.0.0.1', 1, None, None, inflight_window=inflight_window, publish_timeout=publish_timeout)
+    mqtt_handler.client = SilentClient()
+    return mqtt_handler
+
+
+def test_full_window_fails_the_rest_of_the_frame_at_once():
+    mqtt_handler = handler(inflight_window=2, publish_timeout=0.2)
+    results = []
+    messages = [(f"smartmeter/{i}", "1") for i in range(10)]
+
+    started = time.monotonic()
+    mqtt_handler.publish_batch(messages, results.append)
+    # One wait for the window, not one per message
+    assert time.monotonic() - started < 0.6
+    assert results == []
+
+    # The next frame expires the unacknowledged messages of the first one
+    mqtt_handler.publish_batch(messages[:1], results.append)
+    assert results == [False]
+    assert len(mqtt_handler.pending) == 1
@@ -0,0 +1,60 @@
+import threading
+from config_handler import ConfigHandler
+from power_values import PowerValues
+from timeseries import TimeSeriesStore
+from smartmeter import AppMetrics, Backends, MeterWindows, SinkPipeline, process_data_handlers
+
+
+def config(**sections):
+    handler = ConfigHandler.__new__(ConfigHandler)
+    data = handler._merge_defaults(sections)
+    return handler._to_object(data)
+
+
+def test_failed_backend_does_not_block_the_readers():
+    cfg = config(
+        logging={'console': {'enabled': False}},
+        prometheus={'enabled': True, 'exposeValues': True, 'stream': 'raw'},
+        pipeline={'queueSize': 2, 'overflowPolicy': 'block'},
+    )
+    metrics = AppMetrics()
+    # The Prometheus handler failed to build and stays None
+    backends = Backends(metrics)
+    pipeline = SinkPipeline(metrics, cfg.aggregation.windows)
+    pipeline.configure(cfg, backends)
+    pipeline.resume()
+
+    pv = PowerValues()
+    windows = MeterWindows('', pipeline)
+    done = threading.Event()
+
+    def read():
+        for frame_counter in range(10):
+            pv.frame_counter = frame_counter
+            process_data_handlers(pv, pipeline, windows)
+        done.set()
+
+    threading.Thread(target=read, daemon=True).start()
+    assert done.wait(5)
+    assert metrics.sink_drops['prometheus'] == 8
+
+
+def test_block_waits_for_a_ready_sink():
+    cfg = config(
+        logging={'console': {'enabled': False}},
+        pipeline={'queueSize': 2, 'overflowPolicy': 'block'},
+    )
+    metrics = AppMetrics()
+    store = TimeSeriesStore(capacity=100)
+    pipeline = SinkPipeline(metrics, cfg.aggregation.windows, store)
+    pipeline.configure(cfg, Backends(metrics))
+
+    pv = PowerValues()
+    windows = MeterWindows('', pipeline)
+    for frame_counter in range(20):
+        pv.frame_counter = frame_counter
+        process_data_handlers(pv, pipeline, windows)
+    pipeline.workers['timeseries'].wait_idle(timeout=5)
+
+    assert store.meters()[''][0] == 20
+    assert metrics.sink_drops['timeseries'] == 0
@@ -0,0 +1,38 @@
+import sys
+import threading
+from stage_timings import StageTimings
+
+
+def test_concurrent_observations_are_all_counted():
+    timings = StageTimings()
+    stop = threading.Event()
+
+    def observe():
+        for _ in range(20000):
+            timings.observe('sink_mqtt', timings.start())
+
+    def export():
+        while not stop.is_set():
+            for _, timing in timings.items():
+                timing.percentiles()
+                timing.cumulative_buckets()
+
+    # Thread switches in the middle of the read-modify-writes
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        exporter = threading.Thread(target=export)
+        exporter.start()
+        threads = [threading.Thread(target=observe) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stop.set()
+        exporter.join()
+    finally:
+        sys.setswitchinterval(interval)
+
+    timing = dict(timings.items())['sink_mqtt']
+    assert timing.count == 80000
+    assert timing.cumulative_buckets()[-1][1] == 80000
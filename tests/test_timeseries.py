@@ -0,0 +1,29 @@
+import pytest
+from power_values import PowerValuesSnapshot, SHORT_INDEX
+from timeseries import TimeSeriesStore
+
+
+def snapshot(timestamp, power_factor):
+    raw = [0] * len(SHORT_INDEX)
+    raw[SHORT_INDEX['Leistungsfaktor']] = power_factor
+    return PowerValuesSnapshot(raw, timestamp, 1, 'haus')
+
+
+def test_negative_raw_value_is_stored():
+    store = TimeSeriesStore(capacity=4)
+    store.add(snapshot(100.0, -950))
+    store.add(snapshot(101.0, 980))
+
+    _, response = store.query('haus', registers=[SHORT_INDEX['Leistungsfaktor']])
+    assert response['timestamps'] == [100.0, 101.0]
+    assert response['values']['Leistungsfaktor'] == pytest.approx([-0.95, 0.98])
+
+
+def test_ring_keeps_the_newest_frames():
+    store = TimeSeriesStore(capacity=2)
+    for second in range(3):
+        store.add(snapshot(100.0 + second, -second))
+
+    _, response = store.query('haus', registers=[SHORT_INDEX['Leistungsfaktor']])
+    assert response['timestamps'] == [101.0, 102.0]
+    assert response['values']['Leistungsfaktor'] == pytest.approx([-0.001, -0.002])
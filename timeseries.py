@@ -0,0 +1,238 @@
+"""
+Recent values of every meter in fixed size ring buffers, served as JSON
+over HTTP for local dashboards and automation rules:
+
+    GET /api/meters
+    GET /api/latest?meter=haus
+    GET /api/range?meter=haus&last=600&step=10&agg=mean&registers=MomentanleistungP,1.0.32.7.0.255
+    GET /api/range?meter=haus&from=1760000000&to=1760003600
+
+from/to are Unix times, last selects the seconds before the newest sample.
+With step the samples are downsampled to buckets of step seconds (agg:
+mean, min, max or last). Responses carry an ETag that changes with every
+new frame of the meter, a request with If-None-Match gets 304 until then.
+"""
+import json
+import logging
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from power_values import REGISTERS, FACTORS, P_INDEX, N_INDEX, find_register
+
+logger = logging.getLogger(__name__)
+
+AGGREGATIONS = {
+    'mean': lambda values: sum(values) / len(values),
+    'min': min,
+    'max': max,
+    'last': lambda values: values[-1],
+}
+
+class RingSeries:
+    """
+    The last capacity frames of one meter: receive times as doubles and the
+    raw register values as signed 64 bit integers (a few registers are DLMS
+    integers), 96 bytes per frame (8.3 MB for 24 h at one frame per second)
+    allocated up front.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.registers = [array('q', bytes(8 * capacity)) for _ in REGISTERS]
+        self.count = 0
+        self.next = 0
+        # Changes with every frame, the ETag of the responses
+        self.version = 0
+        self.latest = None
+
+    def add(self, snapshot):
+        i = self.next
+        self.timestamps[i] = snapshot.timestamp
+        for column, value in zip(self.registers, snapshot.raw):
+            column[i] = value
+        self.next = (i + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self.version += 1
+        self.latest = snapshot
+
+    def _index(self, position):
+        # position 0 is the oldest sample
+        return (self.next - self.count + position) % self.capacity
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, position):
+        # Sequence of the timestamps in time order, for bisect
+        return self.timestamps[self._index(position)]
+
+    def range(self, start, end):
+        """
+        Ring indexes of the samples with start <= timestamp <= end in time order.
+        """
+        first = bisect_left(self, start, 0, self.count)
+        last = bisect_right(self, end, first, self.count)
+        return [self._index(position) for position in range(first, last)]
+
+class TimeSeriesStore:
+    """
+    One RingSeries per meter, filled by a sink worker and read by the HTTP
+    handler threads.
+    """
+
+    def __init__(self, capacity=86400):
+        self.capacity = int(capacity)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def add(self, snapshot):
+        with self.lock:
+            series = self.series.get(snapshot.meter)
+            if series is None:
+                series = self.series[snapshot.meter] = RingSeries(self.capacity)
+            series.add(snapshot)
+
+    def meters(self):
+        with self.lock:
+            return {meter: (series.count, series.version) for meter, series in self.series.items()}
+
+    def latest(self, meter):
+        """
+        Returns (version, response) of the newest snapshot or None.
+        """
+        with self.lock:
+            series = self.series.get(meter)
+            if series is None or series.latest is None:
+                return None
+            snapshot, version = series.latest, series.version
+        values = {register.short: value for register, value in snapshot.items()}
+        values['Wirkleistunggesamt'] = snapshot.wirkleistung_gesamt
+        return version, {'meter': meter, 'timestamp': snapshot.timestamp, 'frameCounter': snapshot.frame_counter, 'values': values}
+
+    def query(self, meter, start=None, end=None, last=None, step=None, agg='mean', registers=None):
+        """
+        Returns (version, response) with the columns of the selected samples,
+        downsampled to step seconds if given, or None for an unknown meter.
+        """
+        indexes = list(range(len(REGISTERS))) if registers is None else registers
+        with self.lock:
+            series = self.series.get(meter)
+            if series is None:
+                return None
+            version = series.version
+            if last is not None and series.count:
+                end = series[series.count - 1]
+                start = end - last
+            ring = series.range(float('-inf') if start is None else start, float('inf') if end is None else end)
+            timestamps = [series.timestamps[i] for i in ring]
+            columns = {index: [series.registers[index][i] for i in ring] for index in set(indexes) | {P_INDEX, N_INDEX}}
+
+        # Display values outside of the lock, the raw columns are copies
+        display = {index: [raw * FACTORS[index] for raw in column] for index, column in columns.items()}
+        total = [p - n for p, n in zip(display[P_INDEX], display[N_INDEX])]
+        names = [REGISTERS[index].short for index in indexes] + ['Wirkleistunggesamt']
+        values = [display[index] for index in indexes] + [total]
+
+        if step:
+            timestamps, values = self._downsample(timestamps, values, step, AGGREGATIONS[agg])
+        return version, {'meter': meter, 'step': step, 'timestamps': timestamps, 'values': dict(zip(names, values))}
+
+    @staticmethod
+    def _downsample(timestamps, columns, step, aggregate):
+        """
+        Buckets aligned to multiples of step, each labelled with its start.
+        """
+        starts = []
+        bounds = []
+        for position, timestamp in enumerate(timestamps):
+            bucket = timestamp - timestamp % step
+            if not starts or bucket != starts[-1]:
+                starts.append(bucket)
+                bounds.append(position)
+        bounds.append(len(timestamps))
+        slices = list(zip(bounds, bounds[1:]))
+        return starts, [[aggregate(column[lo:hi]) for lo, hi in slices] for column in columns]
+
+class TimeSeriesRequestHandler(BaseHTTPRequestHandler):
+    store = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            if url.path == '/api/meters':
+                meters = self.store.meters()
+                version = sum(version for _, version in meters.values())
+                result = (version, {'meters': [{'meter': meter, 'samples': count} for meter, (count, _) in meters.items()]})
+            elif url.path == '/api/latest':
+                result = self.store.latest(params.get('meter', ''))
+            elif url.path == '/api/range':
+                result = self.store.query(params.get('meter', ''), **self._range_params(params))
+            else:
+                self._send(404, {'error': 'unknown path'})
+                return
+        except ValueError as e:
+            self._send(400, {'error': str(e)})
+            return
+
+        if result is None:
+            self._send(404, {'error': 'unknown meter or no data yet'})
+            return
+        version, body = result
+        # The query is part of the URL the client caches under, the version
+        # alone tells whether the data changed
+        etag = f'"{version}"'
+        if self.headers.get('If-None-Match') == etag:
+            self._send(304, None, etag)
+            return
+        self._send(200, body, etag)
+
+    @staticmethod
+    def _range_params(params):
+        def number(key):
+            return float(params[key]) if key in params else None
+
+        registers = None
+        if params.get('registers'):
+            registers = []
+            for key in params['registers'].split(','):
+                index = find_register(key)
+                if index is None:
+                    raise ValueError(f"unknown register {key}")
+                registers.append(index)
+        agg = params.get('agg', 'mean')
+        if agg not in AGGREGATIONS:
+            raise ValueError(f"agg must be one of {', '.join(AGGREGATIONS)}")
+        step = number('step')
+        if step is not None and step <= 0:
+            raise ValueError("step must be positive")
+        return {'start': number('from'), 'end': number('to'), 'last': number('last'), 'step': step, 'agg': agg, 'registers': registers}
+
+    def _send(self, status, body, etag=None):
+        payload = b'' if body is None else json.dumps(body, separators=(',', ':')).encode()
+        self.send_response(status)
+        if body is not None:
+            self.send_header('Content-Type', 'application/json')
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+def start_server(store, host, port):
+    """
+    Serves store on host:port from a daemon thread.
+    """
+    handler = type('Handler', (TimeSeriesRequestHandler,), {'store': store})
+    server = ThreadingHTTPServer((host, int(port)), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="timeseries-http", daemon=True).start()
+    logger.info(f"Zeitreihen-API läuft auf {host}:{port}")
+    return server